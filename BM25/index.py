@@ -0,0 +1,157 @@
+import hashlib
+import math
+import os
+import pickle
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from Utils.path_manager import PathManager
+
+DEFAULT_K1 = 1.5
+DEFAULT_B = 0.75
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|[0-9]+")
+# e.g. "HTTPServerError2" ==> "HTTP", "Server", "Error", "2"
+SUB_TOKEN_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+
+def tokenize_code(text: str) -> List[str]:
+    """
+    Split code into lower-cased identifiers and their camelCase / snake_case parts, e.g.:
+
+        "getRangeAxis(int index)" ==> ["getrangeaxis", "get", "range", "axis", "int", "index"]
+    """
+    tokens = []
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        parts = [
+            part.lower()
+            for word in identifier.split("_") if word
+            for part in SUB_TOKEN_PATTERN.findall(word)
+        ]
+        if len(parts) != 1 or parts[0] != identifier.lower():
+            tokens.append(identifier.lower())
+        tokens.extend(parts)
+    return tokens
+
+
+def get_doc_id(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class BM25Index:
+    """
+    Okapi BM25 inverted index over method bodies, persisted per project.
+
+    Documents are identified by the hash of their text, so the methods shared by the bug
+    versions of a project are tokenized once and a new version only adds the changed
+    methods. Queries are restricted to the documents of one version, whose statistics
+    (document frequencies, average length) are computed on the fly.
+    """
+
+    def __init__(self, index_file: Optional[str] = None, k1: float = DEFAULT_K1, b: float = DEFAULT_B):
+        self.index_file = index_file
+        self.k1 = k1
+        self.b = b
+        self.doc_ids: List[str] = []
+        self.doc_positions: Dict[str, int] = {}
+        self.doc_lengths: List[int] = []
+        # term ==> {doc position: term frequency}
+        self.postings: Dict[str, Dict[int, int]] = {}
+
+    @classmethod
+    def load(cls, index_file: str, **kwargs) -> "BM25Index":
+        if os.path.exists(index_file):
+            with open(index_file, "rb") as f:
+                index = pickle.load(f)
+            index.index_file = index_file
+            return index
+        return cls(index_file, **kwargs)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(self, f)
+        os.replace(tmp_file, self.index_file)
+
+    def add_documents(self, texts: List[str]) -> Tuple[List[str], int]:
+        """Index the texts not indexed yet, returns the ids of all texts and the number added."""
+        doc_ids = []
+        n_added = 0
+        for text in texts:
+            doc_id = get_doc_id(text)
+            doc_ids.append(doc_id)
+            if doc_id in self.doc_positions:
+                continue
+            position = len(self.doc_ids)
+            self.doc_ids.append(doc_id)
+            self.doc_positions[doc_id] = position
+            tokens = tokenize_code(text)
+            self.doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                self.postings.setdefault(term, {})[position] = tf
+            n_added += 1
+        return doc_ids, n_added
+
+    def score_batch(self, queries: List[str], doc_ids: List[str]) -> np.ndarray:
+        """BM25 scores of the documents doc_ids against each query, shape (n_queries, n_docs)."""
+        positions = np.array([self.doc_positions[doc_id] for doc_id in doc_ids], dtype=np.int64)
+        # map index positions to rows of the active documents, identical methods share a position
+        rows: Dict[int, List[int]] = {}
+        for row, position in enumerate(positions):
+            rows.setdefault(int(position), []).append(row)
+        lengths = np.array([self.doc_lengths[position] for position in positions], dtype=np.float64)
+        n_docs = len(positions)
+        avg_length = lengths.mean() if n_docs else 0.0
+        norms = self.k1 * (1 - self.b + self.b * lengths / avg_length) if avg_length else np.full(n_docs, self.k1)
+
+        query_tokens = [tokenize_code(query) for query in queries]
+        term_scores: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for term in set(token for tokens in query_tokens for token in tokens):
+            hits = [
+                (row, tf)
+                for position, tf in self.postings.get(term, {}).items() if position in rows
+                for row in rows[position]
+            ]
+            if len(hits) == 0:
+                continue
+            hit_rows = np.array([row for row, _ in hits], dtype=np.int64)
+            tfs = np.array([tf for _, tf in hits], dtype=np.float64)
+            idf = math.log((n_docs - len(hits) + 0.5) / (len(hits) + 0.5) + 1)
+            term_scores[term] = (hit_rows, idf * tfs * (self.k1 + 1) / (tfs + norms[hit_rows]))
+
+        scores = np.zeros((len(queries), n_docs), dtype=np.float64)
+        for i, tokens in enumerate(query_tokens):
+            # repeated query terms count repeatedly, like a bag-of-words query
+            for term, count in Counter(tokens).items():
+                if term in term_scores:
+                    hit_rows, hit_scores = term_scores[term]
+                    scores[i, hit_rows] += count * hit_scores
+        return scores
+
+    def search_batch(self, queries: List[str], doc_ids: List[str], k: int) -> List[List[Tuple[int, float]]]:
+        """
+        Top k (index in doc_ids, score) of each query, documents without any query term
+        are not returned.
+        """
+        results = []
+        for scores in self.score_batch(queries, doc_ids):
+            candidates = np.flatnonzero(scores > 0)
+            order = candidates[np.argsort(-scores[candidates], kind="stable")][:k]
+            results.append([(int(row), float(scores[row])) for row in order])
+        return results
+
+    def search(self, query: str, doc_ids: List[str], k: int) -> List[Tuple[int, float]]:
+        return self.search_batch([query], doc_ids, k)[0]
+
+
+def get_bm25_index_file(path_manager: PathManager) -> str:
+    return os.path.join(
+        path_manager.root_path,
+        "BM25Index",
+        path_manager.version,
+        path_manager.project,
+        "index.pkl"
+    )
@@ -5,9 +5,10 @@ import shutil
 import sys
 from typing import List
 
-from langchain_community.retrievers import BM25Retriever
+import numpy as np
 from langchain_core.documents import Document
 
+from BM25.index import BM25Index, get_bm25_index_file
 from Evaluation.evaluate import evaluate_others
 from functions.d4j import check_out, get_failed_tests, get_properties, run_all_tests
 from functions.sbfl import parse_sbfl
@@ -91,15 +92,22 @@ def main():
         if documents == []:
             result_nodes = []
         else:
-            retriever = BM25Retriever.from_documents(documents, k=path_manager.retrieve_top_n)
+            bm25_index = BM25Index.load(get_bm25_index_file(path_manager))
+            doc_ids, n_added = bm25_index.add_documents([doc.page_content for doc in documents])
+            path_manager.logger.info(f"{n_added} of {len(documents)} methods added to the BM25 index")
+            if n_added > 0:
+                bm25_index.save()
             
             # ----------------------------------------
             #          Retrieve
             # ----------------------------------------
             
             path_manager.logger.info("[Retrieve] start...")
-            all_queries = " ".join(queries)
-            result_nodes = retriever._get_relevant_documents(all_queries, run_manager=None)
+            # BM25 is additive over query terms, so the summed scores of the queries
+            # rank like a single query made of all of them
+            scores = bm25_index.score_batch(queries, doc_ids).sum(axis=0)
+            order = np.argsort(-scores, kind="stable")[:path_manager.retrieve_top_n]
+            result_nodes = [documents[i] for i in order]
             with open(path_manager.retrieved_nodes_file, 'wb') as f:
                 pickle.dump(result_nodes, f)
 
@@ -263,9 +263,10 @@ def prepare_method_summarization_input(method_node, method_context_node):
         if method_context_node is None
         else method_context_node.text
     )
-    input_text = f"\nMethod Code:\n\n{method_node.text}\n"
+    # the module context is shared by the methods of a module, it goes first as a cacheable prompt prefix
+    input_text = f"\nModule Context:\n\n{context_text}\n"
     input_text += f"\nDeveloper Comment:\n\n{process_comment(method_node.metadata['comment'])}\n"
-    input_text += f"\nModule Context:\n\n{context_text}\n"
+    input_text += f"\nMethod Code:\n\n{method_node.text}\n"
     return input_text
 
 
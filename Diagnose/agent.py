@@ -1,13 +1,11 @@
 import json
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from http.client import responses
 from typing import Any, Dict, List
 
 from llama_index.core.llms import LLM
 from llama_index.core.schema import NodeWithScore
-from tenacity import retry, stop_after_attempt, wait_fixed
 
+from Diagnose.dedup import DEFAULT_SIMILARITY_THRESHOLD, cluster_test_cases
 from Diagnose.prompt import (
     DIAGNOSE_END_TEMPLATE,
     DIAGNOSE_TEMPLATE,
@@ -15,10 +13,15 @@ from Diagnose.prompt import (
     REQUEST_EXAMPLE,
 )
 from functions.my_types import TestCase, TestFailure
-from Retrieve.index import get_context_index
 from Storage.store import HybridStore
-from Utils.model import calculate_in_cost, calculate_out_cost, parse_llm_output
+from Utils.async_utils import asyncio_run, run_jobs_with_worker_limit
+from Utils.model import calculate_in_cost_batch, calculate_out_cost_batch
 from Utils.path_manager import PathManager
+from Utils.structured_output import (
+    DIAGNOSE_END_SCHEMA,
+    DIAGNOSE_SCHEMA,
+    achat_structured,
+)
 
 DEFAULT_MAX_WORKERS = 8
 
@@ -30,67 +33,126 @@ class DiagnoseAgent:
         self.logger = path_manager.logger
         self.dialogue_dir = os.path.join(path_manager.res_path, "diagnose")
         self.use_context = path_manager.config.use_context
+        self.max_workers = getattr(
+            path_manager.config.hyper, "diagnose_workers", DEFAULT_MAX_WORKERS
+        )
+        # diagnose only k representatives of the tests failing the same way
+        self.dedup = getattr(path_manager.config, "dedup_diagnosis", False)
+        self.dedup_similarity = getattr(
+            path_manager.config.hyper, "dedup_similarity", DEFAULT_SIMILARITY_THRESHOLD
+        )
+        self.dedup_samples = getattr(path_manager.config.hyper, "dedup_samples", 1)
+        self.json_mode = getattr(path_manager.config.models.reason, "json_mode", False)
         if self.use_context:
-            context_index = get_context_index(store)
-            self.context_retriever = context_index.as_retriever(
-                similarity_top_k=path_manager.retrieve_top_n
-            )
+            # context requests of all in-flight dialogs are merged into one query
+            self.context_retriever = store.get_retriever("context_node", similarity_top_k=1)
 
     def diagnose(self, test_failure: TestFailure) -> List[Dict[str, str]]:
         self.logger.info(f"Diagnosing faulty functionality...")
-        with ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS) as executor:
-            futures = []
-            for test_class in test_failure.test_classes:
-                for test_case in test_class.test_cases:
-                    future = executor.submit(
-                        self._diagnose_test_case, test_case
-                    )
-                    futures.append(future)
-
-            result = []
-            for future in as_completed(futures):
-                result.append(future.result())
-
-        faulty_func = [res["response"] for res in result]
+        test_cases = [
+            test_case
+            for test_class in test_failure.test_classes
+            for test_case in test_class.test_cases
+        ]
+        if self.dedup:
+            clusters = cluster_test_cases(test_cases, self.dedup_similarity)
+            self.logger.info(
+                f"{len(test_cases)} failing tests clustered into {len(clusters)} groups: "
+                f"{[len(cluster) for cluster in clusters]}"
+            )
+            todo_test_cases = [
+                test_case
+                for cluster in clusters
+                for test_case in cluster[: self.dedup_samples]
+            ]
+        else:
+            clusters = [[test_case] for test_case in test_cases]
+            todo_test_cases = test_cases
+        result = asyncio_run(self._adiagnose(todo_test_cases))
+
+        # fan the hypotheses of the diagnosed tests out to the rest of their clusters
+        response_dict = {
+            test_case.name: res["response"]
+            for test_case, res in zip(todo_test_cases, result)
+        }
+        faulty_func = []
+        for cluster in clusters:
+            samples = cluster[: self.dedup_samples] if self.dedup else cluster
+            for i, test_case in enumerate(cluster):
+                faulty_func.append(response_dict[samples[i % len(samples)].name])
         tokens = sum([res["tokens"] for res in result])
         cost = sum([res["cost"] for res in result])
         self.logger.info(
             f"Diagnose finished, total cost: {tokens} tokens, {cost} USD"
         )
+        n_cached = sum([res["cached"] for res in result])
+        self.path_manager.token_ledger.record(
+            "diagnose",
+            in_tokens=sum([res["in_tokens"] for res in result]),
+            out_tokens=sum([res["out_tokens"] for res in result]),
+            cost=cost,
+            requests=sum([res["rounds"] for res in result if not res["cached"]]),
+            cache_hits=n_cached,
+            cached_tokens=sum([res["cached_tokens"] for res in result]),
+        )
         return faulty_func
 
-    def calculate_cost(self, dialog: Dict[str, str]) -> Dict[str, str]:
-        in_costs = [calculate_in_cost(str(dialog[k]["user"])) for k in dialog]
-        out_costs = [calculate_out_cost(str(dialog[k]["llm"])) for k in dialog]
+    async def _adiagnose(self, test_cases: List[TestCase]) -> List[Dict[str, Any]]:
+        jobs = [self._adiagnose_test_case(test_case) for test_case in test_cases]
+        return await run_jobs_with_worker_limit(
+            jobs,
+            workers=self.max_workers,
+            desc="Diagnose",
+        )
+
+    def calculate_cost(self, dialog: Dict[str, str]) -> Dict[str, Any]:
+        in_costs = calculate_in_cost_batch([str(dialog[k]["user"]) for k in dialog])
+        out_costs = calculate_out_cost_batch([str(dialog[k]["llm"]) for k in dialog])
         in_tokens, in_money = zip(*in_costs)
         out_tokens, out_money = zip(*out_costs)
-        tokens = sum(in_tokens) + sum(out_tokens)
-        money = sum(in_money) + sum(out_money)
-        return tokens, money
-
-    def _diagnose_test_case(self, test_case: TestCase) -> Dict[str, str]:
+        return {
+            "tokens": sum(in_tokens) + sum(out_tokens),
+            "in_tokens": sum(in_tokens),
+            "out_tokens": sum(out_tokens),
+            "cost": sum(in_money) + sum(out_money),
+            "rounds": len(dialog),
+        }
+
+    async def _adiagnose_test_case(self, test_case: TestCase) -> Dict[str, Any]:
         max_rounds = self.path_manager.config.hyper.max_diagnose_rounds
 
         dialog_dir = os.path.join(self.dialogue_dir, test_case.name)
         os.makedirs(dialog_dir, exist_ok=True)
         if self.use_context:
             dialog_file = os.path.join(dialog_dir, "dialog.json")
+            checkpoint_file = os.path.join(dialog_dir, "checkpoint.json")
         else:
             dialog_file = os.path.join(dialog_dir, "dialog_NC.json")
+            checkpoint_file = os.path.join(dialog_dir, "checkpoint_NC.json")
 
         if os.path.exists(dialog_file):
             with open(dialog_file, "r") as f:
                 dialog = json.load(f)
-                tokens, money = self.calculate_cost(dialog)
                 return {
                     "response": dialog["end"]["llm"],
-                    "tokens": tokens,
-                    "cost": money,
+                    "cached": True,
+                    "cached_tokens": 0,
+                    **self.calculate_cost(dialog),
                 }
 
-        dialog = {}
-        cur_round = 0
-        component_details = {}
+        # resume the unfinished dialog from the last finished round
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file, "r") as f:
+                checkpoint = json.load(f)
+            dialog = checkpoint["dialog"]
+            cur_round = checkpoint["cur_round"]
+            component_details = checkpoint["component_details"]
+        else:
+            dialog = {}
+            cur_round = 0
+            component_details = {}
+        # prompt tokens the provider served from its prefix cache in this run
+        usage = {"cached_tokens": 0}
 
         while True:
             llm_input = {
@@ -102,24 +164,37 @@ class DiagnoseAgent:
 
             if cur_round < max_rounds - 1 and self.use_context:
                 messages = DIAGNOSE_TEMPLATE.format_messages(**llm_input)
+                schema = DIAGNOSE_SCHEMA
             else:
                 messages = DIAGNOSE_END_TEMPLATE.format_messages(**llm_input)
+                schema = DIAGNOSE_END_SCHEMA
 
-            response = self.llm.chat(messages)
-            result = parse_llm_output(response.message.content)
+            result = await achat_structured(
+                self.llm, messages, schema, json_mode=self.json_mode, usage=usage
+            )
 
             if "request" in result:
                 assert (
                     cur_round < max_rounds - 1
                 ), "LLM should not request more information in the last round"
-                context_node = self.get_context(result["request"])
+                context_node = await self.aget_context(result["request"])
                 if context_node.id_ not in component_details:
                     component_details[context_node.id_] = context_node.text
-                dialog[cur_round] = {
+                dialog[str(cur_round)] = {
                     "user": messages[0].content,
                     "llm": result,
                 }
                 cur_round += 1
+                with open(checkpoint_file, "w") as f:
+                    json.dump(
+                        {
+                            "dialog": dialog,
+                            "cur_round": cur_round,
+                            "component_details": component_details,
+                        },
+                        f,
+                        indent=4,
+                    )
             elif (
                 "context" in result
                 and "functionality" in result
@@ -128,11 +203,17 @@ class DiagnoseAgent:
                 dialog["end"] = {"user": messages[0].content, "llm": result}
                 with open(dialog_file, "w") as f:
                     json.dump(dialog, f, indent=4)
-                tokens, money = self.calculate_cost(dialog)
-                return {"response": result, "tokens": tokens, "cost": money}
+                if os.path.exists(checkpoint_file):
+                    os.remove(checkpoint_file)
+                return {
+                    "response": result,
+                    "cached": False,
+                    "cached_tokens": usage["cached_tokens"],
+                    **self.calculate_cost(dialog),
+                }
             else:
                 raise ValueError("Unexpected response format from LLM")
 
-    def get_context(self, request: str) -> NodeWithScore:
-        context_nodes = self.context_retriever.retrieve(request)
+    async def aget_context(self, request: str) -> NodeWithScore:
+        context_nodes = await self.context_retriever.aretrieve(request)
         return context_nodes[0]
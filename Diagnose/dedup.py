@@ -0,0 +1,94 @@
+import re
+from typing import Dict, List, Set, Tuple
+
+from functions.my_types import TestCase
+
+DEFAULT_TOP_FRAMES = 5
+DEFAULT_SIMILARITY_THRESHOLD = 0.5
+# frames of the test runner and reflection, identical for every failing test
+IGNORED_FRAME_PREFIXES = (
+    "junit.",
+    "org.junit.",
+    "sun.reflect.",
+    "jdk.internal.reflect.",
+    "java.lang.reflect.",
+)
+
+
+def get_stack_trace_signature(test_case: TestCase, top_frames: int = DEFAULT_TOP_FRAMES) -> Tuple[str, ...]:
+    """
+    Normalize the stack trace of a failing test into the exception type and its top frames, e.g.:
+
+        --- com.google.javascript.jscomp.TypeCheckTest::testBadInterfaceExtendsNonExistentInterfaces
+        java.lang.NullPointerException
+            at com.google.javascript.jscomp.TypeCheck.checkInterfaceConflictProperties(TypeCheck.java:1574)
+            at com.google.javascript.jscomp.TypeCheck.visitFunction(TypeCheck.java:1664)
+            ...
+
+        ==>
+
+        ("java.lang.NullPointerException",
+         "com.google.javascript.jscomp.TypeCheck.checkInterfaceConflictProperties(TypeCheck.java:1574)",
+         "com.google.javascript.jscomp.TypeCheck.visitFunction(TypeCheck.java:1664)", ...)
+
+    The exception message and the frame of the test method itself are dropped since they
+    differ between tests failing for the same reason.
+    """
+    lines = [line.strip() for line in (test_case.stack_trace or "").split("\n")]
+    lines = [line for line in lines if line and not line.startswith("---")]
+    if len(lines) == 0:
+        return ()
+    exception = lines[0].split(":")[0]
+    test_frame = f"{test_case.test_class_name}.{test_case.test_method_name}("
+    frames = []
+    for line in lines[1:]:
+        if not line.startswith("at "):
+            continue
+        frame = line[3:]
+        if frame.startswith(IGNORED_FRAME_PREFIXES) or frame.startswith(test_frame):
+            continue
+        frames.append(frame)
+        if len(frames) == top_frames:
+            break
+    return (exception, *frames)
+
+
+def get_code_tokens(test_case: TestCase) -> Set[str]:
+    if test_case.test_method is None:
+        return set()
+    # the test method name is unique to each test and says nothing about the failure
+    return set(re.findall(r"\w+", test_case.test_method.code)) - {test_case.test_method_name}
+
+
+def get_code_similarity(tokens_a: Set[str], tokens_b: Set[str]) -> float:
+    """Jaccard similarity of the identifier sets of two test methods."""
+    if not tokens_a and not tokens_b:
+        return 1.0
+    return len(tokens_a & tokens_b) / len(tokens_a | tokens_b)
+
+
+def cluster_test_cases(
+    test_cases: List[TestCase],
+    similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+    top_frames: int = DEFAULT_TOP_FRAMES,
+) -> List[List[TestCase]]:
+    """
+    Cluster failing tests which share the stack trace signature and have similar test code.
+    The first test of each cluster is its representative, the order of tests is kept.
+    """
+    groups: Dict[Tuple[str, ...], List[List[TestCase]]] = {}
+    clusters: List[List[TestCase]] = []
+    tokens = {test_case.name: get_code_tokens(test_case) for test_case in test_cases}
+    for test_case in test_cases:
+        signature = get_stack_trace_signature(test_case, top_frames)
+        same_signature_clusters = groups.setdefault(signature, [])
+        for cluster in same_signature_clusters:
+            similarity = get_code_similarity(tokens[cluster[0].name], tokens[test_case.name])
+            if similarity >= similarity_threshold:
+                cluster.append(test_case)
+                break
+        else:
+            cluster = [test_case]
+            same_signature_clusters.append(cluster)
+            clusters.append(cluster)
+    return clusters
@@ -1,11 +1,12 @@
 from llama_index.core import ChatPromptTemplate
 
-DIAGNOSE_PROMPT = """
+# All the rounds of a dialog share the instructions and the test failure information, and
+# the component details only grow by appending, so each round reuses the prompt of the
+# previous one as a prefix the provider can cache. The goal, response format and guidelines
+# of a round follow the component details.
+DIAGNOSE_INSTRUCTIONS = """
 You are an AI-powered Software Diagnostics Specialist specializing in software test failure analysis and fault localization.
 
-# Goal
-Your task is to analyze provided test failure information and either identify the potentially faulty functionality or request additional information as needed.
-
 You will be provided with the following information:
 
 1. Test Case Code
@@ -13,6 +14,29 @@ You will be provided with the following information:
 3. Test Output
 4. Component Details (if available)
 
+# Provided Test Failure Information
+
+Test Case Code:
+
+{test_code}
+
+Error Stack Trace:
+
+{stack_trace}
+
+Test Output:
+
+{test_output}
+
+Component Details:
+
+{component_details}
+"""
+
+DIAGNOSE_PROMPT = DIAGNOSE_INSTRUCTIONS + """
+# Goal
+Your task is to analyze provided test failure information and either identify the potentially faulty functionality or request additional information as needed.
+
 # Analysis Process
 1. Analyze the provided information, including test case code, error stack trace, test output, and component details (if available).
 2. Identify potential interactions between components that might contribute to the failure.
@@ -58,41 +82,14 @@ Example:
 4. When suggesting a faulty functionality, provide enough detail to guide developers to the relevant code section.
 5. Consider all provided information holistically, including how different components might interact to produce the observed failure.
 
-# Provided Test Failure Information
-
-Test Case Code:
-
-{test_code}
-
-Error Stack Trace:
-
-{stack_trace}
-
-Test Output:
-
-{test_output}
-
-Component Details:
-
-{component_details}
-
 Now, based on the provided information, please respond with a valid JSON object without any other content:
 """
 
 
-DIAGNOSE_END_PROMPT = """
-You are an AI-powered Software Diagnostics Specialist specializing in software test failure analysis and fault localization.
-
+DIAGNOSE_END_PROMPT = DIAGNOSE_INSTRUCTIONS + """
 # Goal
 Your task is to analyze provided test failure information and identify the potentially faulty functionality.
 
-You will be provided with the following information:
-
-1. Test Case Code
-2. Error Stack Trace
-3. Test Output
-4. Component Details (if available)
-
 # Analysis Process
 1. Analyze the provided information, including test case code, error stack trace, test output, and component details (if available).
 2. Identify potential interactions between components that might contribute to the failure.
@@ -120,24 +117,6 @@ Example:
 2. When suggesting a faulty functionality, provide enough detail to guide developers to the relevant code section.
 3. Consider all provided information holistically, including how different components might interact to produce the observed failure.
 
-# Provided Test Failure Information
-
-Test Case Code:
-
-{test_code}
-
-Error Stack Trace:
-
-{stack_trace}
-
-Test Output:
-
-{test_output}
-
-Component Details:
-
-{component_details}
-
 Now, based on the provided information, please respond with a valid JSON object without any other content:
 """
 
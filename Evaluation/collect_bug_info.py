@@ -3,7 +3,7 @@ import os
 import shutil
 from argparse import Namespace
 
-from functions.d4j import check_out, get_failed_tests, get_properties, run_all_tests
+from functions.d4j import prepare_bug
 from functions.my_types import TestFailure
 from functions.sbfl import get_all_sbfl_res
 from projects import ALL_BUGS
@@ -48,21 +48,9 @@ def run_one_bug(config: str, version: str, project: str, bugID: int, clear: bool
         path_manager.logger.info(f"d4j{args.version}-{args.project}-{args.bugID} already finished, skip!")
         return
 
-    # check out the d4j project
-    path_manager.logger.info("[checkout] start...")
-    check_out(path_manager)
-    
-    # get bug specific information
-    path_manager.logger.info("[get bug properties] start...")
-    get_properties(path_manager)
-    
-    # get test failure object
-    path_manager.logger.info("[get test failure object] start...")
-    test_failure_obj = get_failed_tests(path_manager)
-
-    # run all tests
-    path_manager.logger.info("[run all tests] start...")
-    run_all_tests(path_manager, test_failure_obj)
+    # check out the d4j project, get bug properties and run all tests
+    path_manager.logger.info("[prepare bug] start...")
+    test_failure_obj = prepare_bug(path_manager)
 
     # ----------------------------------------
     #          SBFL results
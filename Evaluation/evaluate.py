@@ -1,8 +1,9 @@
+import hashlib
 import json
 import os
 import re
 import sys
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from pathlib import Path
 from pprint import pprint
 from typing import List
@@ -11,35 +12,50 @@ from langchain_core.documents import Document
 from llama_index.core.schema import NodeWithScore
 
 sys.path.append(Path(__file__).resolve().parents[1].as_posix())
+from Evaluation.results_db import (
+    DEFAULT_INGEST_WORKERS,
+    RESULTS_DB_FNAME,
+    ingest_results,
+    query_bug_results,
+)
 from functions.my_types import TestFailure
 from projects import ALL_BUGS
 from Utils.path_manager import PathManager
 
 
+def get_code_hash(code: str) -> str:
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+
+def get_buggy_method_hashes(test_failure_obj: TestFailure) -> Counter:
+    """Hashes of the buggy method bodies, counted since two buggy methods may share a body."""
+    return Counter(get_code_hash(buggy_method.code) for buggy_method in test_failure_obj.buggy_methods)
+
+
+def match_ranks(texts: List[str], buggy_hashes: Counter) -> List[int]:
+    """1-based ranks of the texts that are the body of a buggy method."""
+    ranks = []
+    for i, text in enumerate(texts):
+        ranks.extend([i + 1] * buggy_hashes.get(get_code_hash(text), 0))
+    return ranks
+
+
 def evaluate(
     path_manager: PathManager,
     nodes: List[NodeWithScore],
     reranked_nodes_list: List[List[NodeWithScore]],
     test_failure_obj: TestFailure
 ):
+    buggy_hashes = get_buggy_method_hashes(test_failure_obj)
     results = {"matches":[], "query_matches":[], "methods":[], "reasons":[]}
-    for i, node in enumerate(nodes):
-        localized_method_text = node.text
-        results["methods"].append(localized_method_text)
+    for node in nodes:
+        results["methods"].append(node.text)
         if "llm_reason" in node.metadata:
             results["reasons"].append(node.metadata["llm_reason"])
-        for buggy_method in test_failure_obj.buggy_methods:
-            if buggy_method.code == localized_method_text:
-                results["matches"].append(i + 1)
+    results["matches"] = match_ranks(results["methods"], buggy_hashes)
     
     for reranked_nodes in reranked_nodes_list:
-        query_matches = []
-        for i, node in enumerate(reranked_nodes):
-            localized_method_text = node.text
-            for buggy_method in test_failure_obj.buggy_methods:
-                if buggy_method.code == localized_method_text:
-                    query_matches.append(i + 1)
-        results["query_matches"].append(query_matches)
+        results["query_matches"].append(match_ranks([node.text for node in reranked_nodes], buggy_hashes))
 
     with open(path_manager.res_file, 'w') as f:
         json.dump(results, f, indent=4)
@@ -50,20 +66,24 @@ def evaluate_others(
     docs: List[Document],
     test_failure_obj: TestFailure
 ):
-    
-    results = {"matches":[]}
-
-    for i, doc in enumerate(docs):
-        localized_method_text = doc.page_content
-        for buggy_method in test_failure_obj.buggy_methods:
-            if buggy_method.code == localized_method_text:
-                results["matches"].append(i + 1)
+    buggy_hashes = get_buggy_method_hashes(test_failure_obj)
+    results = {"matches": match_ranks([doc.page_content for doc in docs], buggy_hashes)}
 
     with open(path_manager.res_file, 'w') as f:
         json.dump(results, f, indent=4)
 
 
-def evaluate_all(res_path: str, if_size: bool = False):
+def evaluate_all(res_path: str, if_size: bool = False, workers: int = DEFAULT_INGEST_WORKERS):
+    """
+    Print Top-N, MFR, MAR and MRR of a config, the results are ingested into the results
+    store next to the config directory first (only the bugs changed since the last call).
+    """
+    output_path, config_name = os.path.split(os.path.normpath(res_path))
+    db_file = os.path.join(output_path, RESULTS_DB_FNAME)
+    n_ingested = ingest_results(db_file, output_path, [config_name], workers=workers)
+    print(f"{n_ingested} results of {config_name} ingested into {db_file}")
+    bug_results = query_bug_results(db_file, config_name)
+
     all_bugs = ALL_BUGS
     top_n = OrderedDict()
     mfr = OrderedDict()
@@ -72,66 +92,43 @@ def evaluate_all(res_path: str, if_size: bool = False):
     
     top_1_bugs = []
     top_5_bugs = []
+    # bugs without a result are left out of the metrics, report how many
+    missing = OrderedDict()
     
     mfr_all, mar_all, mrr_all = [], [], []
     
     for version in all_bugs:
         for proj in all_bugs[version]:
-            if proj == "Spoon":
-                print(1)
             if proj not in top_n:
                 top_n[proj] = {"top_1": 0, "top_3": 0, "top_5": 0, "top_10": 0}
             mfr_tmp = []
             mar_tmp = []
             mrr_tmp = []
+            missing.setdefault(proj, 0)
             
             for bug_id in all_bugs[version][proj][0]:
                 if bug_id in all_bugs[version][proj][1]:
                     continue
-                res_file = os.path.join(
-                    res_path,
-                    version,
-                    proj,
-                    f"{proj}-{bug_id}",
-                    "result.json"
-                )
-                with open(res_file, 'r') as f:
-                    results = json.load(f)
-                    matched_indexes = results["matches"]
-                    matched_indexes = [m for m in matched_indexes if m <= 50]
-                    if matched_indexes == []:
-                        matched_indexes = [51]
-                    try:
-                        query_matches = results["query_matches"]
-                        query_matches = [[m for m in q if m <= 50] for q in query_matches]
-                    except KeyError:
-                        query_matches = [[]]
-
-                if matched_indexes:
-                    if matched_indexes[0] == 1:
-                        top_n[proj]["top_1"] += 1
-                        top_1_bugs.append(f"{proj}-{bug_id}")
-                    if matched_indexes[0] <= 3:
-                        top_n[proj]["top_3"] += 1
-                    if matched_indexes[0] <= 5:
-                        top_n[proj]["top_5"] += 1
-                        top_5_bugs.append(f"{proj}-{bug_id}")
-                    if matched_indexes[0] <= 10:
-                        top_n[proj]["top_10"] += 1
-                    mfr_tmp.append(matched_indexes[0])
-                    mar_tmp.append(sum(matched_indexes) / len(matched_indexes))
-                else:
-                    print(f"Warning: no matched indexes found for {version}-{proj}-{bug_id}")
+                if (version, proj, bug_id) not in bug_results:
+                    missing[proj] += 1
+                    continue
+                bug_result = bug_results[(version, proj, bug_id)]
+                first_rank = bug_result["first_rank"]
+                if first_rank == 1:
+                    top_n[proj]["top_1"] += 1
+                    top_1_bugs.append(f"{proj}-{bug_id}")
+                if first_rank <= 3:
+                    top_n[proj]["top_3"] += 1
+                if first_rank <= 5:
+                    top_n[proj]["top_5"] += 1
+                    top_5_bugs.append(f"{proj}-{bug_id}")
+                if first_rank <= 10:
+                    top_n[proj]["top_10"] += 1
+                mfr_tmp.append(first_rank)
+                mar_tmp.append(bug_result["avg_rank"])
                 
-                if query_matches:
-                    query_tmp = []
-                    for query_match in query_matches:
-                        if len(query_match) == 0:
-                            query_tmp.append(0)
-                        else:
-                            reciprocal = [1 / i for i in query_match]
-                            query_tmp.append(sum(reciprocal) / len(reciprocal))
-                    mrr_tmp.append(sum(query_tmp) / len(query_tmp))
+                if bug_result["mrr"] is not None:
+                    mrr_tmp.append(bug_result["mrr"])
                 else:
                     print(f"Warning: no query matches found for {version}-{proj}-{bug_id}")
             
@@ -169,6 +166,8 @@ def evaluate_all(res_path: str, if_size: bool = False):
     pprint(mar)
     print("MRR:")
     pprint(mrr)
+    print("Missing:")
+    pprint(missing)
     
     print(f"Total Top 1: {sum([v['top_1'] for v in top_n.values()])}")
     print(f"Total Top 5: {sum([v['top_5'] for v in top_n.values()])}")
@@ -177,6 +176,7 @@ def evaluate_all(res_path: str, if_size: bool = False):
     print(f"Total MFR: {sum(mfr_all) / len(mfr_all)}")
     print(f"Total MAR: {sum(mar_all) / len(mar_all)}")
     print(f"Total MRR: {sum(mrr_all) / len(mrr_all)}")
+    print(f"Total Missing: {sum(missing.values())} (not counted in the metrics above)")
 
 
 def evaluate_size(config_name: str, autofl_file: str, agentfl_file: str, cosfl_file: str):
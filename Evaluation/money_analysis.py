@@ -1,5 +1,27 @@
 import os
 import re
+import sys
+from pathlib import Path
+
+sys.path.append(Path(__file__).resolve().parents[1].as_posix())
+from Utils.telemetry import aggregate_spans, read_spans
+
+TELEMETRY_FNAME = "telemetry.jsonl"
+STAGES = [
+    "summarize_context",
+    "summarize_methods",
+    "embed",
+    "diagnose",
+    "rerank",
+]
+# stages recoverable from the logs of runs without telemetry
+LEGACY_STAGES = {
+    'context_cost': 'summarize_context',
+    'description_cost': 'summarize_methods',
+    'embedding_cost': 'embed',
+    'diagnose_cost': 'diagnose',
+    'rerank_cost': 'rerank',
+}
 
 
 def extract_cost(line, pattern):
@@ -36,17 +58,20 @@ def analyze_cost(log_content):
                 
     return costs
 
-if __name__ == '__main__':
-    root_dir = "/home/qyh/projects/GarFL/DebugResult/mimic"
-    all_costs = {
-        'context_cost': [],
-        'description_cost': [],
-        'embedding_cost': [],
-        'diagnose_cost': [],
-        'rerank_cost': []
-    }
-    
+def collect_money_costs(root_dir):
+    """Collect the money cost of each stage for all bugs under root_dir.
+
+    The spans in telemetry.jsonl are used when available, otherwise the cost log lines.
+    """
+    all_costs = {stage: [] for stage in STAGES}
     for dirpath, dirnames, filenames in os.walk(root_dir):
+        if TELEMETRY_FNAME in filenames:
+            spans = read_spans(os.path.join(dirpath, TELEMETRY_FNAME))
+            for stage, cost in aggregate_spans(spans, "cost").items():
+                if stage in all_costs and cost > 0:
+                    all_costs[stage].append(cost)
+            continue
+
         for filename in filenames:
             if filename.endswith('.log'):
                 filepath = os.path.join(dirpath, filename)
@@ -55,12 +80,18 @@ if __name__ == '__main__':
                     if not log_content:
                         continue
                     costs = analyze_cost(log_content)
-                    for stage, cost in costs.items():
+                    for legacy_stage, cost in costs.items():
                         if cost > 0:
-                            all_costs[stage].append(cost)
+                            all_costs[LEGACY_STAGES[legacy_stage]].append(cost)
+    return all_costs
+
+if __name__ == '__main__':
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    root_dir = os.path.join(root, "DebugResult", "mimic")
+    all_costs = collect_money_costs(root_dir)
     
     with open("Evaluation/money_cost.csv", "w") as f:
-        f.write("context_cost,description_cost,embedding_cost,diagnose_cost,rerank_cost\n")
+        f.write(",".join(f"{stage}_cost" for stage in all_costs) + "\n")
         for i in range(max(map(len, all_costs.values()))):
             f.write(",".join(str(all_costs[stage][i]) if i < len(all_costs[stage]) else "" for stage in all_costs) + "\n")
     
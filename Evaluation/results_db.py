@@ -0,0 +1,308 @@
+import json
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.append(Path(__file__).resolve().parents[1].as_posix())
+from projects import ALL_BUGS
+from Utils.telemetry import aggregate_spans, read_spans
+
+RESULTS_DB_FNAME = "results.db"
+RESULT_FNAME = "result.json"
+TELEMETRY_FNAME = "telemetry.jsonl"
+# ranks beyond the cutoff count as not found, and a bug without a match gets cutoff + 1
+DEFAULT_MAX_RANK = 50
+DEFAULT_INGEST_WORKERS = os.cpu_count() or 1
+STAGE_FIELDS = ["duration", "cost", "in_tokens", "out_tokens", "requests", "cache_hits", "cached_tokens"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    config TEXT NOT NULL,
+    version TEXT NOT NULL,
+    project TEXT NOT NULL,
+    bug_id INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    matches TEXT NOT NULL,
+    query_matches TEXT,
+    first_rank INTEGER NOT NULL,
+    avg_rank REAL NOT NULL,
+    mrr REAL,
+    PRIMARY KEY (config, version, project, bug_id)
+);
+CREATE TABLE IF NOT EXISTS stages (
+    config TEXT NOT NULL,
+    version TEXT NOT NULL,
+    project TEXT NOT NULL,
+    bug_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    duration REAL,
+    cost REAL,
+    in_tokens INTEGER,
+    out_tokens INTEGER,
+    requests INTEGER,
+    cache_hits INTEGER,
+    cached_tokens INTEGER,
+    PRIMARY KEY (config, version, project, bug_id, stage)
+);
+"""
+
+
+def get_bug_dir(output_path: str, config: str, version: str, project: str, bug_id: int) -> str:
+    return os.path.join(output_path, config, version, project, f"{project}-{bug_id}")
+
+
+def iter_bugs():
+    """(version, project, bug_id) of every bug of ALL_BUGS that is not excluded."""
+    for version in ALL_BUGS:
+        for project in ALL_BUGS[version]:
+            bug_ids, excluded_ids = ALL_BUGS[version][project][:2]
+            for bug_id in bug_ids:
+                if bug_id not in excluded_ids:
+                    yield version, project, bug_id
+
+
+def get_mtime(bug_dir: str) -> float:
+    """Latest modification time of the files ingested from a bug directory."""
+    mtimes = [
+        os.path.getmtime(os.path.join(bug_dir, fname))
+        for fname in (RESULT_FNAME, TELEMETRY_FNAME)
+        if os.path.exists(os.path.join(bug_dir, fname))
+    ]
+    return max(mtimes)
+
+
+def compute_metrics(matches: List[int], query_matches: Optional[List[List[int]]], max_rank: int = DEFAULT_MAX_RANK):
+    """
+    First rank, average rank and mean reciprocal rank of the queries of one bug,
+    mrr is None if the bug has no query results.
+    """
+    matches = [m for m in matches if m <= max_rank]
+    if len(matches) == 0:
+        matches = [max_rank + 1]
+    first_rank = matches[0]
+    avg_rank = sum(matches) / len(matches)
+    if query_matches is None:
+        query_matches = [[]]
+    mrr = None
+    if query_matches:
+        query_scores = []
+        for query_match in query_matches:
+            query_match = [m for m in query_match if m <= max_rank]
+            if len(query_match) == 0:
+                query_scores.append(0)
+            else:
+                query_scores.append(sum(1 / m for m in query_match) / len(query_match))
+        mrr = sum(query_scores) / len(query_scores)
+    return first_rank, avg_rank, mrr
+
+
+def read_bug_result(bug_key: Tuple[str, str, str, int], bug_dir: str, max_rank: int = DEFAULT_MAX_RANK) -> Dict[str, Any]:
+    """Parse the result and telemetry files of one bug into the rows of the results store."""
+    with open(os.path.join(bug_dir, RESULT_FNAME), "r") as f:
+        results = json.load(f)
+    matches = results["matches"]
+    query_matches = results.get("query_matches", None)
+    first_rank, avg_rank, mrr = compute_metrics(matches, query_matches, max_rank)
+    stages = {}
+    telemetry_file = os.path.join(bug_dir, TELEMETRY_FNAME)
+    if os.path.exists(telemetry_file):
+        spans = read_spans(telemetry_file)
+        totals = {field: aggregate_spans(spans, field) for field in STAGE_FIELDS}
+        for stage in totals["duration"]:
+            stages[stage] = [totals[field].get(stage, 0) for field in STAGE_FIELDS]
+    return {
+        "key": bug_key,
+        "mtime": get_mtime(bug_dir),
+        "result": [
+            json.dumps(matches),
+            json.dumps(query_matches) if query_matches is not None else None,
+            first_rank,
+            avg_rank,
+            mrr,
+        ],
+        "stages": stages,
+    }
+
+
+def connect(db_file: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_file)
+    conn.executescript(SCHEMA)
+    # stores created before the provider-cached prompt tokens were recorded
+    stage_columns = [row[1] for row in conn.execute("PRAGMA table_info(stages)")]
+    if "cached_tokens" not in stage_columns:
+        conn.execute("ALTER TABLE stages ADD COLUMN cached_tokens INTEGER")
+    return conn
+
+
+def ingest_results(
+    db_file: str,
+    output_path: str,
+    configs: List[str],
+    workers: int = DEFAULT_INGEST_WORKERS,
+    max_rank: int = DEFAULT_MAX_RANK,
+) -> int:
+    """
+    Add the results of the bugs in ALL_BUGS under output_path/<config> to the results store.
+    Only bugs whose files changed since the last ingestion are parsed, in parallel, and the
+    rows of the configs whose result.json no longer exists are deleted.
+    Returns the number of bugs ingested.
+    """
+    conn = connect(db_file)
+    try:
+        ingested = {
+            (config, version, project, bug_id): mtime
+            for config, version, project, bug_id, mtime in conn.execute(
+                "SELECT config, version, project, bug_id, mtime FROM results"
+            )
+        }
+        todo = []
+        missing = []
+        for config in configs:
+            for version, project, bug_id in iter_bugs():
+                bug_dir = get_bug_dir(output_path, config, version, project, bug_id)
+                if not os.path.exists(os.path.join(bug_dir, RESULT_FNAME)):
+                    missing.append(f"{config}/{version}-{project}-{bug_id}")
+                    continue
+                key = (config, version, project, bug_id)
+                if ingested.get(key) != get_mtime(bug_dir):
+                    todo.append((key, bug_dir))
+        if missing:
+            print(f"Warning: no result found for {len(missing)} bugs, e.g. {missing[:5]}")
+
+        # drop the rows of the results deleted since they were ingested
+        stale = [
+            key for key in ingested
+            if key[0] in configs and not os.path.exists(os.path.join(get_bug_dir(output_path, *key), RESULT_FNAME))
+        ]
+        if stale:
+            print(f"Removing {len(stale)} results without a {RESULT_FNAME} from the results store")
+            with conn:
+                for table in ("results", "stages"):
+                    conn.executemany(
+                        f"DELETE FROM {table} WHERE config = ? AND version = ? AND project = ? AND bug_id = ?",
+                        stale,
+                    )
+        if len(todo) == 0:
+            return 0
+
+        with ProcessPoolExecutor(max_workers=max(1, min(workers, len(todo)))) as executor:
+            rows = list(executor.map(
+                read_bug_result,
+                [key for key, _ in todo],
+                [bug_dir for _, bug_dir in todo],
+                [max_rank] * len(todo),
+            ))
+        with conn:
+            for row in rows:
+                conn.execute(
+                    "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (*row["key"], row["mtime"], *row["result"]),
+                )
+                conn.execute(
+                    "DELETE FROM stages WHERE config = ? AND version = ? AND project = ? AND bug_id = ?",
+                    row["key"],
+                )
+                conn.executemany(
+                    "INSERT INTO stages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(*row["key"], stage, *values) for stage, values in row["stages"].items()],
+                )
+        return len(rows)
+    finally:
+        conn.close()
+
+
+def query_bug_results(db_file: str, config: str) -> Dict[Tuple[str, str, int], Dict[str, Any]]:
+    """Ranks of each bug of a config, {(version, project, bug_id): {first_rank, avg_rank, mrr}}."""
+    conn = connect(db_file)
+    try:
+        return {
+            (version, project, bug_id): {"first_rank": first_rank, "avg_rank": avg_rank, "mrr": mrr}
+            for version, project, bug_id, first_rank, avg_rank, mrr in conn.execute(
+                "SELECT version, project, bug_id, first_rank, avg_rank, mrr FROM results WHERE config = ?",
+                (config,),
+            )
+        }
+    finally:
+        conn.close()
+
+
+def query_metrics(db_file: str, configs: List[str], by_project: bool = False) -> List[Dict[str, Any]]:
+    """
+    Top-N, MFR, MAR and MRR of each config (and project), e.g.:
+
+        [{"config": "default", "n_bugs": 473, "n_missing": 2, "top_1": 124, "top_3": 201, "top_5": 238,
+          "top_10": 280, "mfr": 9.1, "mar": 10.3, "mrr": 0.21, "cost": 0.08, "duration": 412.5}, ...]
+
+    n_missing counts the bugs of ALL_BUGS without a result, they are left out of the metrics.
+    cost and duration are the averages over the bugs with telemetry.
+    """
+    group_columns = "r.config, r.project" if by_project else "r.config"
+    placeholders = ", ".join("?" * len(configs))
+    sql = f"""
+        SELECT {group_columns},
+               COUNT(*) AS n_bugs,
+               SUM(r.first_rank <= 1) AS top_1,
+               SUM(r.first_rank <= 3) AS top_3,
+               SUM(r.first_rank <= 5) AS top_5,
+               SUM(r.first_rank <= 10) AS top_10,
+               AVG(r.first_rank) AS mfr,
+               AVG(r.avg_rank) AS mar,
+               AVG(r.mrr) AS mrr,
+               AVG(s.cost) AS cost,
+               AVG(s.duration) AS duration
+        FROM results AS r
+        LEFT JOIN (
+            SELECT config, version, project, bug_id, SUM(cost) AS cost, SUM(duration) AS duration
+            FROM stages
+            GROUP BY config, version, project, bug_id
+        ) AS s
+        ON r.config = s.config AND r.version = s.version AND r.project = s.project AND r.bug_id = s.bug_id
+        WHERE r.config IN ({placeholders})
+        GROUP BY {group_columns}
+        ORDER BY {group_columns}
+    """
+    conn = connect(db_file)
+    try:
+        cursor = conn.execute(sql, configs)
+        columns = [column[0] for column in cursor.description]
+        metrics = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+    bug_results = {config: query_bug_results(db_file, config) for config in configs}
+    for row in metrics:
+        row["n_missing"] = sum(
+            1 for version, project, bug_id in iter_bugs()
+            if (version, project, bug_id) not in bug_results[row["config"]]
+            and (not by_project or project == row["project"])
+        )
+    return metrics
+
+
+def query_stage_costs(db_file: str, configs: List[str]) -> List[Dict[str, Any]]:
+    """
+    Average time, cost and tokens of each stage per config, cached_token_rate is the share
+    of the prompt tokens served from the provider's prefix cache.
+    """
+    placeholders = ", ".join("?" * len(configs))
+    sql = f"""
+        SELECT config, stage, COUNT(*) AS n_bugs,
+               AVG(duration) AS duration, AVG(cost) AS cost,
+               AVG(in_tokens) AS in_tokens, AVG(out_tokens) AS out_tokens,
+               SUM(cache_hits) * 1.0 / NULLIF(SUM(requests) + SUM(cache_hits), 0) AS cache_hit_rate,
+               AVG(cached_tokens) AS cached_tokens,
+               SUM(cached_tokens) * 1.0 / NULLIF(SUM(in_tokens), 0) AS cached_token_rate
+        FROM stages
+        WHERE config IN ({placeholders})
+        GROUP BY config, stage
+        ORDER BY config, stage
+    """
+    conn = connect(db_file)
+    try:
+        cursor = conn.execute(sql, configs)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        conn.close()
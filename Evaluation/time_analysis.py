@@ -1,6 +1,35 @@
 import os
 import re
+import sys
 from datetime import datetime
+from pathlib import Path
+
+sys.path.append(Path(__file__).resolve().parents[1].as_posix())
+from Utils.telemetry import aggregate_spans, read_spans
+
+TELEMETRY_FNAME = "telemetry.jsonl"
+STAGES = [
+    "checkout",
+    "properties",
+    "tests",
+    "parse",
+    "bind",
+    "cluster",
+    "summarize_context",
+    "summarize_methods",
+    "embed",
+    "diagnose",
+    "retrieve",
+    "rerank",
+]
+# stages recoverable from the logs of runs without telemetry
+LEGACY_STAGES = {
+    'context_time': 'summarize_context',
+    'node_time': 'summarize_methods',
+    'embedding_time': 'embed',
+    'diagnose_time': 'diagnose',
+    'retrieval_time': 'retrieve',
+}
 
 
 def parse_time(line):
@@ -52,17 +81,21 @@ def analyze_cost(log_content):
 
     return results
 
-if __name__ == '__main__':
-    root_dir = "/home/qyh/projects/GarFL/DebugResult/default"
-    all_res = {
-        'context_time': [],
-        'node_time': [],
-        'embedding_time': [],
-        'diagnose_time': [],
-        'retrieval_time': []
-    }
-    
+def collect_time_costs(root_dir):
+    """Collect the time cost of each stage for all bugs under root_dir.
+
+    The spans in telemetry.jsonl are used when available, otherwise the
+    (second-resolution) timestamps of the log lines.
+    """
+    all_res = {stage: [] for stage in STAGES}
     for dirpath, dirnames, filenames in os.walk(root_dir):
+        if TELEMETRY_FNAME in filenames:
+            spans = read_spans(os.path.join(dirpath, TELEMETRY_FNAME))
+            for stage, time in aggregate_spans(spans, "duration").items():
+                if stage in all_res:
+                    all_res[stage].append(time)
+            continue
+
         for filename in filenames:
             if filename.endswith('.log'):
                 filepath = os.path.join(dirpath, filename)
@@ -71,24 +104,28 @@ if __name__ == '__main__':
                     if not log_content:
                         continue
                     time_costs = analyze_cost(log_content)
-                    for stage, time in time_costs.items():
+                    for legacy_stage, time in time_costs.items():
                         if time > 180:
                             continue
                         if time > 0:
-                            all_res[stage].append(time)
-    
+                            all_res[LEGACY_STAGES[legacy_stage]].append(time)
+    return all_res
+
+if __name__ == '__main__':
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    root_dir = os.path.join(root, "DebugResult", "default")
+    all_res = collect_time_costs(root_dir)
+    stages = [stage for stage in STAGES if all_res[stage]]
     
     with open("Evaluation/time_cost.csv", "w") as f:
-        f.write("context_time,node_time,embedding_time,diagnose_time,retrieval_time\n")
-        for i in range(max(len(v) for v in all_res.values())):
-            row = [all_res[stage][i] if i < len(all_res[stage]) else '' for stage in all_res]
+        f.write(",".join(f"{stage}_time" for stage in stages) + "\n")
+        for i in range(max([len(all_res[stage]) for stage in stages], default=0)):
+            row = [all_res[stage][i] if i < len(all_res[stage]) else '' for stage in stages]
             f.write(','.join(map(str, row)) + '\n')
     
     
     print("Time costs analysis (in seconds):")
-    for stage in all_res:
+    for stage in stages:
         times = all_res[stage]
-        if not times:
-            continue
         avg_time = sum(times) / len(times)
         print(f"{stage}: {avg_time:.2f} (avg), {min(times):.2f} (min), {max(times):.2f} (max)")
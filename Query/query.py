@@ -1,18 +1,11 @@
-import asyncio
 import json
 import os
 import re
 import sys
-import time
-from multiprocessing import pool
 from pathlib import Path
-from time import sleep
-from typing import Coroutine, List
+from typing import List
 
-from aiolimiter import AsyncLimiter
-from llama_index.core.async_utils import DEFAULT_NUM_WORKERS, asyncio_run
-from tenacity import retry, stop_after_attempt, wait_fixed
-from tqdm.asyncio import tqdm_asyncio
+from tenacity import retry, stop_after_attempt
 
 sys.path.append(Path(__file__).resolve().parents[1].as_posix())
 from functions.my_types import TestCase, TestFailure
@@ -21,20 +14,23 @@ from Query.prompt import (
     query_merge_template,
     single_test_query_template,
 )
+from Utils.async_utils import (
+    acquire_retry,
+    asyncio_run,
+    run_jobs_with_rate_limit,
+    wait_retry_after,
+)
 from Utils.path_manager import PathManager
+from Utils.token_counter import count_tokens_batch
 
-DEFAULT_RATELIMIT = 50
 
-async def run_jobs(jobs, limit=DEFAULT_RATELIMIT, desc=""):
-    limiter = AsyncLimiter(limit)
-    async def worker(job: Coroutine):
-        async with limiter:
-            return await job
-    
-    pool_jobs = [worker(job) for job in jobs]
+def dump_json(json_res, json_file: str):
+    """Write a json cache file atomically, an interrupted run never leaves a truncated cache."""
+    tmp_file = f"{json_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(json_res, f, indent=4)
+    os.replace(tmp_file, json_file)
 
-    results = await tqdm_asyncio.gather(*pool_jobs, desc=desc)
-    return results
 
 class QueryGenerator:
     def __init__(self, path_manager: PathManager):
@@ -61,10 +57,11 @@ class QueryGenerator:
         for test_class in test_failure.test_classes:
             test_cases.extend(test_class.test_cases)
 
-        queries_list = self._queries_generation(test_cases)
-        queries = self._queries_merge(queries_list)
-        
-        return queries
+        return asyncio_run(self._agenerate(test_cases))
+
+    async def _agenerate(self, test_cases: List[TestCase]) -> List[str]:
+        queries_list = await self._aqueries_generation(test_cases)
+        return await self._aqueries_merge(queries_list)
 
     def generate_no_query(self, test_failure: TestFailure) -> List[str]:
         test_cases = [case for clazz in test_failure.test_classes for case in clazz.test_cases]
@@ -98,8 +95,7 @@ class QueryGenerator:
         messages = one_query_template.format_messages(info_ph=info)
         response = self.path_manager.reasoning_llm.chat(messages)
         json_res = self._parse_json_response(response.message.content)
-        with open(self.one_query_file, "w") as f:
-            json.dump(json_res, f, indent=4)
+        dump_json(json_res, self.one_query_file)
         
         return [json_res["Query"]]
     
@@ -150,15 +146,24 @@ class QueryGenerator:
         
         for test_case in test_cases:
             jobs.append(self._aquery_generation(test_case))
-        
-        queries_list = await run_jobs(
+        job_tokens = count_tokens_batch([
+            f"{test_case.test_method.text}\n{test_case.test_output}\n{test_case.stack_trace}"
+            for test_case in test_cases
+        ])
+        
+        # each job writes its own cache file as soon as it completes
+        reason_config = self.path_manager.config.models.reason
+        queries_list = await run_jobs_with_rate_limit(
             jobs,
-            limit=self.path_manager.config["reason"]["reasoning_rate_limit"],
-            desc="Query Generation"
+            limit=reason_config.rate_limit,
+            desc="Query Generation",
+            show_progress=True,
+            token_limit=getattr(reason_config, "token_limit", None),
+            job_tokens=job_tokens
         )
         return queries_list
     
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(3))
+    @retry(stop=stop_after_attempt(3), wait=wait_retry_after(), before=acquire_retry)
     async def _aquery_generation(self, test_case: TestCase) -> List[str]:
         query_file = os.path.join(self.query_path, f"{test_case.name}.json")
         
@@ -166,6 +171,7 @@ class QueryGenerator:
             with open(query_file, "r") as f:
                 json_res = json.load(f)
                 queries = json_res["Queries"]
+                self.path_manager.token_ledger.record("query", requests=0, cache_hits=1)
                 return queries
         
         messages = single_test_query_template.format_messages(
@@ -173,15 +179,18 @@ class QueryGenerator:
             test_output_ph=test_case.test_output,
             stack_trace_ph=test_case.stack_trace
         )
-        response = self.path_manager.reasoning_llm.chat(messages)
+        response = await self.path_manager.reasoning_llm.achat(messages)
         json_res = self._parse_json_response(response.message.content)
         queries = json_res["Queries"]
-        with open(query_file, "w") as f:
-            json.dump(json_res, f, indent=4)
+        dump_json(json_res, query_file)
+        self.path_manager.token_ledger.record("query")
         return queries
     
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(3))
     def _queries_merge(self, queries_list: List[List[str]]) -> List[str]:
+        return asyncio_run(self._aqueries_merge(queries_list))
+    
+    @retry(stop=stop_after_attempt(3), wait=wait_retry_after(), before=acquire_retry)
+    async def _aqueries_merge(self, queries_list: List[List[str]]) -> List[str]:
         
         # skip merge if only one test case
         if len(queries_list) == 1:
@@ -198,10 +207,10 @@ class QueryGenerator:
                 all_queries += "\n"
                 
             messages = query_merge_template.format_messages(queries_ph=all_queries)
-            response = self.path_manager.reasoning_llm.chat(messages)
+            response = await self.path_manager.reasoning_llm.achat(messages)
             json_res = self._parse_json_response(response.message.content)
             merged_queries = json_res["Queries"]
+            self.path_manager.token_ledger.record("query")
         
-        with open(self.merged_query_file, "w") as f:
-            json.dump({"Queries": merged_queries}, f, indent=4)
-        return merged_queries
\ No newline at end of file
+        dump_json({"Queries": merged_queries}, self.merged_query_file)
+        return merged_queries
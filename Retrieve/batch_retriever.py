@@ -0,0 +1,90 @@
+import asyncio
+from typing import List, Optional, Tuple
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.schema import BaseNode, NodeWithScore
+
+from Retrieve.embedding_cache import QueryEmbeddingCache, aget_query_embeddings
+
+DEFAULT_BATCH_WINDOW = 0.05
+
+
+class BatchedNodeRetriever:
+    """
+    Cosine-similarity retriever over embedded nodes which merges concurrent queries.
+
+    All `aretrieve` calls issued within `batch_window` seconds are embedded with one
+    batched query-mode request (see `aget_query_embeddings`) and scored against the node
+    embeddings in one matrix product. With an `embedding_cache` the queries embedded
+    before, e.g. in earlier diagnose rounds, are not sent again.
+    """
+
+    def __init__(
+        self,
+        nodes: List[BaseNode],
+        similarity_top_k: int = 1,
+        batch_window: float = DEFAULT_BATCH_WINDOW,
+        embed_model: Optional[BaseEmbedding] = None,
+        embedding_cache: Optional[QueryEmbeddingCache] = None,
+    ):
+        if len(nodes) == 0:
+            raise ValueError("No nodes to retrieve from")
+        self.nodes = nodes
+        self.similarity_top_k = similarity_top_k
+        self.batch_window = batch_window
+        self.embed_model = embed_model or Settings.embed_model
+        self.embedding_cache = embedding_cache
+        self._embeddings = self._normalize(np.array([node.embedding for node in nodes], dtype=np.float32))
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+
+    async def aretrieve(self, query: str) -> List[NodeWithScore]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((query, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.batch_window)
+        pending, self._pending = self._pending, []
+        self._flush_task = None
+        try:
+            results = await self.aretrieve_batch([query for query, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), nodes in zip(pending, results):
+            if not future.done():
+                future.set_result(nodes)
+
+    async def aretrieve_batch(self, queries: List[str]) -> List[List[NodeWithScore]]:
+        if self.embedding_cache is not None:
+            query_embeddings = await self.embedding_cache.aget_embeddings(queries)
+        else:
+            # dialogs often request the same context, embed each distinct request once
+            unique_queries = list(dict.fromkeys(queries))
+            embeddings = await aget_query_embeddings(self.embed_model, unique_queries)
+            embedding_of = dict(zip(unique_queries, embeddings))
+            query_embeddings = [embedding_of[query] for query in queries]
+        return self.retrieve_by_embeddings(query_embeddings)
+
+    def retrieve_by_embeddings(self, query_embeddings: List[List[float]]) -> List[List[NodeWithScore]]:
+        queries = self._normalize(np.array(query_embeddings, dtype=np.float32))
+        scores = queries @ self._embeddings.T
+        top_k = min(self.similarity_top_k, len(self.nodes))
+        top_indices = np.argsort(-scores, axis=1, kind="stable")[:, :top_k]
+        return [
+            [NodeWithScore(node=self.nodes[j], score=float(scores[i, j])) for j in top_indices[i]]
+            for i in range(len(query_embeddings))
+        ]
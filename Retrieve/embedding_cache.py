@@ -0,0 +1,107 @@
+import hashlib
+import os
+import pickle
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from llama_index.embeddings.jinaai import JinaEmbedding
+from llama_index.embeddings.openai import OpenAIEmbedding
+from llama_index.embeddings.voyageai import VoyageEmbedding
+
+from Utils.async_utils import asyncio_run, run_jobs_with_worker_limit
+
+DEFAULT_QUERY_EMBED_WORKERS = 16
+
+
+async def aget_query_embeddings(
+    embed_model: BaseEmbedding,
+    texts: List[str],
+    workers: int = DEFAULT_QUERY_EMBED_WORKERS,
+) -> List[List[float]]:
+    """
+    Embed texts in query mode, in batches of the model's embed_batch_size.
+
+    BaseEmbedding has no batched query call: voyage is asymmetric and is asked for
+    input_type="query" directly, jina and openai embed queries like documents and use
+    the text batch call. Other models fall back to one concurrent request per text.
+    """
+    if isinstance(embed_model, VoyageEmbedding):
+        batch_size = embed_model.embed_batch_size
+        embeddings = []
+        for i in range(0, len(texts), batch_size):
+            embeddings.extend(await embed_model._model.aget_embeddings(
+                texts[i:i + batch_size], model=embed_model.model_name, input_type="query"
+            ))
+        return embeddings
+    if isinstance(embed_model, (JinaEmbedding, OpenAIEmbedding)):
+        return await embed_model.aget_text_embedding_batch(texts)
+    jobs = [embed_model.aget_query_embedding(text) for text in texts]
+    return await run_jobs_with_worker_limit(jobs, workers=workers)
+
+
+class QueryEmbeddingCache:
+    """
+    Persistent cache of the query embeddings of one embedding model, {sha256(text): embedding}.
+
+    The texts missing from the cache are embedded in query mode with one batched request
+    (see `aget_query_embeddings`) and the cache file is rewritten after each batch, so the
+    same hypotheses are never embedded twice across runs.
+    """
+
+    def __init__(self, cache_file: str, embed_model: Optional[BaseEmbedding] = None):
+        self.cache_file = cache_file
+        self._embed_model = embed_model
+        self._lock = threading.Lock()
+        self._embeddings: Dict[str, np.ndarray] = self._load()
+        self.n_hits = 0
+        self.n_embedded = 0
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        return self._embed_model or Settings.embed_model
+
+    @staticmethod
+    def get_key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _load(self) -> Dict[str, np.ndarray]:
+        if not os.path.exists(self.cache_file):
+            return {}
+        with open(self.cache_file, "rb") as f:
+            return pickle.load(f)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        # keep the embeddings other processes added since we loaded the file
+        embeddings = self._load()
+        embeddings.update(self._embeddings)
+        self._embeddings = embeddings
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            pickle.dump(embeddings, f)
+        os.replace(tmp_file, self.cache_file)
+
+    async def aget_embeddings(self, texts: List[str]) -> List[np.ndarray]:
+        keys = [self.get_key(text) for text in texts]
+        with self._lock:
+            todo = {}
+            for key, text in zip(keys, texts):
+                if key not in self._embeddings:
+                    todo[key] = text
+            self.n_hits += len(texts) - len(todo)
+        if todo:
+            new_embeddings = await aget_query_embeddings(self.embed_model, list(todo.values()))
+            with self._lock:
+                for key, embedding in zip(todo.keys(), new_embeddings):
+                    self._embeddings[key] = np.asarray(embedding, dtype=np.float32)
+                self.n_embedded += len(todo)
+                self._save()
+        with self._lock:
+            return [self._embeddings[key] for key in keys]
+
+    def get_embeddings(self, texts: List[str]) -> List[np.ndarray]:
+        return asyncio_run(self.aget_embeddings(texts))
@@ -0,0 +1,55 @@
+from typing import List, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode
+
+from BM25.index import BM25Index
+from functions.my_types import TestCase
+from Storage.priority import get_frame_hits, parse_stack_frames
+
+# a method in a stack trace outranks any identifier overlap, which is scaled to [0, 1]
+DEFAULT_FRAME_WEIGHT = 1.0
+
+
+def get_lexical_query(test_case: TestCase) -> str:
+    """
+    Identifiers of a failing test: the exception, the frames of its stack trace and the test code.
+    """
+    stack_trace = test_case.stack_trace or ""
+    lines = [line.strip() for line in stack_trace.split("\n") if line.strip() and not line.startswith("---")]
+    parts = lines[:1]
+    parts.extend(f"{class_name} {method_name}" for class_name, method_name, _ in parse_stack_frames(stack_trace))
+    if test_case.test_method is not None:
+        parts.append(test_case.test_method.code)
+    return "\n".join(parts)
+
+
+class LexicalPrefilter:
+    """
+    Cheap candidate generation over the method nodes from the identifiers of the failing tests.
+
+    Each method is scored by whether it appears in a stack trace, plus the BM25 score of its
+    code against the identifiers of each failing test, summed over the tests and scaled to [0, 1].
+    """
+
+    def __init__(self, method_nodes: List[BaseNode], frame_weight: float = DEFAULT_FRAME_WEIGHT):
+        self.method_nodes = [node for node in method_nodes if not node.metadata["is_test_method"]]
+        self.frame_weight = frame_weight
+        self.bm25_index = BM25Index()
+        self.doc_ids, _ = self.bm25_index.add_documents([node.text for node in self.method_nodes])
+
+    def score(self, test_cases: List[TestCase]) -> np.ndarray:
+        if len(self.method_nodes) == 0 or len(test_cases) == 0:
+            return np.zeros(len(self.method_nodes), dtype=np.float64)
+        queries = [get_lexical_query(test_case) for test_case in test_cases]
+        bm25_scores = self.bm25_index.score_batch(queries, self.doc_ids).sum(axis=0)
+        if bm25_scores.max() > 0:
+            bm25_scores = bm25_scores / bm25_scores.max()
+        return self.frame_weight * get_frame_hits(self.method_nodes, test_cases) + bm25_scores
+
+    def top_candidates(self, test_cases: List[TestCase], top_n: int) -> List[Tuple[BaseNode, float]]:
+        """The top_n methods with a positive score, best first."""
+        scores = self.score(test_cases)
+        candidates = np.flatnonzero(scores > 0)
+        order = candidates[np.argsort(-scores[candidates], kind="stable")][:top_n]
+        return [(self.method_nodes[i], float(scores[i])) for i in order]
@@ -1,18 +1,11 @@
 
 from llama_index.core import ChatPromptTemplate
 
+# the instructions come first and the method last, so that all the rerank requests of a bug
+# share the instructions and hypotheses as a prompt prefix the provider can cache
 CHAT_RERANK_PROMPT = """
 A bug in the codebase has caused one or more test cases to fail. Your task is to analyze a potentially suspicious method and determine its likelihood of being the source of the bug.
 
-Given information:
-Faulty Location Hypothesis:
-
-{causes_ph}
-
-One of the retrieved suspicious methods in the codebase:
-
-{method_code_ph}
-
 Instructions:
 1. Carefully examine the provided Faulty Location Hypothesis and the source code of the suspicious method.
 2. Consider the following factors in your analysis:
@@ -44,37 +37,21 @@ Example JSON output:
   }}
 
 Note: Ensure your explanation in the "Reason" field is detailed enough to justify the score you've assigned.
-"""
-
-EXAMPLE_CHAT_RERANK_PROMPT = """
-A bug in the codebase has caused one or more test cases to fail. Your task is to analyze a potentially suspicious method and determine its likelihood of being the source of the bug.
 
 Given information:
 Faulty Location Hypothesis:
 
-{
-  \"context\": \"The bug likely resides in the component responsible for user authentication and session management.\",
-  \"functionality\": \"The method responsible for session token validation process is not correctly handling expired tokens, leading to unauthorized access to protected resources.\",
-  \"logic\": \"The buggy code is likely not properly checking the expiration time of the token. It may be using an incorrect comparison operator or not accounting for time zone differences when comparing the current time with the token's expiration timestamp.\"
-}
+{causes_ph}
 
 One of the retrieved suspicious methods in the codebase:
 
- 396 public void test2947660() {
- 397         AbstractCategoryItemRenderer r = new LineAndShapeRenderer();
- 398         assertNotNull(r.getLegendItems());
- 399         assertEquals(0, r.getLegendItems().getItemCount());
- 400 
- 401         DefaultCategoryDataset dataset = new DefaultCategoryDataset();
- 402         CategoryPlot plot = new CategoryPlot();
- 403         plot.setDataset(dataset);
- 404         plot.setRenderer(r);
- 405         assertEquals(0, r.getLegendItems().getItemCount());
- 406 
- 407         dataset.addValue(1.0, \"S1\", \"C1\");
- 408         LegendItemCollection lic = r.getLegendItems();
- 409         assertEquals(1, lic.getItemCount());
- 410         assertEquals(\"S1\", lic.get(0).getLabel());
+{method_code_ph}
+
+Now, evaluate this method and respond with the JSON object described above:
+"""
+
+EXAMPLE_CHAT_RERANK_PROMPT = """
+A bug in the codebase has caused one or more test cases to fail. Your task is to analyze a potentially suspicious method and determine its likelihood of being the source of the bug.
 
 Instructions:
 1. Carefully examine the provided Faulty Location Hypothesis and the source code of the suspicious method.
@@ -107,6 +84,35 @@ Example JSON output:
   }}
 
 Note: Ensure your explanation in the "Reason" field is detailed enough to justify the score you've assigned.
+
+Given information:
+Faulty Location Hypothesis:
+
+{
+  \"context\": \"The bug likely resides in the component responsible for user authentication and session management.\",
+  \"functionality\": \"The method responsible for session token validation process is not correctly handling expired tokens, leading to unauthorized access to protected resources.\",
+  \"logic\": \"The buggy code is likely not properly checking the expiration time of the token. It may be using an incorrect comparison operator or not accounting for time zone differences when comparing the current time with the token's expiration timestamp.\"
+}
+
+One of the retrieved suspicious methods in the codebase:
+
+ 396 public void test2947660() {
+ 397         AbstractCategoryItemRenderer r = new LineAndShapeRenderer();
+ 398         assertNotNull(r.getLegendItems());
+ 399         assertEquals(0, r.getLegendItems().getItemCount());
+ 400 
+ 401         DefaultCategoryDataset dataset = new DefaultCategoryDataset();
+ 402         CategoryPlot plot = new CategoryPlot();
+ 403         plot.setDataset(dataset);
+ 404         plot.setRenderer(r);
+ 405         assertEquals(0, r.getLegendItems().getItemCount());
+ 406 
+ 407         dataset.addValue(1.0, \"S1\", \"C1\");
+ 408         LegendItemCollection lic = r.getLegendItems();
+ 409         assertEquals(1, lic.getItemCount());
+ 410         assertEquals(\"S1\", lic.get(0).getLabel());
+
+Now, evaluate this method and respond with the JSON object described above:
 """
 
 
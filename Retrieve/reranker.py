@@ -19,9 +19,9 @@ from Utils.model import (
     calculate_in_cost,
     calculate_out_cost,
     get_embedding_reranker,
-    parse_llm_output,
 )
 from Utils.path_manager import PathManager
+from Utils.structured_output import RERANK_SCHEMA, chat_structured
 
 
 class ChatReranker:
@@ -39,7 +39,8 @@ class ChatReranker:
         diagnose_text = ""
 
         # tranverse the files in diagnose cache path
-        diagnose_files = Path(diagnose_path).rglob("dialog.json")
+        # sorted, so that the hypotheses (the shared prompt prefix) are the same in every run
+        diagnose_files = sorted(Path(diagnose_path).rglob("dialog.json"))
         for i, diagnose_file in enumerate(diagnose_files):
             with open(os.path.join(diagnose_path, diagnose_file), "r") as f:
                 diagnose = json.load(f)
@@ -56,9 +57,12 @@ class ChatReranker:
         )
         return reranked_nodes
 
+    def _get_rerank_file(self, node: NodeWithScore) -> str:
+        return os.path.join(self.rerank_cache_dir, f"{node.id_}.json")
+
     # @retry(stop=stop_after_attempt(3), wait=wait_fixed(5))
     def _get_score_for_node(self, node: NodeWithScore) -> dict:
-        rerank_file = os.path.join(self.rerank_cache_dir, f"{node.id_}.json")
+        rerank_file = self._get_rerank_file(node)
         if os.path.exists(rerank_file):
             with open(rerank_file, "r") as f:
                 result = json.load(f)
@@ -69,40 +73,63 @@ class ChatReranker:
             return {
                 "response": result,
                 "tokens": in_tokens + out_tokens,
+                "in_tokens": in_tokens,
+                "out_tokens": out_tokens,
                 "cost": in_cost + out_cost,
+                "cached_tokens": 0,
+                "cached": True,
             }
 
         messages = CHAT_RERANK_TEMPLATE.format_messages(
             causes_ph=self.diagnose_text, method_code_ph=node.text
         )
         in_tokens, in_cost = calculate_in_cost(str(messages))
+        usage = {"cached_tokens": 0}
 
         if self.path_manager.config.mimic:
             result = EXAMPLE_RERANK_RESPONSE
         else:
-            response = self.path_manager.reasoning_llm.chat(messages)
-            result = parse_llm_output(response.message.content)
+            result = chat_structured(
+                self.path_manager.reasoning_llm,
+                messages,
+                RERANK_SCHEMA,
+                json_mode=getattr(self.path_manager.config.models.reason, "json_mode", False),
+                usage=usage,
+            )
             with open(rerank_file, "w") as f:
                 json.dump(result, f, indent=4)
         out_tokens, out_cost = calculate_out_cost(str(result))
         return {
             "response": result,
             "tokens": in_tokens + out_tokens,
+            "in_tokens": in_tokens,
+            "out_tokens": out_tokens,
             "cost": in_cost + out_cost,
+            "cached_tokens": usage["cached_tokens"],
+            "cached": False,
         }
 
     def _run_jobs_with_thread_pool(self, jobs, limit, desc=""):
-        results = []
+        results = [None] * len(jobs)
+        todo = list(range(len(jobs)))
+
+        # all the prompts share the instructions and hypotheses as prefix, score one node
+        # first so the others can hit the provider's prefix cache instead of racing it
+        first = next((i for i in todo if not os.path.exists(self._get_rerank_file(jobs[i]))), None)
+        if first is not None and len(todo) > 1:
+            results[first] = self._get_score_for_node(jobs[first])
+            todo.remove(first)
 
         with ThreadPoolExecutor(max_workers=limit) as executor:
-            futures = []
-            for node in jobs:
-                futures.append(executor.submit(self._get_score_for_node, node))
+            futures = {
+                executor.submit(self._get_score_for_node, jobs[i]): i
+                for i in todo
+            }
 
             for future in as_completed(futures):
                 try:
-                    result = future.result()
-                    results.append(result)
+                    # keep the results in the order of the jobs
+                    results[futures[future]] = future.result()
                 except Exception as e:
                     self.path_manager.logger.exception(f"Error in {desc}: {e}")
                     raise Exception(f"Error in {desc}: {e}") from e
@@ -124,6 +151,16 @@ class ChatReranker:
         self.path_manager.logger.info(
             f"Chat rerank cost: {sum(tokens)} tokens, {sum(costs)} money"
         )
+        n_cached = sum([result["cached"] for result in results])
+        self.path_manager.token_ledger.record(
+            "rerank",
+            in_tokens=sum([result["in_tokens"] for result in results]),
+            out_tokens=sum([result["out_tokens"] for result in results]),
+            cost=sum(costs),
+            requests=len(results) - n_cached,
+            cache_hits=n_cached,
+            cached_tokens=sum([result["cached_tokens"] for result in results]),
+        )
 
         for i, node in enumerate(nodes):
             node.metadata["llm_score"] = responses[i]["Score"]
@@ -1,184 +1,358 @@
+import hashlib
 import os
 import pickle
-from typing import Dict, List
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-from llama_index.core.base.base_retriever import BaseRetriever
-from llama_index.core.schema import NodeWithScore
-from tqdm import tqdm
+import numpy as np
+from llama_index.core.schema import BaseNode, NodeWithScore
 
-from Retrieve.index import (
-    get_context_index,
-    get_method_description_index,
-    get_method_functionality_index,
-)
+from functions.sbfl import SBFLTable
+from Retrieve.batch_retriever import BatchedNodeRetriever
+from Retrieve.index import get_method_description_nodes
+from Retrieve.lexical import LexicalPrefilter
 from Retrieve.reranker import ChatReranker, EmbeddingReranker
 from Storage.store import HybridStore
-from Utils.async_utils import asyncio_run, run_jobs_with_worker_limit
 from Utils.path_manager import PathManager
 
+DEFAULT_LEXICAL_TOP_N = 500
+
+
+def sum_node_scores(nodes_list: List[List[NodeWithScore]]) -> Tuple[Dict[str, int], np.ndarray]:
+    """
+    Sum the scores each node got from all queries, returns the position of each node id
+    (in order of first appearance) and the summed scores indexed by these positions.
+    """
+    positions: Dict[str, int] = {}
+    rows, scores = [], []
+    for nodes in nodes_list:
+        for node in nodes:
+            rows.append(positions.setdefault(node.id_, len(positions)))
+            scores.append(node.score)
+    summed_scores = np.bincount(
+        np.array(rows, dtype=np.int64),
+        weights=np.array(scores, dtype=np.float64),
+        minlength=len(positions),
+    )
+    return positions, summed_scores
+
 
 class MethodRetriever:
     def __init__(self, path_manager: PathManager, store: HybridStore):
         self.path_manager = path_manager
         self.logger = path_manager.logger
         self.store = store
-        retrieve_dir = os.path.join(path_manager.res_path, "retrieve")
-        os.makedirs(retrieve_dir, exist_ok=True)
-        self.context_nodes_file = os.path.join(retrieve_dir, "context_nodes.pkl")
-        self.method_nodes_file = os.path.join(retrieve_dir, "method_nodes.pkl")
-        self.desc_nodes_file = os.path.join(retrieve_dir, "desc_nodes.pkl")
+        # reranked nodes of each query, {level}/{query key}.pkl
+        self.retrieve_dir = os.path.join(path_manager.res_path, "retrieve")
+        os.makedirs(self.retrieve_dir, exist_ok=True)
+        # method-level SBFL suspiciousness of the candidates, {node id: score}
+        self.sbfl_scores = None
+        # method nodes kept by the lexical prefilter, the embedding search is restricted to them
+        self.lexical_candidates = None
     
     
-    def retrieve(self, queries: List[str], retriever: BaseRetriever) -> List[List[NodeWithScore]]:
-        nodes_list = asyncio_run(self._aretrieve_nodes(queries, retriever))
-        return nodes_list
+    def retrieve(self, queries: List[str], retriever: BatchedNodeRetriever) -> List[List[NodeWithScore]]:
+        """
+        Retrieve the top nodes of all queries, the queries not embedded before are
+        embedded in one batch request.
+        """
+        cache = self.store.query_embedding_cache
+        n_embedded = cache.n_embedded
+        query_embeddings = cache.get_embeddings(queries)
+        self.logger.info(f"embedded {cache.n_embedded - n_embedded} of {len(queries)} queries")
+        return retriever.retrieve_by_embeddings(query_embeddings)
     
     
-    async def _aretrieve_nodes(self, queries: List[str], retriever: BaseRetriever) -> List[List[NodeWithScore]]:
-        jobs = []
-        for query in queries:
-            jobs.append(retriever.aretrieve(query))
-        nodes = await run_jobs_with_worker_limit(
-            jobs,
-            desc="Retrieve Nodes",
-            show_progress=True)
-        return nodes
+    def get_index_fingerprint(self, nodes: List[BaseNode]) -> str:
+        """
+        Identify an index by the embedding model and the ids of its nodes,
+        the node ids are hashes of their text so changed nodes change the fingerprint.
+        """
+        sha256 = hashlib.sha256()
+        sha256.update(self.path_manager.config.models.embed.cache_name.encode("utf-8"))
+        for node_id in sorted(node.id_ for node in nodes):
+            sha256.update(node_id.encode("utf-8"))
+        return sha256.hexdigest()
     
     
-    def get_context_score(self, context_queries: List[str], embedding_reranker: EmbeddingReranker):
-        if os.path.exists(self.context_nodes_file):
-            self.logger.info(f"Loading reranked context nodes from {self.context_nodes_file}")
-            with open(self.context_nodes_file, "rb") as f:
-                reranked_context_list = pickle.load(f)
-        else:
-            self.logger.info(f"Retrieving and reranking context nodes...")
-            context_index = get_context_index(self.store)
-            context_retriever = context_index.as_retriever(similarity_top_k=self.path_manager.retrieve_top_n)
-            context_nodes_list = self.retrieve(context_queries, context_retriever)
-            reranked_context_list = embedding_reranker.rerank(context_nodes_list, context_queries)
-            with open(self.context_nodes_file, "wb") as f:
-                pickle.dump(reranked_context_list, f)
+    def get_query_key(self, query: str, index_fingerprint: str) -> str:
+        config = self.path_manager.config
+        key = "|".join([
+            hashlib.sha256(query.encode("utf-8")).hexdigest(),
+            index_fingerprint,
+            str(self.path_manager.retrieve_top_n),
+            config.models.rerank.series,
+            config.models.rerank.model,
+            str(self.path_manager.rerank_top_n),
+            str(config.use_context),
+        ])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+    
+    
+    def retrieve_and_rerank(self,
+            level: str,
+            queries: List[str],
+            index_nodes: List[BaseNode],
+            embedding_reranker: EmbeddingReranker,
+            retriever: Optional[BatchedNodeRetriever] = None
+        ) -> List[List[NodeWithScore]]:
+        """
+        Retrieve and rerank the nodes of each query, reusing the cached results of the queries
+        asked before against the same index, top_n and reranker model. A retriever over
+        `index_nodes` is built if none is given.
+        """
+        cache_dir = os.path.join(self.retrieve_dir, level)
+        os.makedirs(cache_dir, exist_ok=True)
+        fingerprint = self.get_index_fingerprint(index_nodes)
+        cache_files = [
+            os.path.join(cache_dir, f"{self.get_query_key(query, fingerprint)}.pkl")
+            for query in queries
+        ]
+        reranked_nodes_list = [None] * len(queries)
+        for i, cache_file in enumerate(cache_files):
+            if os.path.exists(cache_file):
+                with open(cache_file, "rb") as f:
+                    reranked_nodes_list[i] = pickle.load(f)
+        todo = [i for i, nodes in enumerate(reranked_nodes_list) if nodes is None]
+        self.logger.info(f"{len(queries) - len(todo)} of {len(queries)} {level} queries found in cache")
+        self.path_manager.token_ledger.record(
+            f"retrieve_{level}",
+            requests=len(todo),
+            cache_hits=len(queries) - len(todo),
+        )
+        if len(todo) == 0:
+            return reranked_nodes_list
         
-        context_score_dict = {}
-        for context_nodes in reranked_context_list:
-            for node in context_nodes:
-                if node.id_ not in context_score_dict:
-                    context_score_dict[node.id_] = [node.score]
-                else:
-                    context_score_dict[node.id_].append(node.score)
-        return context_score_dict
+        self.logger.info(f"Retrieving and reranking {level} nodes...")
+        todo_queries = [queries[i] for i in todo]
+        if retriever is None:
+            cache = self.store.query_embedding_cache
+            retriever = BatchedNodeRetriever(
+                index_nodes,
+                similarity_top_k=self.path_manager.retrieve_top_n,
+                embed_model=cache.embed_model,
+                embedding_cache=cache,
+            )
+        nodes_list = self.retrieve(todo_queries, retriever)
+        reranked_todo_list = embedding_reranker.rerank(nodes_list, todo_queries)
+        for i, reranked_nodes in zip(todo, reranked_todo_list):
+            reranked_nodes_list[i] = reranked_nodes
+            tmp_file = f"{cache_files[i]}.tmp"
+            with open(tmp_file, "wb") as f:
+                pickle.dump(reranked_nodes, f)
+            os.replace(tmp_file, cache_files[i])
+        return reranked_nodes_list
+    
+    
+    def get_context_score(self, context_queries: List[str], embedding_reranker: EmbeddingReranker):
+        reranked_context_list = self.retrieve_and_rerank(
+            "context",
+            context_queries,
+            self.store.get_nodes_by_type("context_node"),
+            embedding_reranker,
+            self.store.get_retriever("context_node", self.path_manager.retrieve_top_n)
+        )
+        return sum_node_scores(reranked_context_list)
     
     
     def get_description_score(self,
             desc_queries: List[str],
-            reranked_methods_list: List[List[NodeWithScore]],
+            method_ids: List[str],
             embedding_reranker: EmbeddingReranker
         ):
-        if os.path.exists(self.desc_nodes_file):
-            self.logger.info(f"Loading reranked description nodes from {self.desc_nodes_file}")
-            with open(self.desc_nodes_file, "rb") as f:
-                reranked_desc_list = pickle.load(f)
-        else:
-            self.logger.info(f"Retrieving and reranking description nodes...")
-            method_nodes_ids = list(set([node.id_ for nodes in reranked_methods_list for node in nodes]))
-            all_method_nodes = self.store.doc_store.get_nodes(method_nodes_ids)
-            desc_index = get_method_description_index(
-                all_method_nodes,
-                self.store,
-                use_context=self.path_manager.config.use_context
-            )
-            desc_retriever = desc_index.as_retriever(similarity_top_k=self.path_manager.retrieve_top_n)
-            desc_nodes_list = self.retrieve(desc_queries, desc_retriever)
-            reranked_desc_list = embedding_reranker.rerank(desc_nodes_list, desc_queries)
-            with open(self.desc_nodes_file, "wb") as f:
-                pickle.dump(reranked_desc_list, f)
-        
-        desc_score_dict = {}
-        for desc_nodes in reranked_desc_list:
-            for node in desc_nodes:
-                if node.id_ not in desc_score_dict:
-                    desc_score_dict[node.id_] = [node.score]
-                else:
-                    desc_score_dict[node.id_].append(node.score)
-        return desc_score_dict
+        all_method_nodes = self.store.doc_store.get_nodes(method_ids)
+        desc_nodes = get_method_description_nodes(
+            all_method_nodes,
+            self.store,
+            use_context=self.path_manager.config.use_context
+        )
+        reranked_desc_list = self.retrieve_and_rerank(
+            "desc", desc_queries, desc_nodes, embedding_reranker
+        )
+        return sum_node_scores(reranked_desc_list)
     
     
     def retrieve_methods(self, faulty_funcs: List[Dict[str, str]]) -> List[NodeWithScore]:
+        telemetry = self.path_manager.telemetry
+        if self.store.lazy:
+            # summarize more methods if the lazily summarized pool cannot fill the retrieval
+            self.store.ensure_summarized(self.path_manager.retrieve_top_n)
+        if getattr(self.path_manager.config, "lexical_prefilter", False):
+            with telemetry.span("lexical") as span:
+                self.lexical_candidates = self.get_lexical_candidates()
+                span["n_candidates"] = len(self.lexical_candidates or [])
+        with telemetry.span("retrieve") as span:
+            result_nodes = self.combine_retrieval_results(faulty_funcs)
+            result_nodes = self.fuse_sbfl_scores(result_nodes)
+            span["n_queries"] = len(faulty_funcs)
+            span["n_nodes"] = len(result_nodes)
+
+        if self.path_manager.config.use_chat_rerank:
+            with telemetry.span("rerank"):
+                result_nodes = self.chat_rerank(result_nodes)
+
+        # Filter out test methods
+        result_nodes = [node for node in result_nodes if node.metadata["is_test_method"] == False]
+        return result_nodes
+
+
+    def get_lexical_candidates(self) -> Optional[List[BaseNode]]:
+        """
+        Method nodes matching the stack traces and test code of the failing tests,
+        None if they are too few to fill the retrieval.
+        """
+        test_failure = self.store.test_failure
+        if test_failure is None:
+            self.logger.warning("No test failure for the lexical prefilter, skip it")
+            return None
+        test_cases = [
+            test_case
+            for test_class in test_failure.test_classes
+            for test_case in test_class.test_cases
+        ]
+        top_n = getattr(self.path_manager.config.hyper, "lexical_top_n", DEFAULT_LEXICAL_TOP_N)
+        prefilter = LexicalPrefilter(self.store.get_nodes_by_type("method_node"))
+        candidates = prefilter.top_candidates(test_cases, top_n)
+        self.logger.info(f"lexical prefilter kept {len(candidates)} of {len(prefilter.method_nodes)} methods")
+        if len(candidates) < self.path_manager.retrieve_top_n:
+            self.logger.info(f"too few lexical candidates for top {self.path_manager.retrieve_top_n} retrieval, skip it")
+            return None
+        return [node for node, _ in candidates]
+    
+    
+    def combine_retrieval_results(self, faulty_funcs: List[Dict[str, str]]) -> List[NodeWithScore]:
         context_queries = [func["context"] for func in faulty_funcs]
         method_queries = [func["functionality"] for func in faulty_funcs]
         desc_queries = [func["logic"] for func in faulty_funcs]
         embedding_reranker = EmbeddingReranker(self.path_manager)
+        config = self.path_manager.config
+        weights = getattr(config.hyper, "retrieval_weights", None)
+        method_weight = getattr(weights, "method", 1.0)
+        context_weight = getattr(weights, "context", 1.0)
+        desc_weight = getattr(weights, "description", 1.0)
         
-        if os.path.exists(self.method_nodes_file):
-            self.logger.info(f"Loading reranked method nodes from {self.method_nodes_file}")
-            with open(self.method_nodes_file, "rb") as f:
-                reranked_methods_list = pickle.load(f)
+        if self.lexical_candidates is not None:
+            reranked_methods_list = self.retrieve_and_rerank(
+                "method",
+                method_queries,
+                self.lexical_candidates,
+                embedding_reranker
+            )
         else:
-            self.logger.info(f"Retrieving and reranking method nodes...")
-            method_index = get_method_functionality_index(self.store)
-            method_retriever = method_index.as_retriever(similarity_top_k=self.path_manager.retrieve_top_n)
-            method_nodes_list = self.retrieve(method_queries, method_retriever)
-            reranked_methods_list = embedding_reranker.rerank(method_nodes_list, method_queries)
-            with open(self.method_nodes_file, "wb") as f:
-                pickle.dump(reranked_methods_list, f)
-            
-        method_score_dict = {}
-        for method_nodes in reranked_methods_list:
-            for node in method_nodes:
-                if node.id_ not in method_score_dict:
-                    method_score_dict[node.id_] = [node.score]
-                else:
-                    method_score_dict[node.id_].append(node.score)
+            reranked_methods_list = self.retrieve_and_rerank(
+                "method",
+                method_queries,
+                self.store.get_nodes_by_type("method_node"),
+                embedding_reranker,
+                self.store.get_retriever("method_node", self.path_manager.retrieve_top_n)
+            )
+        
+        method_positions, method_scores = sum_node_scores(reranked_methods_list)
+        method_ids = list(method_positions)
+        
+        self.logger.info(f"Combining multi-level retrieval results...")
+        method_nodes = self.store.doc_store.get_nodes(method_ids)
+        scores = method_weight * method_scores
         
-        if self.path_manager.config.use_context_retrieval:
-            if self.path_manager.config.use_context:
-                context_score_dict = self.get_context_score(context_queries, embedding_reranker)
+        if config.use_context_retrieval and config.use_context:
+            context_positions, context_scores = self.get_context_score(context_queries, embedding_reranker)
+            # index -1 points to the padded zero for methods without a retrieved context
+            context_rows = np.array([
+                context_positions.get(node.metadata.get("ctxt_node_id", None), -1)
+                for node in method_nodes
+            ], dtype=np.int64)
+            scores += context_weight * np.append(context_scores, 0.0)[context_rows]
         
-        if self.path_manager.config.use_description_retrieval:
-            desc_score_dict = self.get_description_score(
+        if config.use_description_retrieval:
+            desc_positions, desc_scores = self.get_description_score(
                 desc_queries,
-                reranked_methods_list,
+                method_ids,
                 embedding_reranker
             )
-        
-        self.logger.info(f"Combining multi-level retrieval results...")
-        result_nodes = []
-        for id in tqdm(method_score_dict):
-            method_node = self.store.doc_store.get_node(id)
-            node_with_score = NodeWithScore(node=method_node, score=sum(method_score_dict[id]))
-            
-            if self.path_manager.config.use_context_retrieval:
-                context_node_id = method_node.metadata.get("context_node_id", None)
-                if context_node_id:
-                    if context_node_id in context_score_dict:
-                        node_with_score.score += sum(context_score_dict[context_node_id])
-                
-            if self.path_manager.config.use_description_retrieval:
-                if self.path_manager.config.use_context:
-                    desc_node_ids = method_node.metadata.get("desc_node_ids", None)
-                else:
-                    desc_node_ids = method_node.metadata.get("desc_node_ids_NC", None)
-                assert desc_node_ids is not None, f"Method node {id} has no description node"
+            desc_key = "desc_node_ids" if config.use_context else "desc_node_ids_NC"
+            method_rows, desc_rows = [], []
+            for i, node in enumerate(method_nodes):
+                desc_node_ids = node.metadata.get(desc_key, None)
+                assert desc_node_ids is not None, f"Method node {node.id_} has no description node"
                 for desc_node_id in desc_node_ids:
-                    if desc_node_id in desc_score_dict:
-                        node_with_score.score += sum(desc_score_dict[desc_node_id])
-            
-            result_nodes.append(node_with_score)
-        result_nodes.sort(key=lambda x: x.score, reverse=True)
-        
-        if self.path_manager.config.use_chat_rerank:
-            n_chat_rerank = self.path_manager.config.hyper.chat_rerank_top_n
-            if len(result_nodes) <= n_chat_rerank:
-                todo_nodes = result_nodes
-                undo_nodes = []
-            else:
-                todo_nodes = result_nodes[:n_chat_rerank]
-                undo_nodes = result_nodes[n_chat_rerank:]
-            self.logger.info(f"Chat rerank {len(todo_nodes)} method nodes")
-            chat_reranker = ChatReranker(self.path_manager)
-            todo_nodes = chat_reranker.rerank(todo_nodes)
-            result_nodes = todo_nodes + undo_nodes
+                    if desc_node_id in desc_positions:
+                        method_rows.append(i)
+                        desc_rows.append(desc_positions[desc_node_id])
+            scores += desc_weight * np.bincount(
+                np.array(method_rows, dtype=np.int64),
+                weights=desc_scores[np.array(desc_rows, dtype=np.int64)],
+                minlength=len(method_nodes),
+            )
         
-        # Filter out test methods
-        result_nodes = [node for node in result_nodes if node.metadata["is_test_method"] == False]
-        return result_nodes
\ No newline at end of file
+        top_k = getattr(config.hyper, "combine_top_k", None)
+        if top_k and top_k < len(scores):
+            top_rows = np.argpartition(-scores, top_k - 1)[:top_k]
+            top_rows.sort()
+        else:
+            top_rows = np.arange(len(scores))
+        # stable sort keeps the retrieval order among equal scores
+        order = top_rows[np.argsort(-scores[top_rows], kind="stable")]
+        return [NodeWithScore(node=method_nodes[i], score=float(scores[i])) for i in order]
+    
+    
+    def get_sbfl_scores(self, nodes: List[NodeWithScore]) -> np.ndarray:
+        """
+        Method-level suspiciousness of the nodes, the maximum SBFL score of their lines.
+        """
+        formula = self.path_manager.sbfl_formula
+        sbfl_table = SBFLTable.from_files({formula: self.path_manager.sbfl_file})
+        methods = [
+            (Path(node.metadata["file_path"]).stem, node.metadata["start_line"], node.metadata["end_line"])
+            for node in nodes
+        ]
+        return sbfl_table.method_scores(methods, formula)
+    
+    
+    def fuse_sbfl_scores(self, result_nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        """
+        Add the SBFL suspiciousness as a prior to the semantic scores, both scaled to [0, 1]:
+
+            score = semantic_score / max(semantic_score) + sbfl_weight * sbfl_score / max(sbfl_score)
+        """
+        sbfl_weight = getattr(self.path_manager.config.hyper, "sbfl_weight", 0)
+        sbfl_prune = getattr(self.path_manager.config.hyper, "sbfl_prune", False)
+        if not (sbfl_weight or sbfl_prune) or len(result_nodes) == 0:
+            return result_nodes
+        if not self.path_manager.sbfl_formula or not os.path.exists(self.path_manager.sbfl_file):
+            self.logger.warning(f"No SBFL result for {self.path_manager.bug_name}, skip SBFL fusion")
+            return result_nodes
+
+        sbfl_scores = self.get_sbfl_scores(result_nodes)
+        self.sbfl_scores = {node.id_: float(score) for node, score in zip(result_nodes, sbfl_scores)}
+        self.logger.info(f"{np.count_nonzero(sbfl_scores)}/{len(result_nodes)} candidates are covered by SBFL")
+        if not sbfl_weight:
+            return result_nodes
+
+        def scale(scores: np.ndarray) -> np.ndarray:
+            max_abs = np.abs(scores).max()
+            return scores / max_abs if max_abs > 0 else scores
+
+        semantic_scores = np.array([node.score for node in result_nodes], dtype=np.float64)
+        fused_scores = scale(semantic_scores) + sbfl_weight * scale(sbfl_scores)
+        result_nodes = [
+            NodeWithScore(node=node.node, score=float(score))
+            for node, score in zip(result_nodes, fused_scores)
+        ]
+        result_nodes.sort(key=lambda x: x.score, reverse=True)
+        return result_nodes
+    
+    
+    def chat_rerank(self, result_nodes: List[NodeWithScore]) -> List[NodeWithScore]:
+        n_chat_rerank = self.path_manager.config.hyper.chat_rerank_top_n
+        candidates = result_nodes
+        if getattr(self.path_manager.config.hyper, "sbfl_prune", False) and self.sbfl_scores is not None:
+            # methods never executed by the failing tests are not worth an LLM call
+            candidates = [node for node in result_nodes if self.sbfl_scores.get(node.id_, 0) > 0]
+            self.logger.info(f"SBFL pruned {len(result_nodes) - len(candidates)} chat rerank candidates")
+        todo_nodes = candidates[:n_chat_rerank]
+        todo_ids = set(node.id_ for node in todo_nodes)
+        undo_nodes = [node for node in result_nodes if node.id_ not in todo_ids]
+        self.logger.info(f"Chat rerank {len(todo_nodes)} method nodes")
+        chat_reranker = ChatReranker(self.path_manager)
+        todo_nodes = chat_reranker.rerank(todo_nodes)
+        return todo_nodes + undo_nodes
\ No newline at end of file
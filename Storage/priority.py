@@ -0,0 +1,110 @@
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import networkx as nx
+import numpy as np
+from llama_index.core.schema import TextNode
+
+from CallGraph.cg import CGMethodNode
+from functions.my_types import TestCase
+from functions.sbfl import SBFLTable
+
+# e.g. "at org.jfree.chart.plot.CategoryPlot.getRangeAxis(CategoryPlot.java:567)"
+FRAME_PATTERN = re.compile(r"at\s+([\w.$]+)\.([\w$<>]+)\((?:[^:()]*:(\d+))?")
+
+
+def parse_stack_frames(stack_trace: str) -> List[Tuple[str, str, Optional[int]]]:
+    """
+    Get the (class_name, method_name, line) of each frame in a stack trace,
+    the class name is the simple name of the outermost class, i.e. the file name.
+    """
+    frames = []
+    for match in FRAME_PATTERN.finditer(stack_trace or ""):
+        full_class_name, method_name, line = match.groups()
+        class_name = full_class_name.split(".")[-1].split("$")[0]
+        frames.append((class_name, method_name, int(line) if line else None))
+    return frames
+
+
+def get_frame_hits(method_nodes: List[TextNode], test_cases: List[TestCase]) -> np.ndarray:
+    """Whether each method appears in the stack trace of any failing test."""
+    frames: Dict[Tuple[str, str], Set[Optional[int]]] = {}
+    for test_case in test_cases:
+        for class_name, method_name, line in parse_stack_frames(test_case.stack_trace):
+            frames.setdefault((class_name, method_name), set()).add(line)
+
+    hits = np.zeros(len(method_nodes), dtype=np.float64)
+    for i, node in enumerate(method_nodes):
+        class_name = Path(node.metadata["file_path"]).stem
+        lines = frames.get((class_name, node.metadata["method_name"]))
+        if lines is None:
+            continue
+        # overloaded methods are told apart by the line number of the frame
+        start_line, end_line = node.metadata["start_line"], node.metadata["end_line"]
+        if any(line is None or start_line <= line <= end_line for line in lines):
+            hits[i] = 1.0
+    return hits
+
+
+def get_call_distances(
+    method_nodes: List[TextNode],
+    call_graph: nx.DiGraph,
+    cg_to_mn_map: Dict[CGMethodNode, str],
+    test_cases: List[TestCase],
+) -> np.ndarray:
+    """
+    Shortest call distance from the failing test methods to each method, inf if it is
+    not reachable from them.
+    """
+    failing_methods = set(
+        (test_case.test_class_name.split(".")[-1], test_case.test_method_name)
+        for test_case in test_cases
+    )
+    sources = [
+        cg_node for cg_node in call_graph.nodes
+        if (cg_node.class_name.split("$")[0], cg_node.method_name) in failing_methods
+    ]
+    mn_distances: Dict[str, int] = {}
+    if sources:
+        for distance, layer in enumerate(nx.bfs_layers(call_graph, sources)):
+            for cg_node in layer:
+                mn_id = cg_to_mn_map.get(cg_node)
+                if mn_id is not None and mn_id not in mn_distances:
+                    mn_distances[mn_id] = distance
+    return np.array([mn_distances.get(node.id_, np.inf) for node in method_nodes], dtype=np.float64)
+
+
+def rank_methods_for_summary(
+    method_nodes: List[TextNode],
+    call_graph: nx.DiGraph,
+    cg_to_mn_map: Dict[CGMethodNode, str],
+    test_cases: List[TestCase],
+    sbfl_table: Optional[SBFLTable] = None,
+    sbfl_formula: Optional[str] = None,
+) -> List[TextNode]:
+    """
+    Order the method nodes by how likely they are to be faulty, judged without any LLM call:
+
+        priority = stack_frame_hit + sbfl_score / max(sbfl_score) + 1 / (1 + call_distance)
+
+    Test methods are never reported as faulty and are left out.
+    """
+    method_nodes = [node for node in method_nodes if not node.metadata["is_test_method"]]
+    if len(method_nodes) == 0:
+        return []
+    priority = get_frame_hits(method_nodes, test_cases)
+    priority += 1 / (1 + get_call_distances(method_nodes, call_graph, cg_to_mn_map, test_cases))
+    if sbfl_table is not None:
+        sbfl_scores = sbfl_table.method_scores(
+            [
+                (Path(node.metadata["file_path"]).stem, node.metadata["start_line"], node.metadata["end_line"])
+                for node in method_nodes
+            ],
+            sbfl_formula,
+        )
+        if sbfl_scores.max() > 0:
+            priority += sbfl_scores / sbfl_scores.max()
+    # stable sort keeps the call graph order among equal priorities
+    order = np.argsort(-priority, kind="stable")
+    return [method_nodes[i] for i in order]
@@ -2,7 +2,7 @@ import copy
 import os
 import pickle
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 import chromadb
 import more_itertools
@@ -11,7 +11,7 @@ from llama_index.core.schema import TextNode
 from llama_index.core.storage.docstore import SimpleDocumentStore
 from llama_index.vector_stores.chroma import ChromaVectorStore
 from networkx import DiGraph
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import retry, stop_after_attempt
 
 from CallGraph.cg import (
     CGMethodNode,
@@ -27,17 +27,36 @@ from CallGraph.prompt import (
     METHOD_SUMMARIZATION_TEMPLATE,
     OUTPUT_EXAMPLE,
 )
+from functions.my_types import TestFailure
+from functions.sbfl import SBFLTable
+from Retrieve.batch_retriever import BatchedNodeRetriever
+from Retrieve.embedding_cache import QueryEmbeddingCache
 from Storage.node_parser import JavaNodeParser
 from Storage.node_utils import default_id_func, get_node_text_for_embedding
-from Utils.async_utils import asyncio_run, run_jobs_with_rate_limit
-from Utils.model import calculate_in_cost, calculate_out_cost, parse_llm_output
+from Storage.priority import rank_methods_for_summary
+from Utils.async_utils import (
+    AdaptiveRateLimiter,
+    acquire_retry,
+    asyncio_run,
+    run_jobs_with_rate_limit,
+    wait_retry_after,
+)
+from Utils.model import calculate_in_cost_batch, calculate_out_cost
 from Utils.path_manager import PathManager
+from Utils.structured_output import (
+    SUBGRAPH_REPORT_SCHEMA,
+    SUMMARY_SCHEMA,
+    achat_structured,
+)
+
+DEFAULT_LAZY_SUMMARY_TOP_N = 200
 
 
 class HybridStore:
-    def __init__(self, path_manager: PathManager) -> None:
+    def __init__(self, path_manager: PathManager, test_failure: Optional[TestFailure] = None) -> None:
         self.path_manager = path_manager
         self.logger = path_manager.logger
+        self.test_failure = test_failure
         self.src_path = os.path.join(path_manager.buggy_path, path_manager.src_prefix)
         self.test_path = os.path.join(path_manager.buggy_path, path_manager.test_prefix)
         self.init_stores()
@@ -52,22 +71,164 @@ class HybridStore:
         vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
         self.doc_store = doc_store
         self.vector_store = vector_store
+        self.query_embedding_cache = QueryEmbeddingCache(self.path_manager.query_embeddings_file)
         self.use_context = self.path_manager.config.use_context
+        # shared by all summarization stages so the budgets adapt across them
+        self.summary_limiter = AdaptiveRateLimiter(
+            request_limit=self.path_manager.config.models.summary.rate_limit,
+            token_limit=getattr(self.path_manager.config.models.summary, "token_limit", None),
+        )
+        # ask the backend for JSON object responses
+        self.summary_json_mode = getattr(self.path_manager.config.models.summary, "json_mode", False)
+
+        telemetry = self.path_manager.telemetry
+        with telemetry.span("parse") as span:
+            raw_method_nodes = self.get_raw_method_nodes()
+            span["n_nodes"] = len(raw_method_nodes)
+        with telemetry.span("bind") as span:
+            call_graph, binded_method_nodes, cg_to_mn_map = self.bind_call_graph(raw_method_nodes)
+            method_nodes = self.get_method_nodes_from_docstore(binded_method_nodes)
+            span["n_nodes"] = len(method_nodes)
+
+        self.method_nodes = method_nodes
+        self.cg_to_mn_map = cg_to_mn_map
+        self.sub_graphs = []
+        if self.use_context:
+            with telemetry.span("cluster") as span:
+                self.sub_graphs = self.cluster_call_graph(call_graph)
+                span["n_subgraphs"] = len(self.sub_graphs)
+
+        # with lazy summarization only the most suspicious methods are summarized up front,
+        # the rest waits in the queue until retrieval asks for more
+        self.lazy = getattr(self.path_manager.config, "lazy_summarization", False)
+        self.embedded_nodes: List[TextNode] = []
+        # indexes over the embedded nodes, kept up to date by add_embedded_nodes
+        self.node_index: Dict[str, TextNode] = {}
+        self.typed_nodes: Dict[str, List[TextNode]] = {}
+        self._retrievers: Dict[Tuple[str, int], BatchedNodeRetriever] = {}
+        if self.lazy:
+            self.summary_queue = self.rank_methods(call_graph, method_nodes, cg_to_mn_map)
+            top_n = getattr(self.path_manager.config.hyper, "lazy_summary_top_n", DEFAULT_LAZY_SUMMARY_TOP_N)
+            self.expand_summaries(top_n)
+        else:
+            self.summary_queue = []
+            self.summarize_and_embed(method_nodes)
 
-        raw_method_nodes = self.get_raw_method_nodes()
-        call_graph, binded_method_nodes, cg_to_mn_map = self.bind_call_graph(raw_method_nodes)
-        method_nodes = self.get_method_nodes_from_docstore(binded_method_nodes)
+    def rank_methods(self, call_graph, method_nodes, cg_to_mn_map) -> List[TextNode]:
+        """
+        rank the method nodes for lazy summarization by SBFL, call distance and stack traces
+        """
+        test_cases = []
+        if self.test_failure is not None:
+            test_cases = [
+                test_case
+                for test_class in self.test_failure.test_classes
+                for test_case in test_class.test_cases
+            ]
+        sbfl_table = None
+        sbfl_formula = self.path_manager.sbfl_formula
+        if sbfl_formula and os.path.exists(self.path_manager.sbfl_file):
+            sbfl_table = SBFLTable.from_files({sbfl_formula: self.path_manager.sbfl_file})
+        ranked_nodes = rank_methods_for_summary(
+            method_nodes, call_graph, cg_to_mn_map, test_cases, sbfl_table, sbfl_formula
+        )
+        self.logger.info(f"ranked {len(ranked_nodes)} methods for lazy summarization")
+        return ranked_nodes
+
+    def expand_summaries(self, n: int) -> int:
+        """
+        summarize and embed the next n methods of the lazy summarization queue,
+        return the number of methods added
+        """
+        todo_methods = self.summary_queue[:n]
+        self.summary_queue = self.summary_queue[n:]
+        if len(todo_methods) == 0:
+            return 0
+        self.logger.info(
+            f"lazy summarization of {len(todo_methods)} methods, {len(self.summary_queue)} left in queue"
+        )
+        self.summarize_and_embed(todo_methods)
+        return len(todo_methods)
 
+    def ensure_summarized(self, n_methods: int):
+        """
+        make sure at least n_methods non-test methods are summarized, if there are enough
+        """
+        n_summarized = len([
+            node for node in self.typed_nodes.get("method_node", [])
+            if not node.metadata["is_test_method"]
+        ])
+        if n_summarized < n_methods:
+            self.expand_summaries(n_methods - n_summarized)
+
+    def summarize_and_embed(self, method_nodes: List[TextNode]):
+        """
+        summarize the method nodes (with their modules) and add the embedded nodes to the store
+        """
+        telemetry = self.path_manager.telemetry
         # these steps also update the method nodes
         if self.use_context:
-            sub_graphs = self.cluster_call_graph(call_graph)
-            context_nodes = self.subgraphs_summarization(sub_graphs, method_nodes, cg_to_mn_map)
-            desc_nodes = self.methods_summarization(method_nodes)
+            if self.lazy:
+                todo_ids = set(node.id_ for node in method_nodes)
+                sub_graphs = [
+                    subgraph for subgraph in self.sub_graphs
+                    if any(self.cg_to_mn_map.get(nx_node) in todo_ids for nx_node in subgraph.nodes)
+                ]
+            else:
+                sub_graphs = self.sub_graphs
+            with telemetry.span("summarize_context"):
+                # all bound methods are passed since a module may contain methods not summarized yet
+                context_nodes = self.subgraphs_summarization(sub_graphs, self.method_nodes, self.cg_to_mn_map)
+            with telemetry.span("summarize_methods"):
+                desc_nodes = self.methods_summarization(method_nodes)
         else:
             context_nodes = []
-            desc_nodes = self.methods_summarization_no_context(method_nodes)
+            with telemetry.span("summarize_methods"):
+                desc_nodes = self.methods_summarization_no_context(method_nodes)
+
+        with telemetry.span("embed") as span:
+            new_nodes = self.get_node_embeddings(context_nodes, method_nodes, desc_nodes)
+            span["n_nodes"] = len(new_nodes)
+        self.add_embedded_nodes(new_nodes)
+
+    def add_embedded_nodes(self, nodes: List[TextNode]):
+        """
+        add embedded nodes to the store, the retrievers built before are dropped
+        """
+        n_added = 0
+        for node in nodes:
+            # context and description nodes may be shared with the methods summarized before
+            if node.id_ in self.node_index:
+                continue
+            self.node_index[node.id_] = node
+            self.typed_nodes.setdefault(node.metadata["node_type"], []).append(node)
+            self.embedded_nodes.append(node)
+            n_added += 1
+        if n_added > 0:
+            self._retrievers.clear()
+
+    def get_nodes_by_type(self, node_type: str) -> List[TextNode]:
+        """
+        embedded nodes of a type: method_node, context_node or desc_node
+        """
+        nodes = self.typed_nodes.get(node_type, [])
+        if len(nodes) == 0:
+            raise ValueError(f"No {node_type} nodes found")
+        return nodes
 
-        self.embedded_nodes = self.get_node_embeddings(context_nodes, method_nodes, desc_nodes)
+    def get_retriever(self, node_type: str, similarity_top_k: int) -> BatchedNodeRetriever:
+        """
+        retriever over the embedded nodes of a type, built once until new nodes are embedded
+        """
+        key = (node_type, similarity_top_k)
+        if key not in self._retrievers:
+            self._retrievers[key] = BatchedNodeRetriever(
+                self.get_nodes_by_type(node_type),
+                similarity_top_k=similarity_top_k,
+                embed_model=self.query_embedding_cache.embed_model,
+                embedding_cache=self.query_embedding_cache,
+            )
+        return self._retrievers[key]
 
     def cluster_call_graph(self, call_graph):
         """
@@ -183,6 +344,7 @@ class HybridStore:
         tokens = sum([res["tokens"] for res in results])
         cost = sum([res["cost"] for res in results])
         self.logger.info(f"get context nodes with {tokens} tokens and {cost} cost")
+        self.record_usage("context", results, cache_hits=len(context_nodes))
         if self.path_manager.config.mimic:
             return context_nodes
         
@@ -195,38 +357,60 @@ class HybridStore:
         context_nodes.extend(new_context_nodes)
         return context_nodes
 
+    def record_usage(self, stage: str, results: List[Dict], cache_hits: int = 0):
+        """
+        record the tokens and cost of the summarization results in the token ledger
+        """
+        self.path_manager.token_ledger.record(
+            stage,
+            in_tokens=sum([res["in_tokens"] for res in results]),
+            out_tokens=sum([res["out_tokens"] for res in results]),
+            cost=sum([res["cost"] for res in results]),
+            requests=len(results),
+            cache_hits=cache_hits,
+            cached_tokens=sum([res["cached_tokens"] for res in results]),
+        )
+
     async def _asubgraphs_summarization(self, subgraphs: List[DiGraph]):
         jobs = []
-
-        for subgraph in subgraphs:
-            jobs.append(self._asubgraph_summarization(subgraph))
+        job_tokens = []
+        input_texts = [subgraph_to_text(subgraph) for subgraph in subgraphs]
+        in_costs = calculate_in_cost_batch(input_texts)
+        for input_text, (in_tokens, in_cost) in zip(input_texts, in_costs):
+            jobs.append(self._asubgraph_summarization(input_text, in_tokens, in_cost))
+            job_tokens.append(in_tokens)
 
         responses = await run_jobs_with_rate_limit(
             jobs,
-            limit=self.path_manager.config.models.summary.rate_limit,
             desc="Subgraph Summarization",
-            show_progress=True
+            show_progress=True,
+            job_tokens=job_tokens,
+            limiter=self.summary_limiter,
         )
+        self.logger.info(f"subgraph summarization throughput: {self.summary_limiter.throughput}")
         return responses
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(3))
-    async def _asubgraph_summarization(self, subgraph: DiGraph):
-        input_text = subgraph_to_text(subgraph)
+    @retry(stop=stop_after_attempt(3), wait=wait_retry_after(), before=acquire_retry)
+    async def _asubgraph_summarization(self, input_text: str, in_tokens: int, in_cost: float):
         messages = METHOD_CALL_SUBGRAPH_SUMMARIZATION_TEMPLATE.format_messages(
             input_text=input_text
         )
-        in_tokens, in_cost = calculate_in_cost(input_text)
+        usage = {"cached_tokens": 0}
         if self.path_manager.config.mimic:
             # For mimic
             json_res = OUTPUT_EXAMPLE
             json_res["title"] = input_text
         else:
-            response = await Settings.llm.achat(messages)
-            json_res = parse_llm_output(response.message.content)
+            json_res = await achat_structured(
+                Settings.llm, messages, SUBGRAPH_REPORT_SCHEMA, json_mode=self.summary_json_mode, usage=usage
+            )
         out_tokens, out_cost = calculate_out_cost(str(json_res))
         return {
             "tokens": in_tokens + out_tokens,
+            "in_tokens": in_tokens,
+            "out_tokens": out_tokens,
             "cost": in_cost + out_cost,
+            "cached_tokens": usage["cached_tokens"],
             "response": json_res
         }
 
@@ -416,6 +600,7 @@ class HybridStore:
         tokens = sum([res["tokens"] for res in results])
         cost = sum([res["cost"] for res in results])
         self.logger.info(f"get description nodes with {tokens} tokens and {cost} cost")
+        self.record_usage("description", results, cache_hits=len(method_nodes) - len(todo_methods))
         
         if self.path_manager.config.mimic:
             return desc_nodes
@@ -462,35 +647,56 @@ class HybridStore:
 
     async def _amethods_summarization(self, method_nodes, method_contexts):
         jobs = []
-        for i in range(len(method_nodes)):
-            jobs.append(self._amethod_summarization(method_nodes[i], method_contexts[i]))
-        responses = await run_jobs_with_rate_limit(
+        job_tokens = []
+        # the methods of a module share its context as prompt prefix, dispatching them
+        # together lets the provider serve the prefix from its cache
+        order = sorted(
+            range(len(method_nodes)),
+            key=lambda i: method_contexts[i].id_ if method_contexts[i] is not None else ""
+        )
+        input_texts = [
+            prepare_method_summarization_input(method_nodes[i], method_contexts[i])
+            for i in order
+        ]
+        in_costs = calculate_in_cost_batch(input_texts)
+        for input_text, (in_tokens, in_cost) in zip(input_texts, in_costs):
+            jobs.append(self._amethod_summarization(input_text, in_tokens, in_cost))
+            job_tokens.append(in_tokens)
+        ordered_responses = await run_jobs_with_rate_limit(
             jobs,
-            limit=self.path_manager.config.models.summary.rate_limit,
             desc="Method Summarization",
-            show_progress=True
+            show_progress=True,
+            job_tokens=job_tokens,
+            limiter=self.summary_limiter,
         )
+        self.logger.info(f"method summarization throughput: {self.summary_limiter.throughput}")
+        responses = [None] * len(method_nodes)
+        for i, response in zip(order, ordered_responses):
+            responses[i] = response
         return responses
 
-    @retry(stop=stop_after_attempt(3), wait=wait_fixed(3))
-    async def _amethod_summarization(self, method_node, method_context):
-        input_text = prepare_method_summarization_input(method_node, method_context)
+    @retry(stop=stop_after_attempt(3), wait=wait_retry_after(), before=acquire_retry)
+    async def _amethod_summarization(self, input_text: str, in_tokens: int, in_cost: float):
         messages = METHOD_SUMMARIZATION_TEMPLATE.format_messages(
             input_text=input_text
         )
-        in_tokens, in_cost = calculate_in_cost(input_text)
+        usage = {"cached_tokens": 0}
         # For mimic
         if self.path_manager.config.mimic:
             json_res = METHOD_SUMMARIZATION_EXAMPLE
             json_res["title"] = input_text
         else:
-            response = await Settings.llm.achat(messages)
-            json_res = parse_llm_output(response.message.content)
+            json_res = await achat_structured(
+                Settings.llm, messages, SUMMARY_SCHEMA, json_mode=self.summary_json_mode, usage=usage
+            )
         out_tokens, out_cost = calculate_out_cost(str(json_res))
         return {
             "response": json_res,
             "tokens": in_tokens + out_tokens,
-            "cost": in_cost + out_cost
+            "in_tokens": in_tokens,
+            "out_tokens": out_tokens,
+            "cost": in_cost + out_cost,
+            "cached_tokens": usage["cached_tokens"]
         }
 
     def build_description_nodes(self, method_nodes, responses, no_context=False):
@@ -557,12 +763,23 @@ class HybridStore:
         else:
             no_embeded_nodes = all_nodes
         self.logger.info(f"found {len(all_nodes) - len(no_embeded_nodes)} nodes already embedded")
+        self.path_manager.token_ledger.record(
+            "embedding",
+            requests=len(no_embeded_nodes),
+            cache_hits=len(all_nodes) - len(no_embeded_nodes),
+        )
 
         if self.path_manager.config.mimic:
             all_text = [get_node_text_for_embedding(node, self.use_context) for node in all_nodes]
-            all_costs = [calculate_in_cost(text, price_per_1m_tokens=0.02) for text in all_text]
+            all_costs = calculate_in_cost_batch(all_text, price_per_1m_tokens=0.02)
             tokens, cost = zip(*all_costs)
             self.logger.info(f"mimic cost: {sum(tokens)} tokens, {sum(cost)} money")
+            self.path_manager.token_ledger.record(
+                "embedding",
+                in_tokens=sum(tokens),
+                cost=sum(cost),
+                requests=0,
+            )
         
         if len(no_embeded_nodes) == 0:
             return all_nodes
@@ -1,12 +1,25 @@
 import asyncio
-from typing import Any, Coroutine, List, Optional, TypeVar
-
-from aiolimiter import AsyncLimiter
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Coroutine, Dict, List, Optional, TypeVar
 
 T = TypeVar("T")
 
 DEFAULT_RATELIMIT = 50
 DEFAULT_NUM_WORKERS = 4
+DEFAULT_TIME_PERIOD = 60.0
+DEFAULT_RETRY_WAIT = 3.0
+MIN_LIMIT_SCALE = 0.1
+LIMIT_DECREASE_FACTOR = 0.5
+LIMIT_INCREASE_STEP = 0.05
+
+# the limiter and prompt tokens of the job running in the current task,
+# used by `wait_retry_after` and `acquire_retry`
+_current_limiter: ContextVar[Optional["AdaptiveRateLimiter"]] = ContextVar(
+    "current_limiter", default=None
+)
+_current_tokens: ContextVar[int] = ContextVar("current_tokens", default=0)
 
 
 def asyncio_run(coro: Coroutine) -> Any:
@@ -17,34 +30,239 @@ def asyncio_run(coro: Coroutine) -> Any:
     try:
         # Check if there's an existing event loop
         loop = asyncio.get_event_loop()
+    except RuntimeError:
+        # If we can't get the event loop, we're likely in a different thread
+        return asyncio.run(coro)
 
-        # If we're here, there's an existing loop but it's not running
-        return loop.run_until_complete(coro)
+    if loop.is_closed():
+        return asyncio.run(coro)
 
-    except RuntimeError as e:
-        # If we can't get the event loop, we're likely in a different thread, or its already running
-        try:
-            return asyncio.run(coro)
-        except RuntimeError as e:
-            raise RuntimeError(
-                "Detected nested async. Please use nest_asyncio.apply() to allow nested event loops."
-                "Or, use async entry methods like `aquery()`, `aretriever`, `achat`, etc."
+    if loop.is_running():
+        coro.close()
+        raise RuntimeError(
+            "Detected nested async. Please use nest_asyncio.apply() to allow nested event loops."
+            "Or, use async entry methods like `aquery()`, `aretriever`, `achat`, etc."
+        )
+    # errors raised by the coroutine itself are propagated as they are
+    return loop.run_until_complete(coro)
+
+
+class AdaptiveRateLimiter:
+    """Leaky-bucket limiter that budgets both requests and tokens per time period.
+
+    Every acquisition consumes one request and the given number of (prompt) tokens.
+    When the provider answers with HTTP 429, all acquisitions are paused for the
+    retry-after interval and the effective budgets are halved; each successful
+    request then recovers the budgets additively up to the configured limits.
+    """
+
+    def __init__(
+        self,
+        request_limit: float = DEFAULT_RATELIMIT,
+        token_limit: Optional[float] = None,
+        time_period: float = DEFAULT_TIME_PERIOD,
+    ):
+        self.request_limit = request_limit
+        self.token_limit = token_limit
+        self.time_period = time_period
+        self.scale = 1.0
+        self.n_rate_limited = 0
+        self._request_level = 0.0
+        self._token_level = 0.0
+        self._last_drain = time.monotonic()
+        self._blocked_until = 0.0
+        self._backoff = DEFAULT_RETRY_WAIT
+        self._history = deque()  # (timestamp, tokens) of the acquisitions in the last period
+
+    @property
+    def effective_request_limit(self) -> float:
+        return max(1.0, self.request_limit * self.scale)
+
+    @property
+    def effective_token_limit(self) -> Optional[float]:
+        if self.token_limit is None:
+            return None
+        return max(1.0, self.token_limit * self.scale)
+
+    @property
+    def throughput(self) -> Dict[str, float]:
+        """Requests and tokens acquired during the last time period, and the current budgets."""
+        self._trim_history(time.monotonic())
+        return {
+            "requests_per_period": len(self._history),
+            "tokens_per_period": sum(tokens for _, tokens in self._history),
+            "request_limit": self.effective_request_limit,
+            "token_limit": self.effective_token_limit,
+            "rate_limited": self.n_rate_limited,
+        }
+
+    def _trim_history(self, now: float):
+        while self._history and now - self._history[0][0] > self.time_period:
+            self._history.popleft()
+
+    def _drain(self, now: float):
+        elapsed = now - self._last_drain
+        self._last_drain = now
+        self._request_level = max(
+            0.0, self._request_level - elapsed * self.effective_request_limit / self.time_period
+        )
+        if self.token_limit is not None:
+            self._token_level = max(
+                0.0, self._token_level - elapsed * self.effective_token_limit / self.time_period
             )
 
+    def _get_wait_time(self, tokens: int, now: float) -> float:
+        if self._blocked_until > now:
+            return self._blocked_until - now
+        wait_time = 0.0
+        request_limit = self.effective_request_limit
+        if self._request_level + 1 > request_limit:
+            excess = self._request_level + 1 - request_limit
+            wait_time = excess * self.time_period / request_limit
+        token_limit = self.effective_token_limit
+        # a single request larger than the whole budget is let through once the bucket is empty
+        if token_limit is not None and self._token_level > 0 and self._token_level + tokens > token_limit:
+            excess = self._token_level + tokens - token_limit
+            wait_time = max(wait_time, excess * self.time_period / token_limit)
+        return wait_time
+
+    async def acquire(self, tokens: int = 0):
+        while True:
+            now = time.monotonic()
+            self._drain(now)
+            wait_time = self._get_wait_time(tokens, now)
+            if wait_time <= 0:
+                break
+            await asyncio.sleep(wait_time)
+        self._request_level += 1
+        self._token_level += tokens
+        self._history.append((now, tokens))
+        self._trim_history(now)
+
+    def report_success(self):
+        self._backoff = DEFAULT_RETRY_WAIT
+        self.scale = min(1.0, self.scale + LIMIT_INCREASE_STEP)
+
+    def report_rate_limit(self, retry_after: Optional[float] = None) -> float:
+        """Pause all acquisitions and shrink the budgets, returns the seconds to wait."""
+        self.n_rate_limited += 1
+        if retry_after is None:
+            retry_after = self._backoff
+            self._backoff = min(self._backoff * 2, self.time_period)
+        self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        self.scale = max(MIN_LIMIT_SCALE, self.scale * LIMIT_DECREASE_FACTOR)
+        return retry_after
+
+
+def is_rate_limit_error(error: Optional[BaseException]) -> bool:
+    if error is None:
+        return False
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code == 429 or type(error).__name__ == "RateLimitError"
+
+
+def get_retry_after(error: Optional[BaseException]) -> Optional[float]:
+    """Read the retry-after(-ms) header from the http response attached to the error."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def _report_rate_limit(limiter: AdaptiveRateLimiter, error: BaseException) -> float:
+    """Report a rate limit error to the limiter once, even if it is seen again up the stack."""
+    if getattr(error, "_rate_limit_reported", False):
+        return max(0.0, limiter._blocked_until - time.monotonic())
+    error._rate_limit_reported = True
+    return limiter.report_rate_limit(get_retry_after(error))
+
+
+def wait_retry_after(fallback: float = DEFAULT_RETRY_WAIT):
+    """Tenacity wait strategy honouring the retry-after header of rate limit errors.
+
+    Rate limit errors are reported to the limiter of the running job (see
+    `run_jobs_with_rate_limit`), so that the other jobs back off as well.
+    """
+
+    def wait(retry_state) -> float:
+        error = retry_state.outcome.exception()
+        if not is_rate_limit_error(error):
+            return fallback
+        limiter = _current_limiter.get()
+        if limiter is not None:
+            return _report_rate_limit(limiter, error)
+        retry_after = get_retry_after(error)
+        return retry_after if retry_after is not None else fallback
+
+    return wait
+
+
+async def acquire_retry(retry_state):
+    """Tenacity `before` hook making every retried attempt acquire the job's limiter again.
+
+    The first attempt is acquired by `run_jobs_with_rate_limit` itself, e.g.:
+
+        @retry(stop=stop_after_attempt(3), wait=wait_retry_after(), before=acquire_retry)
+        async def _aquery_generation(self, test_case): ...
+    """
+    limiter = _current_limiter.get()
+    if limiter is not None and retry_state.attempt_number > 1:
+        await limiter.acquire(_current_tokens.get())
+
 
 async def run_jobs_with_rate_limit(
     jobs,
     limit=DEFAULT_RATELIMIT,
     desc="",
     show_progress=False,
+    token_limit: Optional[float] = None,
+    job_tokens: Optional[List[int]] = None,
+    limiter: Optional[AdaptiveRateLimiter] = None,
 ):
-    limiter = AsyncLimiter(limit)
+    """Run jobs under a request (and optionally token) budget per minute.
 
-    async def worker(job: Coroutine):
-        async with limiter:
-            return await job
+    Args:
+        jobs (List[Coroutine]):
+            List of jobs to run.
+        limit (float):
+            Maximum number of requests per minute.
+        token_limit (Optional[float]):
+            Maximum number of prompt tokens per minute, no token budget if None.
+        job_tokens (Optional[List[int]]):
+            Number of prompt tokens of each job.
+        limiter (Optional[AdaptiveRateLimiter]):
+            Share an existing limiter instead of creating one from the limits.
+    """
+    if limiter is None:
+        limiter = AdaptiveRateLimiter(limit, token_limit)
+    if job_tokens is None:
+        job_tokens = [0] * len(jobs)
 
-    pool_jobs = [worker(job) for job in jobs]
+    async def worker(job: Coroutine, tokens: int):
+        _current_limiter.set(limiter)
+        _current_tokens.set(tokens)
+        await limiter.acquire(tokens)
+        try:
+            result = await job
+        except Exception as e:
+            if is_rate_limit_error(e):
+                _report_rate_limit(limiter, e)
+            raise
+        limiter.report_success()
+        return result
+
+    # start the jobs in list order, tqdm gathers them through an unordered set otherwise,
+    # and callers order the jobs to group those sharing a prompt prefix
+    pool_jobs = [asyncio.ensure_future(worker(job, tokens)) for job, tokens in zip(jobs, job_tokens)]
 
     if show_progress:
         from tqdm.asyncio import tqdm_asyncio
@@ -2,6 +2,10 @@ import os
 
 
 class WorkDir():
+    """
+    Change the working directory of the whole process inside the context. Not safe with
+    threads, pass `cwd=` to the subprocess instead where possible.
+    """
     def __init__(self, path):
         self.work_dir = path
         self.cwd = os.getcwd()
@@ -14,6 +18,5 @@ class WorkDir():
     
     def __exit__(self, exc_type, exc_value, traceback):
         os.chdir(self.cwd)
-        return True
-
-
+        # propagate the exceptions raised inside the context
+        return False
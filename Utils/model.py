@@ -1,9 +1,7 @@
-import json
 import sys
 from pathlib import Path
 
 import httpx
-import tiktoken
 from cohere import Client
 from llama_index.core import Settings
 from llama_index.embeddings.jinaai import JinaEmbedding
@@ -15,6 +13,8 @@ from llama_index.postprocessor.jinaai_rerank import JinaRerank
 
 sys.path.append(Path(__file__).resolve().parents[1].as_posix())
 from Utils.path_manager import PathManager
+from Utils.structured_output import parse_json_object
+from Utils.token_counter import count_tokens, count_tokens_batch
 
 DEFAULT_TIMEOUT = 120
 
@@ -104,45 +104,14 @@ def get_embedding_reranker(path_manager: PathManager):
 
 
 def parse_llm_output(content: str):
-    try:
-        content1 = content.replace("```json", "").replace("```", "")
-        res = json.loads(content1)
-        return res
-    except Exception as e:
-        print(content)
-        if e.msg == "Expecting ',' delimiter":
-            content2 = content1[: e.pos - 1] + '\\"' + content1[e.pos :]
-            return parse_llm_output(content2)
-        elif e.msg == "Expecting value":
-            last_comma_index = content1.rfind(",", 0, e.pos)
-            content2 = (
-                content1[:last_comma_index] + content1[last_comma_index + 1 :]
-            )
-            return parse_llm_output(content2)
-        elif e.msg == "Invalid \\escape":
-            content2 = content1[: e.pos] + "\\\\" + content1[e.pos + 1 :]
-            return parse_llm_output(content2)
-        elif e.msg == "Invalid control character at":
-            if content1[e.pos] == "\n":
-                content2 = content1[: e.pos] + '",' + content1[e.pos + 1 :]
-            else:
-                content2 = (
-                    content1[: e.pos]
-                    + "(control character)"
-                    + content1[e.pos + 1 :]
-                )
-            return parse_llm_output(content2)
-        else:
-            print(e)
-            raise ValueError("Invalid JSON response from LLM: \n" + content)
+    """Parse the JSON object of an LLM response, repairing common format errors in one pass."""
+    return parse_json_object(content)
 
 
 def calculate_in_cost(
     text, model_name="gpt-3.5-turbo", price_per_1m_tokens=0.13699
 ):
-    enc = tiktoken.encoding_for_model(model_name)
-    tokens = enc.encode(text)
-    token_count = len(tokens)
+    token_count = count_tokens(text, model_name)
     cost = (token_count / 1000000) * price_per_1m_tokens
     return token_count, cost
 
@@ -150,8 +119,20 @@ def calculate_in_cost(
 def calculate_out_cost(
     text, model_name="gpt-3.5-turbo", price_per_1m_tokens=0.27397
 ):
-    enc = tiktoken.encoding_for_model(model_name)
-    tokens = enc.encode(text)
-    token_count = len(tokens)
+    token_count = count_tokens(text, model_name)
     cost = (token_count / 1000000) * price_per_1m_tokens
     return token_count, cost
+
+
+def calculate_in_cost_batch(
+    texts, model_name="gpt-3.5-turbo", price_per_1m_tokens=0.13699
+):
+    token_counts = count_tokens_batch(texts, model_name)
+    return [(n, (n / 1000000) * price_per_1m_tokens) for n in token_counts]
+
+
+def calculate_out_cost_batch(
+    texts, model_name="gpt-3.5-turbo", price_per_1m_tokens=0.27397
+):
+    token_counts = count_tokens_batch(texts, model_name)
+    return [(n, (n / 1000000) * price_per_1m_tokens) for n in token_counts]
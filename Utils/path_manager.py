@@ -8,11 +8,16 @@ from time import time
 
 import yaml
 
+from Utils.telemetry import Telemetry
+from Utils.token_counter import TokenLedger
+
 DEFAULT_VECTOR_STORE_NAME = "chroma"
 DEFAULT_PERSIST_FNAME = "docstore.json"
 
 log_config = {
     'version': 1,
+    # keep the loggers of the bugs created before
+    'disable_existing_loggers': False,
     'formatters': {
         'simple': {
             'format': '%(levelname)s - %(asctime)s - %(message)s',
@@ -26,18 +31,10 @@ log_config = {
             'level': 'DEBUG',
             'stream': 'ext://sys.stdout',
         },
-        'file': {
-            'class': 'logging.FileHandler',
-            'formatter': 'simple',
-            'level': 'DEBUG',
-            'filename': '',
-            'mode': 'w',
-            'encoding': 'utf-8',
-        }
     },
     'loggers': {
         'default': {
-            'handlers': ['file', 'console'],
+            'handlers': ['console'],
             'level': 'DEBUG'
         },
     }
@@ -78,21 +75,37 @@ class PathManager():
             f"{args.project}-{args.bugID}")
         self.retrieved_nodes_file = os.path.join(self.res_path, "retrieved_nodes.pkl")
         self.res_file = os.path.join(self.res_path, "result.json")
+        self.token_ledger_file = os.path.join(self.res_path, "token_ledger.json")
+        self.telemetry_file = os.path.join(self.res_path, "telemetry.jsonl")
+        self.cmd_log_dir = os.path.join(self.res_path, "cmd_logs")
         self.projects_path = os.path.join(self.root_path, "Projects")
         self.bug_path = os.path.join(self.projects_path, args.project, str(args.bugID))
         self.test_failure_file = os.path.join(self.bug_path, "test_failure.pkl")
         self.method_nodes_file = os.path.join(self.bug_path, "nodes.pkl")
+        self.build_state_file = os.path.join(self.bug_path, "build_state.json")
+        self.buggy_methods_file = os.path.join(self.bug_path, "buggy_methods.pkl")
         self.proj_tmp_path = os.path.join(
             self.output_path,
             self.config_hash,
             f"{args.version}-{args.project}-{args.bugID}"
         )
+        # pristine checkouts shared by all configs, copied into proj_tmp_path for each run
+        self.checkout_cache_path = os.path.join(
+            self.root_path,
+            "Checkouts",
+            f"{args.version}",
+            args.project,
+            str(args.bugID)
+        )
         self.buggy_path = os.path.join(self.proj_tmp_path, "buggy")
         self.fixed_path = os.path.join(self.proj_tmp_path, "fixed")
         if self.subproj:
             self.buggy_path = os.path.join(self.buggy_path, self.subproj)
             self.fixed_path = os.path.join(self.fixed_path, self.subproj)
 
+        # tokens and cost spent in each stage
+        self.token_ledger = TokenLedger()
+
         # temp paths for each test case
         self.test_cache_dir = None
         self.failed_test_names = []
@@ -135,6 +148,13 @@ class PathManager():
         )
         if not os.path.exists(self.vector_stores_dir):
             os.makedirs(self.vector_stores_dir, exist_ok=True)
+        # query embeddings shared by all bugs, keyed by the embedding model and the query mode,
+        # the caches of earlier versions hold document-mode embeddings and are not reused
+        self.query_embeddings_file = os.path.join(
+            self.root_path,
+            "QueryEmbeddings",
+            f"{self.config.models.embed.cache_name}.query.pkl"
+        )
 
         # dependencies
         self.agent_lib = self.config.dependencies.agent_lib
@@ -161,10 +181,27 @@ class PathManager():
                 f"{self.sbfl_formula}.ranking.csv"
             )
 
-        # init logger with time
-        log_config['handlers']['file']['filename'] = os.path.join(self.res_path, f"{int(time())}.log")
-        logging.config.dictConfig(log_config)
-        self.logger = logging.getLogger("default")
+        # per-stage spans, the run id matches the log file name
+        self.run_id = str(int(time()))
+        self.telemetry = Telemetry(self.telemetry_file, self.token_ledger, self.run_id)
+
+        # init logger with time, each bug logs to its own file so that bugs can run concurrently
+        if not logging.getLogger("default").handlers:
+            # configure once, a re-configuration would drop the handlers of existing bugs
+            logging.config.dictConfig(log_config)
+        self.logger = logging.getLogger(f"default.{self.config_name}.{self.bug_name}")
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        file_handler = logging.FileHandler(
+            os.path.join(self.res_path, f"{self.run_id}.log"), mode="w", encoding="utf-8"
+        )
+        file_handler.setFormatter(logging.Formatter(
+            log_config['formatters']['simple']['format'],
+            datefmt=log_config['formatters']['simple']['datefmt'],
+        ))
+        file_handler.setLevel(logging.DEBUG)
+        self.logger.addHandler(file_handler)
 
     def get_class_file(self, class_name):
         class_file = os.path.join(self.buggy_path,
@@ -0,0 +1,327 @@
+import json
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from llama_index.core.llms import LLM, ChatMessage
+
+from Utils.token_counter import get_cached_tokens
+
+DEFAULT_MAX_REPAIRS = 1
+JSON_ESCAPES = set('"\\/bfnrtu')
+HEX_DIGITS = set("0123456789abcdefABCDEF")
+CLOSERS = {"{": "}", "[": "]"}
+JSON_LITERALS = ("true", "false", "null")
+
+REPAIR_PROMPT = """Your answer is missing the following fields or they are not valid: {fields}.
+Respond with a JSON object containing only these fields, without any other content."""
+
+
+@dataclass(frozen=True)
+class Field:
+    name: str
+    type: type
+    # required keys of the items of a list of objects
+    item_keys: Tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class OutputSchema:
+    name: str
+    fields: Tuple[Field, ...]
+    # other complete answers, e.g. the diagnose agent may request more context instead
+    alternatives: Tuple["OutputSchema", ...] = ()
+
+
+SUMMARY_SCHEMA = OutputSchema(
+    "summary",
+    (Field("functionality", str), Field("description", list)),
+)
+SUBGRAPH_REPORT_SCHEMA = OutputSchema(
+    "subgraph_report",
+    (Field("title", str), Field("summary", str), Field("findings", list, ("summary", "explanation"))),
+)
+DIAGNOSE_END_SCHEMA = OutputSchema(
+    "diagnose_end",
+    (Field("context", str), Field("functionality", str), Field("logic", str)),
+)
+DIAGNOSE_SCHEMA = OutputSchema(
+    "diagnose",
+    DIAGNOSE_END_SCHEMA.fields,
+    (OutputSchema("request", (Field("request", str),)),),
+)
+RERANK_SCHEMA = OutputSchema(
+    "rerank",
+    (Field("Reason", str), Field("Score", float)),
+)
+
+
+def _skip_spaces(text: str, i: int) -> int:
+    while i < len(text) and text[i].isspace():
+        i += 1
+    return i
+
+
+def _is_key(text: str, i: int) -> bool:
+    """Whether the string starting at i is an object key, i.e. followed by ':' (or truncated)."""
+    i += 1
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+            continue
+        if text[i] == '"':
+            i = _skip_spaces(text, i + 1)
+            return i >= len(text) or text[i] == ":"
+        i += 1
+    return True
+
+
+def _is_literal(text: str, i: int) -> bool:
+    for literal in JSON_LITERALS:
+        if text.startswith(literal, i):
+            end = i + len(literal)
+            return end >= len(text) or not (text[end].isalnum() or text[end] == "_")
+    return False
+
+
+def _is_closing_quote(text: str, pos: int, in_array: bool = False) -> bool:
+    """
+    Whether the quote at pos ends a JSON string, judged by what follows it. A following
+    comma only ends the string if the next token can follow it: a quoted key and ':' in
+    an object, a value (e.g. true/false/null) in an array. So the string goes on in
+    "He said "hi", then left" and "the "flag", false by default".
+    """
+    n = len(text)
+    i = _skip_spaces(text, pos + 1)
+    if i >= n or text[i] in "}]:":
+        return True
+    if text[i] != ",":
+        return False
+    i = _skip_spaces(text, i + 1)
+    if i >= n or text[i] in "}]":
+        return True
+    if in_array:
+        return text[i] in '"{[-' or text[i].isdigit() or _is_literal(text, i)
+    return text[i] == '"' and _is_key(text, i)
+
+
+def repair_json(content: str) -> str:
+    """
+    Extract the first JSON object of an LLM response and repair it in one pass:
+    code fences and surrounding text are dropped, invalid escapes, raw control
+    characters and unescaped quotes inside strings are escaped, trailing commas
+    are removed and a truncated object is closed.
+    """
+    start = content.find("{")
+    if start == -1:
+        raise ValueError("No JSON object in LLM response: \n" + content)
+    out: List[str] = []
+    stack: List[str] = []
+    in_string = False
+    i = start
+    n = len(content)
+    while i < n:
+        c = content[i]
+        if in_string:
+            if c == "\\":
+                nxt = content[i + 1] if i + 1 < n else ""
+                if nxt == "u" and i + 6 <= n and all(ch in HEX_DIGITS for ch in content[i + 2:i + 6]):
+                    out.append(content[i:i + 6])
+                    i += 6
+                    continue
+                if nxt in JSON_ESCAPES and nxt != "u":
+                    out.append(c + nxt)
+                    i += 2
+                    continue
+                out.append("\\\\")
+            elif c == '"':
+                if _is_closing_quote(content, i, in_array=bool(stack) and stack[-1] == "]"):
+                    in_string = False
+                    out.append(c)
+                else:
+                    out.append('\\"')
+            elif c == "\n":
+                out.append("\\n")
+            elif c == "\t":
+                out.append("\\t")
+            elif ord(c) < 0x20:
+                out.append(f"\\u{ord(c):04x}")
+            else:
+                out.append(c)
+        elif c == '"':
+            in_string = True
+            out.append(c)
+        elif c in CLOSERS:
+            stack.append(CLOSERS[c])
+            out.append(c)
+        elif c in "}]":
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            out.append(c)
+            if stack:
+                stack.pop()
+            if not stack:
+                return "".join(out)
+        elif c == "`":
+            # a code fence inside the object, i.e. the object is truncated
+            break
+        else:
+            out.append(c)
+        i += 1
+
+    # truncated response, close what is still open
+    if in_string:
+        out.append('"')
+    while out and (out[-1].isspace() or out[-1] in ",:"):
+        out.pop()
+    out.extend(reversed(stack))
+    return "".join(out)
+
+
+def parse_json_object(content: str) -> Dict[str, Any]:
+    repaired = repair_json(content)
+    try:
+        result = json.loads(repaired)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Invalid JSON response from LLM ({e}): \n" + content) from e
+    if not isinstance(result, dict):
+        raise ValueError("Invalid JSON response from LLM: \n" + content)
+    return result
+
+
+def _coerce(value: Any, field: Field) -> Optional[Any]:
+    """Convert a value to the type of the field, None if it cannot be."""
+    if value is None:
+        return None
+    if field.type is str:
+        if isinstance(value, str):
+            return value if value.strip() else None
+        return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+    if field.type is float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+    if field.type is list:
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except json.JSONDecodeError:
+                value = [value]
+        if not isinstance(value, list):
+            value = [value]
+        if field.item_keys and not all(
+            isinstance(item, dict) and all(key in item for key in field.item_keys)
+            for item in value
+        ):
+            return None
+        return value
+    return value if isinstance(value, field.type) else None
+
+
+def validate_output(result: Dict[str, Any], schema: OutputSchema) -> Tuple[Dict[str, Any], List[str]]:
+    """
+    Coerce the fields of a parsed response to the schema, keys are matched case-insensitively.
+    Returns the valid fields and the names of the missing or invalid ones.
+    """
+    for alternative in schema.alternatives:
+        valid, missing = validate_output(result, alternative)
+        if not missing:
+            return valid, []
+    keys = {key.lower(): key for key in result}
+    valid = {}
+    missing = []
+    for field in schema.fields:
+        key = field.name if field.name in result else keys.get(field.name.lower())
+        value = _coerce(result.get(key), field) if key is not None else None
+        if value is None:
+            missing.append(field.name)
+        else:
+            valid[field.name] = value
+    return valid, missing
+
+
+def _add_usage(usage: Optional[Dict[str, int]], response: Any):
+    if usage is not None:
+        usage["cached_tokens"] = usage.get("cached_tokens", 0) + get_cached_tokens(response)
+
+
+def _get_chat_kwargs(json_mode: bool) -> Dict[str, Any]:
+    return {"response_format": {"type": "json_object"}} if json_mode else {}
+
+
+def _get_repair_request(
+    messages: List[ChatMessage],
+    content: str,
+    schema: OutputSchema,
+    missing: List[str],
+) -> Tuple[List[ChatMessage], OutputSchema]:
+    repair_messages = list(messages) + [
+        ChatMessage(role="assistant", content=content),
+        ChatMessage(role="user", content=REPAIR_PROMPT.format(fields=", ".join(missing))),
+    ]
+    repair_schema = OutputSchema(schema.name, tuple(f for f in schema.fields if f.name in missing))
+    return repair_messages, repair_schema
+
+
+async def achat_structured(
+    llm: LLM,
+    messages: List[ChatMessage],
+    schema: OutputSchema,
+    json_mode: bool = False,
+    max_repairs: int = DEFAULT_MAX_REPAIRS,
+    usage: Optional[Dict[str, int]] = None,
+) -> Dict[str, Any]:
+    """
+    Chat and parse the response against the schema. With json_mode the backend is asked
+    for a JSON object response (OpenAI-compatible response_format). If some fields are
+    missing, only these fields are asked for again in the same dialog, instead of
+    repeating the whole request. The prompt tokens served from the provider's prefix
+    cache are added to usage["cached_tokens"].
+    """
+    kwargs = _get_chat_kwargs(json_mode)
+    response = await llm.achat(messages, **kwargs)
+    _add_usage(usage, response)
+    content = response.message.content
+    valid, missing = validate_output(parse_json_object(content), schema)
+    for _ in range(max_repairs):
+        if not missing:
+            break
+        repair_messages, repair_schema = _get_repair_request(messages, content, schema, missing)
+        response = await llm.achat(repair_messages, **kwargs)
+        _add_usage(usage, response)
+        content = response.message.content
+        repaired, missing = validate_output(parse_json_object(content), repair_schema)
+        valid.update(repaired)
+    if missing:
+        raise ValueError(f"LLM response misses the {schema.name} fields {missing}")
+    return valid
+
+
+def chat_structured(
+    llm: LLM,
+    messages: List[ChatMessage],
+    schema: OutputSchema,
+    json_mode: bool = False,
+    max_repairs: int = DEFAULT_MAX_REPAIRS,
+    usage: Optional[Dict[str, int]] = None,
+) -> Dict[str, Any]:
+    """Blocking version of `achat_structured`, safe to call from worker threads."""
+    kwargs = _get_chat_kwargs(json_mode)
+    response = llm.chat(messages, **kwargs)
+    _add_usage(usage, response)
+    content = response.message.content
+    valid, missing = validate_output(parse_json_object(content), schema)
+    for _ in range(max_repairs):
+        if not missing:
+            break
+        repair_messages, repair_schema = _get_repair_request(messages, content, schema, missing)
+        response = llm.chat(repair_messages, **kwargs)
+        _add_usage(usage, response)
+        content = response.message.content
+        repaired, missing = validate_output(parse_json_object(content), repair_schema)
+        valid.update(repaired)
+    if missing:
+        raise ValueError(f"LLM response misses the {schema.name} fields {missing}")
+    return valid
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from Utils.token_counter import LEDGER_FIELDS, TokenLedger
+
+
+class Telemetry:
+    """Write one JSON line per pipeline stage (span) to a per-bug telemetry file.
+
+    Each span records its monotonic duration and the requests, cache hits, tokens,
+    provider-cached prompt tokens and cost added to the token ledger while it was open.
+    The caller may add extra fields to the yielded dict, e.g.:
+
+        with path_manager.telemetry.span("embed") as span:
+            ...
+            span["n_nodes"] = len(all_nodes)
+    """
+
+    def __init__(self, telemetry_file: str, token_ledger: TokenLedger, run_id: Optional[str] = None):
+        self.telemetry_file = telemetry_file
+        self.token_ledger = token_ledger
+        self.run_id = run_id if run_id is not None else str(int(time.time()))
+        self._lock = threading.Lock()
+
+    def _ledger_totals(self) -> Dict[str, float]:
+        totals = dict.fromkeys(LEDGER_FIELDS, 0)
+        for entry in self.token_ledger.to_dict().values():
+            for k in LEDGER_FIELDS:
+                totals[k] += entry[k]
+        return totals
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[Dict[str, Any]]:
+        record: Dict[str, Any] = {}
+        status = "ok"
+        start_totals = self._ledger_totals()
+        start_time = time.time()
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            end_totals = self._ledger_totals()
+            span = {
+                "run_id": self.run_id,
+                "span": name,
+                "status": status,
+                "start": start_time,
+                "duration": duration,
+            }
+            for k in LEDGER_FIELDS:
+                span[k] = end_totals[k] - start_totals[k]
+            span.update(attrs)
+            span.update(record)
+            n_lookups = span["requests"] + span["cache_hits"]
+            span["cache_hit_rate"] = span["cache_hits"] / n_lookups if n_lookups else None
+            self.emit(span)
+
+    def emit(self, span: Dict[str, Any]):
+        with self._lock:
+            with open(self.telemetry_file, "a") as f:
+                f.write(json.dumps(span) + "\n")
+
+
+def read_spans(telemetry_file: str, last_run_only: bool = True) -> List[Dict[str, Any]]:
+    """Read the spans of a telemetry file, by default only those of the latest run."""
+    with open(telemetry_file, "r") as f:
+        spans = [json.loads(line) for line in f if line.strip()]
+    if last_run_only and spans:
+        last_run_id = spans[-1]["run_id"]
+        spans = [span for span in spans if span["run_id"] == last_run_id]
+    return spans
+
+
+def aggregate_spans(spans: List[Dict[str, Any]], field: str = "duration") -> Dict[str, float]:
+    """Sum a field of the successful spans by stage name."""
+    totals: Dict[str, float] = {}
+    for span in spans:
+        if span["status"] != "ok":
+            continue
+        # spans written before a field was added count as 0
+        totals[span["span"]] = totals.get(span["span"], 0) + span.get(field, 0)
+    return totals
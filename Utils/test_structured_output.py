@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+sys.path.append(Path(__file__).resolve().parents[1].as_posix())
+from Utils.structured_output import parse_json_object
+
+
+def test_unescaped_quote_before_comma():
+    result = parse_json_object('{"a": "He said "hi", then left"}')
+    assert result == {"a": 'He said "hi", then left'}
+
+
+def test_unescaped_quote_before_literal_word():
+    result = parse_json_object('{"logic": "the "flag", false by default, is ignored", "context": "x"}')
+    assert result == {"logic": 'the "flag", false by default, is ignored', "context": "x"}
+
+
+def test_quote_before_next_key():
+    result = parse_json_object('{"functionality": "parses "dates"", "description": ["a", "b", 1]}')
+    assert result == {"functionality": 'parses "dates"', "description": ["a", "b", 1]}
+
+
+def test_quote_before_literal_value():
+    result = parse_json_object('{"description": ["a", true, "b", null], "context": "x"}')
+    assert result == {"description": ["a", True, "b", None], "context": "x"}
+
+
+if __name__ == "__main__":
+    test_unescaped_quote_before_comma()
+    test_unescaped_quote_before_literal_word()
+    test_quote_before_next_key()
+    test_quote_before_literal_value()
@@ -0,0 +1,114 @@
+import json
+import threading
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List
+
+import tiktoken
+
+DEFAULT_ENCODING = "cl100k_base"
+DEFAULT_ENCODE_THREADS = 8
+LEDGER_FIELDS = ["requests", "cache_hits", "in_tokens", "out_tokens", "cost", "cached_tokens"]
+
+
+@lru_cache(maxsize=None)
+def get_encoder(model_name: str) -> tiktoken.Encoding:
+    """Get the (cached) tiktoken encoder of a model.
+
+    Models unknown to tiktoken (e.g. deepseek-chat) fall back to the default encoding.
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text: str, model_name: str = "gpt-3.5-turbo") -> int:
+    return len(get_encoder(model_name).encode(text, disallowed_special=()))
+
+
+def encode_batch(
+    texts: Iterable[str],
+    model_name: str = "gpt-3.5-turbo",
+    num_threads: int = DEFAULT_ENCODE_THREADS,
+) -> List[List[int]]:
+    return get_encoder(model_name).encode_batch(
+        list(texts), num_threads=num_threads, disallowed_special=()
+    )
+
+
+def count_tokens_batch(
+    texts: Iterable[str],
+    model_name: str = "gpt-3.5-turbo",
+    num_threads: int = DEFAULT_ENCODE_THREADS,
+) -> List[int]:
+    return [len(tokens) for tokens in encode_batch(texts, model_name, num_threads)]
+
+
+def _get_field(obj: Any, key: str) -> Any:
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
+
+
+def get_cached_tokens(response: Any) -> int:
+    """
+    Prompt tokens of a chat response served from the provider's prefix cache, 0 if not reported.
+    OpenAI reports them in usage.prompt_tokens_details.cached_tokens, DeepSeek in
+    usage.prompt_cache_hit_tokens.
+    """
+    usage = _get_field(getattr(response, "raw", None), "usage")
+    cached_tokens = _get_field(_get_field(usage, "prompt_tokens_details"), "cached_tokens")
+    if cached_tokens is None:
+        cached_tokens = _get_field(usage, "prompt_cache_hit_tokens")
+    return int(cached_tokens or 0)
+
+
+class TokenLedger:
+    """Thread-safe record of the requests, tokens and cost spent in each stage.
+
+    e.g.:
+        {
+            "diagnose": {"requests": 3, "cache_hits": 1, "in_tokens": 9120, "out_tokens": 410, "cost": 0.0013,
+                         "cached_tokens": 6400}
+        }
+
+    cache_hits counts the requests answered from our own caches, cached_tokens the prompt
+    tokens the provider served from its prefix cache.
+    """
+
+    def __init__(self):
+        self._stages: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        stage: str,
+        in_tokens: int = 0,
+        out_tokens: int = 0,
+        cost: float = 0.0,
+        requests: int = 1,
+        cache_hits: int = 0,
+        cached_tokens: int = 0,
+    ):
+        with self._lock:
+            entry = self._stages.setdefault(stage, dict.fromkeys(LEDGER_FIELDS, 0))
+            entry["requests"] += requests
+            entry["cache_hits"] += cache_hits
+            entry["cached_tokens"] += cached_tokens
+            entry["in_tokens"] += in_tokens
+            entry["out_tokens"] += out_tokens
+            entry["cost"] += cost
+
+    def get(self, stage: str) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._stages.get(stage, dict.fromkeys(LEDGER_FIELDS, 0)))
+
+    def to_dict(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {stage: dict(entry) for stage, entry in self._stages.items()}
+
+    def dump(self, ledger_file: str):
+        with open(ledger_file, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
@@ -1,13 +1,19 @@
+import asyncio
 import copy
+import hashlib
 import json
 import os
 import pickle
+import queue
 import re
 import shutil
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from numpy import full
 
@@ -22,36 +28,143 @@ from functions.line_parser import (
     parse_test_report,
     parse_test_run_log,
     read_text,
+    split_test_reports,
 )
 from functions.MethodExtractor.java_method_extractor import JavaMethodExtractor
 from functions.my_types import JMethod, TestCase, TestClass, TestFailure
-from functions.utils import auto_read, clean_doc, git_clean, run_cmd
-from Utils.context_manager import WorkDir
+from functions.utils import arun_cmd, auto_read, clean_doc, git_clean, run_cmd
+from Utils.async_utils import asyncio_run
 from Utils.path_manager import PathManager
 
 filepath = os.path.dirname(__file__)
 root = os.path.dirname(filepath)
 directory = os.path.join(root, "DebugResult")
+# serializes the read-modify-write of the build state file across test worker threads
+BUILD_STATE_LOCK = threading.Lock()
+# files written to the checkout root by `defects4j test` and the classtracer agent
+TEST_OUTPUT_FILES = ["failing_tests", "all_tests", "callgraph.graphml", "loaded_classes.txt", "calltrace.txt"]
+
+
+def checkout_version(path_manager: PathManager, version: str, work_path: str):
+    """
+    Check out the buggy (version "b") or fixed (version "f") project version to `work_path`.
+    """
+    cmd = f"{path_manager.bug_exec} checkout -p {path_manager.project} -v {path_manager.bug_id}{version} -w {work_path}"
+    if path_manager.subproj:
+        cmd += f" -s {path_manager.subproj}"
+    run_cmd(cmd, log_file=os.path.join(path_manager.cmd_log_dir, f"checkout_{version}.log"), check=True)
+
+
+def get_cached_checkout(path_manager: PathManager, version: str) -> str:
+    """
+    Get the pristine checkout of a project version from the checkout cache, populating
+    it on the first use. Concurrent runs (processes or threads) check out to their own
+    temp directory and only the first one is renamed into the cache.
+    """
+    cache_path = os.path.join(path_manager.checkout_cache_path, version)
+    if os.path.exists(cache_path):
+        return cache_path
+    os.makedirs(path_manager.checkout_cache_path, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    checkout_version(path_manager, version, tmp_path)
+    if not os.path.exists(os.path.join(tmp_path, path_manager.subproj)):
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise FileNotFoundError(f"Checkout Error: {tmp_path} not exists.")
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # populated by another run in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return cache_path
 
 
 def check_out(path_manager: PathManager):
+    """
+    Check out the buggy and fixed versions to the temp path of this run. With the
+    `checkout_cache` option they are copy-on-write copies of the cached checkouts.
+    """
     if os.path.exists(path_manager.method_nodes_file):
         callgraph_files = list(Path(path_manager.bug_path).rglob("callgraph.graphml"))
         if len(callgraph_files) > 0:
             return
-    with WorkDir(path_manager.proj_tmp_path):
-        if not os.path.exists(path_manager.buggy_path):
-            if path_manager.subproj:
-                run_cmd(f"{path_manager.bug_exec} checkout -p {path_manager.project} -v {path_manager.bug_id}b -w buggy -s {path_manager.subproj}")
-            else:
-                run_cmd(f"{path_manager.bug_exec} checkout -p {path_manager.project} -v {path_manager.bug_id}b -w buggy")
-        if not os.path.exists(path_manager.fixed_path):
-            if path_manager.subproj:
-                run_cmd(f"{path_manager.bug_exec} checkout -p {path_manager.project} -v {path_manager.bug_id}f -w fixed -s {path_manager.subproj}")
-            else:
-                run_cmd(f"{path_manager.bug_exec} checkout -p {path_manager.project} -v {path_manager.bug_id}f -w fixed")
-    if not os.path.exists(path_manager.buggy_path) or not os.path.exists(path_manager.fixed_path):
-        raise FileNotFoundError(f"Checkout Error: {path_manager.buggy_path} or {path_manager.fixed_path} not exists.")
+    versions = ["b"]
+    # the fixed version is only needed if the buggy methods can not be built from the patch
+    if not (getattr(path_manager.config, "fixed_from_patch", False) and get_fix_patch_file(path_manager)):
+        versions.append("f")
+    with ThreadPoolExecutor(max_workers=len(versions)) as executor:
+        list(executor.map(lambda version: check_out_version(path_manager, version), versions))
+
+
+def check_out_version(path_manager: PathManager, version: str):
+    """
+    Check out the buggy (version "b") or fixed (version "f") version to the temp path of this run.
+    """
+    work_path = path_manager.buggy_path if version == "b" else path_manager.fixed_path
+    if os.path.exists(work_path):
+        return
+    use_cache = getattr(path_manager.config, "checkout_cache", False)
+    copy_mode = getattr(path_manager.config, "checkout_copy_mode", "reflink")
+    os.makedirs(path_manager.proj_tmp_path, exist_ok=True)
+    # the checkout root, which is the parent of the subproject if any
+    checkout_path = os.path.join(path_manager.proj_tmp_path, "buggy" if version == "b" else "fixed")
+    if use_cache:
+        copy_checkout(get_cached_checkout(path_manager, version), checkout_path, copy_mode)
+    else:
+        checkout_version(path_manager, version, checkout_path)
+    if not os.path.exists(work_path):
+        raise FileNotFoundError(f"Checkout Error: {work_path} not exists.")
+
+
+def get_build_hash(path_manager: PathManager, work_path: str) -> Optional[str]:
+    """
+    Hash the path, size and mtime of every source and compiled class file of a checkout,
+    which changes whenever the sources are edited or the compiled classes are removed.
+    None if a source or class directory is missing, i.e. the checkout is not built.
+    """
+    md5_hash = hashlib.md5()
+    for prefix in [path_manager.src_prefix, path_manager.test_prefix,
+                   path_manager.src_class_prefix, path_manager.test_class_prefix]:
+        prefix_path = os.path.join(work_path, prefix)
+        if not os.path.isdir(prefix_path):
+            return None
+        for root_dir, dirs, files in os.walk(prefix_path):
+            dirs.sort()
+            for file in sorted(files):
+                stat = os.stat(os.path.join(root_dir, file))
+                md5_hash.update(f"{os.path.relpath(os.path.join(root_dir, file), work_path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode("utf-8"))
+    return md5_hash.hexdigest()
+
+
+def record_build_state(path_manager: PathManager, work_path: str):
+    build_hash = get_build_hash(path_manager, work_path)
+    if build_hash is None:
+        return
+    with BUILD_STATE_LOCK:
+        build_state = {}
+        if os.path.exists(path_manager.build_state_file):
+            with open(path_manager.build_state_file, "r") as f:
+                build_state = json.load(f)
+        build_state[work_path] = build_hash
+        with open(path_manager.build_state_file, "w") as f:
+            json.dump(build_state, f, indent=4)
+
+
+def compile_if_needed(path_manager: PathManager, work_path: str = None):
+    """
+    Compile a checkout unless it is unchanged since its last compilation.
+    """
+    work_path = work_path or path_manager.buggy_path
+    if os.path.exists(path_manager.build_state_file):
+        with BUILD_STATE_LOCK:
+            with open(path_manager.build_state_file, "r") as f:
+                build_state = json.load(f)
+        if work_path in build_state and build_state[work_path] == get_build_hash(path_manager, work_path):
+            path_manager.logger.info(f"{work_path} already compiled, skip!")
+            return
+    run_cmd(f"{path_manager.bug_exec} compile -w {work_path}",
+            log_file=os.path.join(path_manager.cmd_log_dir, "compile.log"))
+    record_build_state(path_manager, work_path)
 
 
 def run_single_test(test_case: TestCase, path_manager: PathManager):
@@ -69,8 +182,10 @@ def run_single_test(test_case: TestCase, path_manager: PathManager):
         return test_output, stack_trace
     
     git_clean(path_manager.buggy_path)
-    out, err = run_cmd(f"{path_manager.bug_exec} compile -w {path_manager.buggy_path}")
-    out, err = run_cmd(f"timeout 90 {path_manager.bug_exec} test -n -t {test_case.name} -w {path_manager.buggy_path}")
+    compile_if_needed(path_manager)
+    out, err = run_cmd(f"{path_manager.bug_exec} test -n -t {test_case.name} -w {path_manager.buggy_path}",
+                       timeout=90,
+                       log_file=os.path.join(test_output_dir, "d4j_test.log"))
     with open(f"{path_manager.buggy_path}/failing_tests", "r") as f:
         test_res = f.readlines()
     test_output, stack_trace = parse_test_report(test_res)
@@ -80,30 +195,67 @@ def run_single_test(test_case: TestCase, path_manager: PathManager):
         f.writelines(stack_trace)
     return test_output, stack_trace
 
-def run_test_with_instrument(test_case: TestCase, path_manager: PathManager):
-    loaded_classes_file = os.path.join(path_manager.test_cache_dir, "loaded_classes.txt")
-    calltrace_file = os.path.join(path_manager.test_cache_dir, "callgraph.graphml")
-    test_output_file = os.path.join(path_manager.test_cache_dir, "test_output.txt")
-    stack_trace_file = os.path.join(path_manager.test_cache_dir, "stack_trace.txt")
-    all_files = [loaded_classes_file, calltrace_file, test_output_file, stack_trace_file]
-    src_class_path = os.path.join(path_manager.buggy_path, path_manager.src_class_prefix)
+def get_instrument_files(test_cache_dir: str) -> List[str]:
+    return [
+        os.path.join(test_cache_dir, "loaded_classes.txt"),
+        os.path.join(test_cache_dir, "callgraph.graphml"),
+        os.path.join(test_cache_dir, "test_output.txt"),
+        os.path.join(test_cache_dir, "stack_trace.txt"),
+    ]
+
+
+def is_instrumented(test_cache_dir: str) -> bool:
+    """
+    Whether a test has been run with instrumentation, either alone or in a batch whose
+    call graph and loaded classes are saved in the parent (test class) directory.
+    """
+    loaded_classes_file, calltrace_file, test_output_file, stack_trace_file = get_instrument_files(test_cache_dir)
+    if not (os.path.exists(test_output_file) and os.path.exists(stack_trace_file)):
+        return False
+    if os.path.exists(loaded_classes_file) and os.path.exists(calltrace_file):
+        return True
+    batch_dir = os.path.dirname(test_cache_dir)
+    return (os.path.exists(os.path.join(batch_dir, "loaded_classes.txt"))
+            and os.path.exists(os.path.join(batch_dir, "callgraph.graphml")))
+
+
+def run_test_with_instrument(test_case: TestCase,
+                             path_manager: PathManager,
+                             test_cache_dir: str = None,
+                             work_path: str = None):
+    """
+    Run a failing test with the classtracer javaagent in `work_path` (the buggy checkout
+    by default) and save its call graph, loaded classes and report to `test_cache_dir`.
+    """
+    test_cache_dir = test_cache_dir or path_manager.test_cache_dir
+    work_path = work_path or path_manager.buggy_path
+    all_files = get_instrument_files(test_cache_dir)
+    loaded_classes_file, calltrace_file, test_output_file, stack_trace_file = all_files
+    src_class_path = os.path.join(work_path, path_manager.src_class_prefix)
     class_path = os.path.dirname(src_class_path)
 
-    if (all(os.path.exists(f) for f in all_files)):
+    if is_instrumented(test_cache_dir):
         path_manager.logger.info("instrumentation already done, skip!")
     else:
-        shutil.rmtree(path_manager.test_cache_dir, ignore_errors=True)
-        os.makedirs(path_manager.test_cache_dir, exist_ok=True)
-        git_clean(path_manager.buggy_path)
+        shutil.rmtree(test_cache_dir, ignore_errors=True)
+        os.makedirs(test_cache_dir, exist_ok=True)
+        git_clean(work_path)
+        # unlink the outputs of the last run, so that neither a stale report is read
+        # nor a hard linked copy writes through to the original checkout
+        for output_file in TEST_OUTPUT_FILES:
+            if os.path.exists(os.path.join(work_path, output_file)):
+                os.remove(os.path.join(work_path, output_file))
         cmd = f"{path_manager.bug_exec} test -n "\
             f"-t {test_case.name} "\
             f"-a -Djvmargs=-javaagent:{path_manager.agent_lib}=classesPath={class_path}"
-        with WorkDir(path_manager.buggy_path):
-            run_cmd(cmd)
-            shutil.copy(f"{path_manager.buggy_path}/callgraph.graphml", path_manager.test_cache_dir)
-            shutil.copy(f"{path_manager.buggy_path}/loaded_classes.txt", path_manager.test_cache_dir)
-            shutil.rmtree(os.path.join(path_manager.test_cache_dir, "calltrace.txt"), ignore_errors=True)
-        with open(f"{path_manager.buggy_path}/failing_tests", "r") as f:
+        run_cmd(cmd,
+                cwd=work_path,
+                timeout=getattr(path_manager.config.hyper, "test_timeout", None),
+                log_file=os.path.join(test_cache_dir, "d4j_test.log"))
+        shutil.copy(f"{work_path}/callgraph.graphml", test_cache_dir)
+        shutil.copy(f"{work_path}/loaded_classes.txt", test_cache_dir)
+        shutil.rmtree(os.path.join(test_cache_dir, "calltrace.txt"), ignore_errors=True)
+        with open(f"{work_path}/failing_tests", "r") as f:
             test_res = f.readlines()
         test_output, stack_trace = parse_test_report(test_res)
         with open(test_output_file, "w") as f:
@@ -116,6 +268,85 @@ def run_test_with_instrument(test_case: TestCase, path_manager: PathManager):
     test_case.stack_trace = read_text(stack_trace_file, max_lines=50)
 
 
+def run_tests_with_instrument_batch(test_cases: List[TestCase],
+                                    path_manager: PathManager,
+                                    test_cache_dirs: List[str],
+                                    work_path: str = None):
+    """
+    Run the failing tests of one test class with the classtracer javaagent in a single
+    JVM, which relies on the `forkmode="once"` junit task of the BenchmarkMode/*-jvm-mod
+    frameworks.
+
+    The agent traces the whole JVM, so the call graph and loaded classes are shared by
+    the batch and saved in the test class directory, while the failing_tests report is
+    split into the directory of each test.
+    """
+    work_path = work_path or path_manager.buggy_path
+    test_class_name = test_cases[0].test_class_name
+    assert all(test_case.test_class_name == test_class_name for test_case in test_cases)
+    batch_dir = os.path.dirname(test_cache_dirs[0])
+    src_class_path = os.path.join(work_path, path_manager.src_class_prefix)
+    class_path = os.path.dirname(src_class_path)
+
+    for test_cache_dir in test_cache_dirs:
+        shutil.rmtree(test_cache_dir, ignore_errors=True)
+        os.makedirs(test_cache_dir, exist_ok=True)
+    git_clean(work_path)
+    for output_file in TEST_OUTPUT_FILES:
+        if os.path.exists(os.path.join(work_path, output_file)):
+            os.remove(os.path.join(work_path, output_file))
+    test_methods = ",".join(test_case.test_method_name for test_case in test_cases)
+    cmd = f"{path_manager.bug_exec} test -n "\
+        f"-t {test_class_name}::{test_methods} "\
+        f"-a -Djvmargs=-javaagent:{path_manager.agent_lib}=classesPath={class_path}"
+    run_cmd(cmd,
+            cwd=work_path,
+            timeout=getattr(path_manager.config.hyper, "test_timeout", None),
+            log_file=os.path.join(batch_dir, "d4j_test.log"))
+    shutil.copy(f"{work_path}/callgraph.graphml", batch_dir)
+    shutil.copy(f"{work_path}/loaded_classes.txt", batch_dir)
+    with open(f"{work_path}/failing_tests", "r") as f:
+        reports = split_test_reports(f.readlines())
+
+    for test_case, test_cache_dir in zip(test_cases, test_cache_dirs):
+        if test_case.name not in reports:
+            # e.g. the test only fails when it runs alone
+            path_manager.logger.warning(f"{test_case.name} not failed in batch, run it alone")
+            run_test_with_instrument(test_case, path_manager, test_cache_dir, work_path)
+            continue
+        loaded_classes_file, calltrace_file, test_output_file, stack_trace_file = get_instrument_files(test_cache_dir)
+        test_output, stack_trace = parse_test_report(reports[test_case.name])
+        with open(test_output_file, "w") as f:
+            f.writelines(test_output)
+        with open(stack_trace_file, "w") as f:
+            f.writelines(stack_trace)
+        assert is_instrumented(test_cache_dir)
+        test_case.test_output = read_text(test_output_file, max_lines=100)
+        test_case.stack_trace = read_text(stack_trace_file, max_lines=50)
+
+
+def copy_checkout(src_path: str, dst_path: str, copy_mode: str = "reflink"):
+    """
+    Make a working copy of a (compiled) checkout for running tests in isolation.
+
+    copy_mode:
+        reflink: copy-on-write copy where the file system supports it, a full copy otherwise
+        hardlink: hard link every file, only safe if the checkout is already compiled
+        copy: full copy
+    """
+    shutil.rmtree(dst_path, ignore_errors=True)
+    if copy_mode == "hardlink":
+        run_cmd(f"cp -al {src_path} {dst_path}", check=True)
+    elif copy_mode == "reflink":
+        run_cmd(f"cp -a --reflink=auto {src_path} {dst_path}", check=True)
+    elif copy_mode == "copy":
+        shutil.copytree(src_path, dst_path, symlinks=True)
+    else:
+        raise ValueError(f"Unknown copy mode: {copy_mode}")
+    if not os.path.exists(dst_path):
+        raise FileNotFoundError(f"Copy Error: {dst_path} not exists.")
+
+
 def get_test_method(path_manager: PathManager,
                     test_class_name: str,
                     test_method_name: str):
@@ -155,87 +386,210 @@ def get_test_method(path_manager: PathManager,
             raise ValueError(f"Error: No method named {test_method_name} in {test_file}.")
 
 
+def get_fix_patch_file(path_manager: PathManager) -> str:
+    """
+    The source patch of a bug in the framework, e.g.
+    defects4j/framework/projects/Chart/patches/1.src.patch
+    """
+    framework_path = os.path.dirname(os.path.dirname(path_manager.bug_exec))
+    patch_file = os.path.join(framework_path, "projects", path_manager.project, "patches", f"{path_manager.bug_id}.src.patch")
+    return patch_file if os.path.exists(patch_file) else None
+
+
+def get_patched_files(patch_file: str) -> List[str]:
+    patched_files = []
+    with open(patch_file, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f.readlines():
+            if line.startswith("--- ") or line.startswith("+++ "):
+                file = line[4:].strip().split("\t")[0]
+                if file == "/dev/null":
+                    continue
+                if file.startswith("a/") or file.startswith("b/"):
+                    file = file[2:]
+                if file not in patched_files:
+                    patched_files.append(file)
+    return patched_files
+
+
+def get_fixed_files_from_patch(path_manager: PathManager, fixed_dir: str) -> str:
+    """
+    Rebuild the fixed version of the patched files under `fixed_dir`. The buggy version of
+    a bug is its fixed revision with the source patch applied, so the patch is reverted on
+    copies of the buggy files. Return the directory which the patch paths are relative
+    to, or None if the patch can not be reverted. Raise CmdError if applying a patch
+    that passed the check fails.
+    """
+    patch_file = get_fix_patch_file(path_manager)
+    if patch_file is None:
+        return None
+    patched_files = get_patched_files(patch_file)
+    checkout_path = os.path.join(path_manager.proj_tmp_path, "buggy")
+    # the patch paths may be relative to the checkout root or to the subproject
+    for base_path in [checkout_path, path_manager.buggy_path]:
+        if any(os.path.exists(os.path.join(base_path, file)) for file in patched_files):
+            break
+    else:
+        return None
+    for file in patched_files:
+        if os.path.exists(os.path.join(base_path, file)):
+            os.makedirs(os.path.dirname(os.path.join(fixed_dir, file)), exist_ok=True)
+            shutil.copy(os.path.join(base_path, file), os.path.join(fixed_dir, file))
+    # fall back to applying the patch in case a framework stores it the other way around
+    for reverse_flag in [" -R", ""]:
+        # judged by the exit code, git apply also writes warnings (e.g. whitespace) on success
+        check_result = asyncio_run(arun_cmd(f"git apply --check{reverse_flag} {patch_file}", cwd=fixed_dir))
+        if check_result.returncode == 0:
+            run_cmd(f"git apply{reverse_flag} {patch_file}", cwd=fixed_dir, check=True)
+            return base_path
+    return None
+
+
 def get_modified_methods(path_manager: PathManager):
+    """
+    Get the methods changed by the fix as the ground truth, cached per bug. With the
+    `fixed_from_patch` option the fixed files are rebuilt from the framework patch,
+    otherwise (or if that fails) they are read from the fixed checkout.
+    """
+    if os.path.exists(path_manager.buggy_methods_file):
+        with open(path_manager.buggy_methods_file, "rb") as f:
+            return pickle.load(f)
+
     buggy_path = path_manager.buggy_path
     fixed_path = path_manager.fixed_path
     src_path = path_manager.src_prefix
     modified_classes = path_manager.modified_classes
     buggy_methods = []
 
-    for class_name in modified_classes:
-        if class_name.endswith(".txt"):
-            continue
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        patch_base_path = None
+        if getattr(path_manager.config, "fixed_from_patch", False):
+            patch_base_path = get_fixed_files_from_patch(path_manager, tmp_dir)
+            if patch_base_path is None:
+                path_manager.logger.warning("failed to revert the fix patch, check out the fixed version")
+        if patch_base_path is None:
+            check_out_version(path_manager, "f")
+
+        for class_name in modified_classes:
+            if class_name.endswith(".txt"):
+                continue
         
-        # fix errors in GrowingBugs
-        if path_manager.project == "IO":
-            extra_prefix = src_path.replace("/", ".") + "."
-            class_name = class_name.replace(extra_prefix, "")
-        elif path_manager.project == "Dagger_core":
-            extra_prefix = "core."
-            class_name = class_name.replace(extra_prefix, "")
+            # fix errors in GrowingBugs
+            if path_manager.project == "IO":
+                extra_prefix = src_path.replace("/", ".") + "."
+                class_name = class_name.replace(extra_prefix, "")
+            elif path_manager.project == "Dagger_core":
+                extra_prefix = "core."
+                class_name = class_name.replace(extra_prefix, "")
         
-        buggy_file = os.path.join(buggy_path,
-                                  src_path,
-                                  class_name.replace(".", "/") + ".java")
-
-        fixed_file = os.path.join(fixed_path,
-                                  src_path,
-                                  class_name.replace(".", "/") + ".java")
+            buggy_file = os.path.join(buggy_path,
+                                      src_path,
+                                      class_name.replace(".", "/") + ".java")
+
+            fixed_file = os.path.join(fixed_path,
+                                      src_path,
+                                      class_name.replace(".", "/") + ".java")
+            if patch_base_path is not None:
+                # files untouched by the patch are the same in both versions
+                fixed_file = os.path.join(tmp_dir, os.path.relpath(buggy_file, patch_base_path))
+                if not os.path.exists(fixed_file):
+                    fixed_file = buggy_file
         
-        if not (os.path.exists(fixed_file) and os.path.exists(buggy_file)):
-            raise FileNotFoundError(f"Warning: {fixed_file} or {buggy_file} not exists.")
+            if not (os.path.exists(fixed_file) and os.path.exists(buggy_file)):
+                raise FileNotFoundError(f"Warning: {fixed_file} or {buggy_file} not exists.")
         
-        buggy_code = auto_read(buggy_file)
+            buggy_code = auto_read(buggy_file)
         
-        fixed_code = auto_read(fixed_file)
-
-        function_extractor = JavaMethodExtractor()
-        methods = function_extractor.get_buggy_methods(buggy_code, fixed_code)
-        for method in methods:
-            method.class_full_name = class_name
-            method.text = method.text.replace("\r", "")
-        buggy_methods.extend(methods)
+            fixed_code = auto_read(fixed_file)
+
+            function_extractor = JavaMethodExtractor()
+            methods = function_extractor.get_buggy_methods(buggy_code, fixed_code)
+            for method in methods:
+                method.class_full_name = class_name
+                method.text = method.text.replace("\r", "")
+            buggy_methods.extend(methods)
+
+    with open(path_manager.buggy_methods_file, "wb") as f:
+        pickle.dump(buggy_methods, f)
     return buggy_methods
 
 
+def read_build_properties(work_path: str) -> Dict[str, str]:
+    """
+    Read the `defects4j.build.properties` file written by the checkout, e.g.:
+
+        d4j.classes.modified=org.jfree.chart.renderer.category.AbstractCategoryItemRenderer
+        d4j.dir.src.classes=source
+        d4j.dir.src.tests=tests
+        d4j.tests.trigger=org.jfree.chart.renderer.category.junit.AbstractCategoryItemRendererTests::test2947660
+
+    ==> {"classes.modified": "org.jfree...", "dir.src.classes": "source", ...}
+    """
+    properties_file = os.path.join(work_path, "defects4j.build.properties")
+    build_properties = {}
+    if not os.path.exists(properties_file):
+        return build_properties
+    with open(properties_file, "r") as f:
+        for line in f.readlines():
+            line = line.strip()
+            if line.startswith("#") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            key = key.strip()
+            if key.startswith("d4j."):
+                key = key[len("d4j."):]
+            build_properties[key] = value.strip()
+    return build_properties
+
+
 def get_properties(path_manager: PathManager):
     """
     Retrieves properties related to the project.
+
+    The properties stored in `defects4j.build.properties` are read from the file, only
+    the remaining ones are exported, concurrently.
     """
+    compiled = False
     if os.path.exists(os.path.join(path_manager.bug_path, "properties.json")):
         with open(os.path.join(path_manager.bug_path, "properties.json"), "r") as f:
             properties = json.load(f)
     else:
         properties = {}
-        
+        property_names = {
+            "failed_test_names": "tests.trigger",
+            "src_class_prefix": "dir.bin.classes",
+            "test_class_prefix": "dir.bin.tests",
+            "src_prefix": "dir.src.classes",
+            "test_prefix": "dir.src.tests",
+            "modified_classes": "classes.modified",
+        }
+        list_properties = ["failed_test_names", "modified_classes"]
+
         # for some project such as Pool we have to compile first
         cmd = f"{path_manager.bug_exec} compile -w {path_manager.buggy_path}"
-        out, err = run_cmd(cmd)
-        
-        cmd = f"{path_manager.bug_exec} export -p tests.trigger -w {path_manager.buggy_path}"
-        out, err = run_cmd(cmd)
-        properties["failed_test_names"] = out.split("\n")
-        
-        cmd = f"{path_manager.bug_exec} export -p dir.bin.classes -w {path_manager.buggy_path}"
-        out, err = run_cmd(cmd)
-        properties["src_class_prefix"] = out
-        
-        cmd = f"{path_manager.bug_exec} export -p dir.bin.tests -w {path_manager.buggy_path}"
-        out, err = run_cmd(cmd)
-        properties["test_class_prefix"] = out
-
-        cmd = f"{path_manager.bug_exec} export -p dir.src.classes -w {path_manager.buggy_path}"
-        out, err = run_cmd(cmd)
-        properties["src_prefix"] = out
-
-        cmd = f"{path_manager.bug_exec} export -p dir.src.tests -w {path_manager.buggy_path}"
-        out, err = run_cmd(cmd)
-        properties["test_prefix"] = out
-
-        cmd = f"{path_manager.bug_exec} export -p classes.modified -w {path_manager.buggy_path}"
-        out, err = run_cmd(cmd)
-        properties["modified_classes"] = out.split("\n")
-    
+        out, err = run_cmd(cmd, log_file=os.path.join(path_manager.cmd_log_dir, "compile.log"))
+        compiled = True
+
+        build_properties = read_build_properties(path_manager.buggy_path)
+        for key, d4j_property in property_names.items():
+            if d4j_property in build_properties:
+                value = build_properties[d4j_property]
+                properties[key] = value.split(",") if key in list_properties else value
+
+        async def aexport_properties(keys: List[str]):
+            results = await asyncio.gather(*[
+                arun_cmd(f"{path_manager.bug_exec} export -p {property_names[key]} -w {path_manager.buggy_path}")
+                for key in keys
+            ])
+            return {
+                key: result.out.split("\n") if key in list_properties else result.out
+                for key, result in zip(keys, results)
+            }
+
+        export_keys = [key for key in property_names if key not in properties]
+        properties.update(asyncio_run(aexport_properties(export_keys)))
+
+        # keep the key order of the exported file
+        properties = {key: properties[key] for key in property_names}
         with open(os.path.join(path_manager.bug_path, "properties.json"), "w") as f:
             json.dump(properties, f, indent=4)
     
@@ -245,6 +599,8 @@ def get_properties(path_manager: PathManager):
     path_manager.src_prefix = properties["src_prefix"]
     path_manager.test_prefix = properties["test_prefix"]
     path_manager.modified_classes = properties["modified_classes"]
+    if compiled:
+        record_build_state(path_manager, path_manager.buggy_path)
 
 
 def get_failed_tests(path_manager: PathManager) -> TestFailure:
@@ -254,7 +610,7 @@ def get_failed_tests(path_manager: PathManager) -> TestFailure:
     try:
         with open(path_manager.test_failure_file, "rb") as f:
             test_failure = pickle.load(f)
-            print(f"Load cached TestFailure object from {path_manager.test_failure_file}")
+            path_manager.logger.info(f"Load cached TestFailure object from {path_manager.test_failure_file}")
             return test_failure
     except FileNotFoundError:
         pass
@@ -399,16 +755,92 @@ def run_all_tests(path_manager: PathManager, test_failure: TestFailure):
     """
     Extract loaded java classes for a test suite (witch may contains multiple test methods)
     according to the method coverage information.
-    """
 
+    With `hyper.batch_instrument` the uncached tests of each test class run in one JVM.
+    With `hyper.test_workers` > 1 the uncached tests (or batches) run in parallel, each
+    worker in its own copy of the compiled buggy checkout.
+    """
+    workers = getattr(path_manager.config.hyper, "test_workers", 1)
+    batch = getattr(path_manager.config.hyper, "batch_instrument", False)
+    jobs = []
     for test_class in test_failure.test_classes:
         path_manager.logger.info(f"test class: {path_manager.project}-{path_manager.bug_id} {test_class.name}")
+        class_jobs = []
         for test_case in test_class.test_cases:
-            path_manager.logger.info(f"\u14AA test case: {path_manager.project}-{path_manager.bug_id} {test_case.name}")
             test_cache_dir = os.path.join(path_manager.bug_path, test_class.name, test_case.name)
             os.makedirs(test_cache_dir, exist_ok=True)
-            path_manager.test_cache_dir = test_cache_dir
-            run_test_with_instrument(test_case, path_manager)
+            if is_instrumented(test_cache_dir):
+                path_manager.logger.info(f"\u14AA test case: {path_manager.project}-{path_manager.bug_id} {test_case.name}")
+                run_test_with_instrument(test_case, path_manager, test_cache_dir)
+            else:
+                class_jobs.append((test_case, test_cache_dir))
+        if batch and len(class_jobs) > 1:
+            jobs.append(class_jobs)
+        else:
+            jobs.extend([[job] for job in class_jobs])
+
+    def run_job(job: List[Tuple[TestCase, str]], work_path: str = None):
+        for test_case, _ in job:
+            path_manager.logger.info(f"\u14AA test case: {path_manager.project}-{path_manager.bug_id} {test_case.name}")
+        if len(job) == 1:
+            test_case, test_cache_dir = job[0]
+            run_test_with_instrument(test_case, path_manager, test_cache_dir, work_path)
+        else:
+            test_cases, test_cache_dirs = zip(*job)
+            run_tests_with_instrument_batch(list(test_cases), path_manager, list(test_cache_dirs), work_path)
+
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            run_job(job)
+        return
+
+    # copy the whole checkout even if the bug lives in a subproject
+    checkout_path = os.path.join(path_manager.proj_tmp_path, "buggy")
+    sub_path = os.path.relpath(path_manager.buggy_path, checkout_path)
+    copy_mode = getattr(path_manager.config.hyper, "test_copy_mode", "reflink")
+    n_workers = min(workers, len(jobs))
+    # compile once so that the copies share the compiled classes
+    compile_if_needed(path_manager)
+    copy_paths = [
+        os.path.join(path_manager.proj_tmp_path, f"buggy_worker_{i}")
+        for i in range(n_workers)
+    ]
+    path_manager.logger.info(f"running {len(jobs)} test jobs in {n_workers} {copy_mode} copies of {checkout_path}")
+
+    work_paths = queue.Queue()
+    def run_job_in_copy(job: List[Tuple[TestCase, str]]):
+        work_path = work_paths.get()
+        try:
+            run_job(job, work_path)
+        finally:
+            work_paths.put(work_path)
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(lambda p: copy_checkout(checkout_path, p, copy_mode), copy_paths))
+            for copy_path in copy_paths:
+                work_paths.put(os.path.normpath(os.path.join(copy_path, sub_path)))
+            list(executor.map(run_job_in_copy, jobs))
+    finally:
+        for copy_path in copy_paths:
+            shutil.rmtree(copy_path, ignore_errors=True)
+
+def prepare_bug(path_manager: PathManager) -> TestFailure:
+    """
+    Check out a bug, read its properties and run its failing tests with instrumentation.
+
+    All the steps keep their state in `path_manager` and run the commands with an explicit
+    `cwd`, so different bugs can be prepared concurrently in one process.
+    """
+    path_manager.logger.info("checkout ...")
+    check_out(path_manager)
+    path_manager.logger.info("get bug properties...")
+    get_properties(path_manager)
+    path_manager.logger.info("run all tests...")
+    test_failure = get_failed_tests(path_manager)
+    run_all_tests(path_manager, test_failure)
+    return test_failure
+
 
 def get_class_name_from_msg(tmp_path, test_class):
     """
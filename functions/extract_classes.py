@@ -1,8 +1,10 @@
 import os
-import subprocess as sp
+import shutil
 from functools import reduce
 from typing import List
 
+from functions.utils import git_clean, run_cmd
+
 
 def extract_classes(proj_name, bug_id, test_class, repo_dir, agent_jar, max_num=30):
     """Extract classes for a test suite (witch may contains multiple test methods)"""
@@ -10,7 +12,6 @@ def extract_classes(proj_name, bug_id, test_class, repo_dir, agent_jar, max_num=
     cwd = os.path.dirname(os.path.abspath(__file__))
     buggy_dir = os.path.join(repo_dir, proj_name, str(bug_id), "buggy")
     tmp_dir = os.path.join(cwd, "tmp")
-    os.chdir(buggy_dir)
 
     loaded_classes = []
     covered_classes = []
@@ -42,10 +43,8 @@ def extract_classes(proj_name, bug_id, test_class, repo_dir, agent_jar, max_num=
     else:
         extracted_classes = []
     
-    p = os.popen("git clean -df").read()
-    os.chdir(cwd)
-    cmd = "rm -rf tmp"
-    os.system(cmd)
+    git_clean(buggy_dir)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
     return loaded_classes, covered_classes, extracted_classes
 
 
@@ -53,26 +52,18 @@ def run_instrument(proj_name, bug_id, test_name, buggy_dir, tmp_dir, agent_jar):
     os.makedirs(tmp_dir, exist_ok=True)
     log = ""
 
-    os.chdir(buggy_dir)
     cmd1 = f"defects4j export -p dir.bin.classes"
-    p = sp.Popen(cmd1.split(" "), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-    output, err = p.communicate()
-    out = output.decode("utf-8")
-    err = err.decode("utf-8")
+    out, err = run_cmd(cmd1, cwd=buggy_dir)
     log = log + err + out + "\n"
     classes_dir = out
     assert classes_dir != "", f"[{proj_name}-{bug_id}-{test_name}] get classes dir error:\n" + log
 
     if not os.path.exists(os.path.join(buggy_dir, classes_dir)):
         cmd2 = f"defects4j compile"
-        p = sp.Popen(cmd2.split(" "), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-        output, err = p.communicate()
+        run_cmd(cmd2, cwd=buggy_dir)
     
     cmd3 = f"defects4j test -n -t {test_name} -a -Djvmargs=-javaagent:{agent_jar}=outputDir={tmp_dir},classesPath={classes_dir}"
-    p = sp.Popen(cmd3.split(" "), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-    output, err = p.communicate()
-    out = output.decode("utf-8")
-    err = err.decode("utf-8")
+    out, err = run_cmd(cmd3, cwd=buggy_dir)
     log = log + err + out + "\n"
     return log
 
@@ -83,6 +83,27 @@ def parse_test_report(lines):
     return output, report
 
 
+def split_test_reports(lines):
+    """Split the failing_tests file of a multi-test run into the report lines of each test, e.g.:
+
+    --- com.google.javascript.jscomp.TypeCheckTest::testA
+    ...
+    --- com.google.javascript.jscomp.TypeCheckTest::testB
+    ...
+
+    ==> {"com.google.javascript.jscomp.TypeCheckTest::testA": [...], "com.google.javascript.jscomp.TypeCheckTest::testB": [...]}
+    """
+    reports = {}
+    test_name = None
+    for line in lines:
+        if line.startswith("--- "):
+            test_name = line[4:].strip()
+            reports[test_name] = []
+        if test_name is not None:
+            reports[test_name].append(line)
+    return reports
+
+
 def read_text(file_path: str, max_lines: int = 50) -> str:
     with open(file_path, "r") as f:
         lines = f.readlines()
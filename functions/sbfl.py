@@ -1,55 +1,178 @@
 import os
-import re
-from typing import Dict, List
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
 
 from Utils.path_manager import PathManager
 
+SBFL_FORMULAS = ["tarantula", "ochiai", "jaccard", "ample", "ochiai2", "dstar"]
+
+
+def parse_sbfl_line(line: str) -> Tuple[str, int, float]:
+    """
+    e.g.: org.jfree.chart.plot$CategoryPlot#CategoryPlot():567;0.2581988897471611
+          ==> ("CategoryPlot", 567, 0.2581988897471611)
+    """
+    name, _, score = line.rpartition(";")
+    name, _, line_num = name.rpartition(":")
+    class_name = name.split("#")[0].split("$")[1]
+    return class_name, int(line_num), float(score)
+
+
+class SBFLTable:
+    """
+    Line-level scores of several SBFL formulas, stored per class as a sorted array of
+    line numbers and a (n_lines, n_formulas) score matrix, e.g.:
+
+        {
+            "CategoryPlot": (array([567, 568]), array([[0.25, 0.12, ...], [0.25, 0.12, ...]]))
+        }
 
-def parse_sbfl(sbfl_file) -> Dict[str, List[int]]:
+    Lines of a method range are found with binary search.
+    """
+
+    def __init__(self, formulas: List[str], classes: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        self.formulas = formulas
+        self.classes = classes
+
+    @classmethod
+    def from_files(cls, sbfl_files: Dict[str, str]) -> "SBFLTable":
+        """Load the ranking files of all formulas ({formula: file}) in one pass."""
+        formulas = list(sbfl_files.keys())
+        rows: Dict[Tuple[str, int], np.ndarray] = {}
+        for i, formula in enumerate(formulas):
+            with open(sbfl_files[formula], "r") as f:
+                lines = f.read().splitlines()[1:]  # skip the header
+            for line in lines:
+                if not line:
+                    continue
+                class_name, line_num, score = parse_sbfl_line(line)
+                key = (class_name, line_num)
+                if key not in rows:
+                    rows[key] = np.zeros(len(formulas), dtype=np.float64)
+                rows[key][i] = score
+
+        grouped: Dict[str, List[Tuple[int, np.ndarray]]] = {}
+        for (class_name, line_num), scores in rows.items():
+            grouped.setdefault(class_name, []).append((line_num, scores))
+        classes = {}
+        for class_name, class_rows in grouped.items():
+            class_rows.sort(key=lambda row: row[0])
+            line_nums = np.array([row[0] for row in class_rows], dtype=np.int64)
+            scores = np.vstack([row[1] for row in class_rows])
+            classes[class_name] = (line_nums, scores)
+        return cls(formulas, classes)
+
+    def _formula_columns(self, formula: Optional[str]) -> slice:
+        if formula is None:
+            return slice(None)
+        i = self.formulas.index(formula)
+        return slice(i, i + 1)
+
+    def is_covered(self, class_name: str, start_line: int, end_line: int, formula: Optional[str] = None) -> bool:
+        """Whether any line in [start_line, end_line] has a positive score (in any formula by default)."""
+        if class_name not in self.classes:
+            return False
+        line_nums, scores = self.classes[class_name]
+        lo = np.searchsorted(line_nums, start_line, side="left")
+        hi = np.searchsorted(line_nums, end_line, side="right")
+        return bool((scores[lo:hi, self._formula_columns(formula)] > 0).any())
+
+    def method_scores(self, methods: Sequence[Tuple[str, int, int]], formula: str) -> np.ndarray:
+        """
+        Aggregate the line scores of a formula to methods given as (class_name, start_line, end_line),
+        the score of a method is the maximum score of its lines, 0 if none of them is ranked.
+        """
+        column = self.formulas.index(formula)
+        result = np.zeros(len(methods), dtype=np.float64)
+        by_class: Dict[str, List[int]] = {}
+        for i, (class_name, _, _) in enumerate(methods):
+            if class_name in self.classes:
+                by_class.setdefault(class_name, []).append(i)
+        for class_name, indices in by_class.items():
+            line_nums, scores = self.classes[class_name]
+            starts = np.array([methods[i][1] for i in indices])
+            ends = np.array([methods[i][2] for i in indices])
+            lo = np.searchsorted(line_nums, starts, side="left")
+            hi = np.searchsorted(line_nums, ends, side="right")
+            # max over each [lo, hi) slice in one reduceat call, a zero row pads the end
+            padded = np.append(scores[:, column], 0.0)
+            bounds = np.empty(2 * len(indices), dtype=np.int64)
+            bounds[0::2] = lo
+            bounds[1::2] = hi
+            maxima = np.maximum.reduceat(padded, bounds)[0::2]
+            result[indices] = np.where(hi > lo, maxima, 0.0)
+        return result
+
+    def result(self, formula: str) -> "SBFLResult":
+        return SBFLResult(self, formula)
+
+
+class SBFLResult(Mapping):
+    """
+    Read-only view of one formula of an SBFLTable as {class_name: [lines with a positive score]},
+    the format returned by `parse_sbfl`.
+    """
+
+    def __init__(self, table: SBFLTable, formula: str):
+        self.table = table
+        self.formula = formula
+        self._column = table.formulas.index(formula)
+        self._covered = {
+            class_name: line_nums[scores[:, self._column] > 0]
+            for class_name, (line_nums, scores) in table.classes.items()
+            if (scores[:, self._column] > 0).any()
+        }
+
+    def __getitem__(self, class_name: str) -> List[int]:
+        return self._covered[class_name].tolist()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._covered)
+
+    def __len__(self) -> int:
+        return len(self._covered)
+
+    def is_covered(self, class_name: str, start_line: int, end_line: int) -> bool:
+        return self.table.is_covered(class_name, start_line, end_line, self.formula)
+
+
+def parse_sbfl(sbfl_file) -> SBFLResult:
     """
     Parse the SBFL result from line level to method level.
     e.g.:
         org.jfree.chart.plot$CategoryPlot#CategoryPlot():567;0.2581988897471611
         org.jfree.chart.plot$CategoryPlot#CategoryPlot():568;0.2581988897471611
-        
+
         ==>
-        
+
         {
             "CategoryPlot": [567, 568]
         }
     """
-    res = {}
-    with open(sbfl_file, "r") as f:
-        line = f.readline() # skip the first line
-        line = f.readline().strip("\n")
-        while line:
-            full_name, method_name, line_num, score = re.split(r"[#:;]", line)
-            class_name = full_name.split("$")[1]
-            
-            if score == "0.0":
-                break
-
-            try:
-                res[class_name].append(int(line_num))
-            except:
-                res[class_name] = [int(line_num)]
-            line = f.readline().strip("\n")
-    return res
-
-def get_all_sbfl_res(path_manager: PathManager):
-    sbfl_names = ["tarantula","ochiai","jaccard","ample","ochiai2","dstar"]
-    sbfl_files = []
-    for name in sbfl_names:
-        sbfl_files.append(os.path.join(
+    formula = os.path.basename(sbfl_file).split(".")[0]
+    return SBFLTable.from_files({formula: sbfl_file}).result(formula)
+
+
+def get_sbfl_files(path_manager: PathManager, formulas: List[str] = SBFL_FORMULAS) -> Dict[str, str]:
+    return {
+        name: os.path.join(
             path_manager.root_path,
             "SBFL",
             "results",
             path_manager.project,
-            path_manager.bug_id,
+            str(path_manager.bug_id),
             f"{name}.ranking.csv"
-        ))
-    
-    sbfl_reses = []
-    for sbfl_file in sbfl_files:
-        sbfl_reses.append(parse_sbfl(sbfl_file))
-    return sbfl_reses
\ No newline at end of file
+        )
+        for name in formulas
+    }
+
+
+def load_sbfl_table(path_manager: PathManager, formulas: List[str] = SBFL_FORMULAS) -> SBFLTable:
+    return SBFLTable.from_files(get_sbfl_files(path_manager, formulas))
+
+
+def get_all_sbfl_res(path_manager: PathManager) -> List[SBFLResult]:
+    table = load_sbfl_table(path_manager)
+    return [table.result(name) for name in table.formulas]
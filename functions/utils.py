@@ -1,26 +1,145 @@
+import asyncio
 import os
 import re
-import subprocess as sp
+import shlex
+import signal
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import List, Optional, Union
 
 import chardet
 
+from Utils.async_utils import asyncio_run
 
-def run_cmd(cmd: str):
-    print(f"run command: {cmd}")
-    p = sp.Popen(cmd.split(" "), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-    output, err = p.communicate()
-    out = output.decode("utf-8")
-    err = err.decode("utf-8")
-    print(err)
-    print(out)
-    print("-" * 50)
-    return out, err
+# lines of stdout/stderr kept in memory when the full output goes to a log file
+DEFAULT_TAIL_LINES = 200
+
+
+class CmdError(RuntimeError):
+    """A command exited with a non-zero code or ran into its timeout."""
+
+    def __init__(self, result: "CmdResult"):
+        self.result = result
+        reason = "timed out" if result.timed_out else f"exited with code {result.returncode}"
+        super().__init__(f"command {reason} after {result.duration:.1f}s: {result.cmd}\n{result.err[-2000:]}")
+
+
+@dataclass
+class CmdResult:
+    cmd: str
+    returncode: Optional[int]
+    out: str
+    err: str
+    duration: float
+    timed_out: bool = False
+
+
+def _kill_process_group(process: asyncio.subprocess.Process):
+    """Kill the command with its children, e.g. the JVM forked by Ant."""
+    if process.returncode is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def _read_stream(stream: asyncio.StreamReader, lines: deque, log, prefix: str):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        text = line.decode("utf-8", errors="replace")
+        lines.append(text)
+        if log is not None:
+            log.write(prefix + text)
+
+
+async def arun_cmd(cmd: Union[str, List[str]],
+                   cwd: str = None,
+                   timeout: float = None,
+                   log_file: str = None,
+                   check: bool = False) -> CmdResult:
+    """
+    Run a command without blocking the event loop.
+
+    stdout and stderr are read line by line. With `log_file` the full output is appended
+    to the file and only the last lines are kept in memory, otherwise all of it is kept.
+    The command (with its child processes) is killed when `timeout` seconds pass or the
+    awaiting task is cancelled. With `check` a non-zero exit code or a timeout raises
+    a CmdError.
+    """
+    args = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+    cmd_str = " ".join(args)
+    print(f"run command: {cmd_str}")
+    max_lines = DEFAULT_TAIL_LINES if log_file else None
+    out_lines, err_lines = deque(maxlen=max_lines), deque(maxlen=max_lines)
+    timed_out = False
+    start = time.perf_counter()
+    log = None
+    if log_file:
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        log = open(log_file, "a", encoding="utf-8")
+        log.write(f"$ {cmd_str}\n")
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args,
+            cwd=cwd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    _read_stream(process.stdout, out_lines, log, ""),
+                    _read_stream(process.stderr, err_lines, log, "[stderr] "),
+                    process.wait(),
+                ),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            timed_out = True
+            _kill_process_group(process)
+            await process.wait()
+        except asyncio.CancelledError:
+            _kill_process_group(process)
+            raise
+    finally:
+        if log is not None:
+            log.close()
+    result = CmdResult(
+        cmd=cmd_str,
+        returncode=process.returncode,
+        out="".join(out_lines),
+        err="".join(err_lines),
+        duration=time.perf_counter() - start,
+        timed_out=timed_out,
+    )
+    print(f"command finished with code {result.returncode} in {result.duration:.1f}s"
+          + (" (timed out)" if timed_out else ""))
+    if check and (timed_out or result.returncode != 0):
+        raise CmdError(result)
+    return result
+
+
+def run_cmd(cmd: Union[str, List[str]],
+            cwd: str = None,
+            timeout: float = None,
+            log_file: str = None,
+            check: bool = False):
+    """Blocking version of `arun_cmd`, returns stdout and stderr."""
+    result = asyncio_run(arun_cmd(cmd, cwd=cwd, timeout=timeout, log_file=log_file, check=check))
+    if log_file is None:
+        print(result.err)
+        print(result.out)
+        print("-" * 50)
+    return result.out, result.err
 
 def git_clean(git_dir):
-    cwd = os.getcwd()
-    os.chdir(git_dir)
-    run_cmd("git clean -df")
-    os.chdir(cwd)
+    run_cmd("git clean -df", cwd=git_dir)
 
 def clean_doc(doc: str) -> str:
     """
@@ -9,7 +9,7 @@ from llama_index.core import Settings, SimpleDirectoryReader, VectorStoreIndex
 from llama_index.core.storage.docstore import SimpleDocumentStore
 from llama_index.vector_stores.chroma import ChromaVectorStore
 
-from functions.sbfl import get_all_sbfl_res
+from functions.sbfl import SBFLResult, get_all_sbfl_res
 from preprocess.code_extractors import CodeSummaryExtractor
 from preprocess.node_parser import JavaNodeParser
 from Utils.path_manager import PathManager
@@ -101,6 +101,8 @@ class ProjectIndexBuilder():
         file_name = file_path.split("/")[-1]
         class_name = file_name.split(".")[0]
         
+        if isinstance(sbfl_res, SBFLResult):
+            return sbfl_res.is_covered(class_name, start_line, end_line)
         if class_name in sbfl_res:
             for line_num in sbfl_res[class_name]:
                 if start_line <= line_num <= end_line:
@@ -58,7 +58,7 @@ def run_one_bug(config: str, version: str, project: str, bugID: int, clear: bool
     
     if clear:
         shutil.rmtree(path_manager.buggy_path)
-        shutil.rmtree(path_manager.fixed_path)
+        shutil.rmtree(path_manager.fixed_path, ignore_errors=True)
 
 
 def run_all_bugs(config_name: str):
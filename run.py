@@ -74,25 +74,31 @@ def main():
     # set models
     set_models(path_manager)
 
+    telemetry = path_manager.telemetry
+
     # check out the d4j project
     path_manager.logger.info("checkout ...")
-    check_out(path_manager)
+    with telemetry.span("checkout"):
+        check_out(path_manager)
 
     # get bug specific information
     path_manager.logger.info("get bug properties...")
-    get_properties(path_manager)
+    with telemetry.span("properties"):
+        get_properties(path_manager)
 
     # run all tests
     path_manager.logger.info("run all tests...")
-    test_failure_obj = get_failed_tests(path_manager)
-    run_all_tests(path_manager, test_failure_obj)
+    with telemetry.span("tests"):
+        test_failure_obj = get_failed_tests(path_manager)
+        run_all_tests(path_manager, test_failure_obj)
 
     # init store
-    store = HybridStore(path_manager)
+    store = HybridStore(path_manager, test_failure_obj)
 
     # diagnose faulty functionalities
-    diag_agent = DiagnoseAgent(path_manager, store)
-    faulty_funcs = diag_agent.diagnose(test_failure_obj)
+    with telemetry.span("diagnose"):
+        diag_agent = DiagnoseAgent(path_manager, store)
+        faulty_funcs = diag_agent.diagnose(test_failure_obj)
 
     # retrieve methods
     method_retriever = MethodRetriever(path_manager, store)
@@ -100,6 +106,7 @@ def main():
 
     # Evaluate
     evaluate(path_manager, method_nodes, [], test_failure_obj)
+    path_manager.token_ledger.dump(path_manager.token_ledger_file)
 
     if path_manager.config.clear:
         shutil.rmtree(path_manager.proj_tmp_path, ignore_errors=True)
@@ -2,16 +2,50 @@ import os
 import shutil
 import subprocess
 import sys
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
 from igraph import config
 
+from functions.d4j import prepare_bug
 from projects import ALL_BUGS
+from Utils.path_manager import PathManager
 
 root = os.path.dirname(__file__)
 sys.path.append(root)
 
 
+def prepare_all_bugs(config_name: str, workers: int):
+    """
+    Check out all unfinished bugs and run their failing tests concurrently in this process,
+    so that the runs of run_all_bugs start from the prepared checkouts and test results.
+    """
+    bugs = []
+    for version in ALL_BUGS:
+        for proj in ALL_BUGS[version]:
+            bugIDs = ALL_BUGS[version][proj][0]
+            deprecatedIDs = ALL_BUGS[version][proj][1]
+            subproj = (
+                ALL_BUGS[version][proj][2] if version == "GrowingBugs" else ""
+            )
+            for bug_id in bugIDs:
+                res_file = os.path.join(root, f"DebugResult/{config_name.replace('.yaml', '')}/{version}/{proj}/{proj}-{bug_id}", "result.json")
+                if bug_id in deprecatedIDs or os.path.exists(res_file):
+                    continue
+                bugs.append(Namespace(config=config_name, version=version, project=proj, bugID=bug_id, subproj=subproj, verbose=False))
+
+    def prepare_one_bug(args: Namespace):
+        try:
+            prepare_bug(PathManager(args))
+        except Exception as e:
+            # the bug is prepared again (and fails loudly) in its own run
+            print(f"Error in preparing {args.version}-{args.project}-{args.bugID}: {e}")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(prepare_one_bug, bugs))
+
+
 def run_all_bugs(config_name: str):
     for version in ALL_BUGS:
         for proj in ALL_BUGS[version]:
@@ -67,4 +101,8 @@ if __name__ == "__main__":
     # config_name = "module_analysis_optimized.yaml"
     # config_name = "mimic.yaml"
 
+    # check out and test several bugs at a time before the sequential runs, 0 to disable
+    prepare_workers = 0
+    if prepare_workers > 0:
+        prepare_all_bugs(config_name, prepare_workers)
     run_all_bugs(config_name)